@@ -0,0 +1,66 @@
+import type { Capability, ChangeEntry } from '../types/api';
+
+// Apply change feed entries to a capability tree and return the new tree.
+// Every change sets absolute values, so applying one twice is harmless.
+export function applyModelChanges(tree: Capability[], changes: ChangeEntry[]): Capability[] {
+  const nodes = new Map<number, Capability>();
+  const collect = (caps: Capability[]) => {
+    caps.forEach(cap => {
+      nodes.set(cap.id, { ...cap, children: [] });
+      collect(cap.children ?? []);
+    });
+  };
+  collect(tree);
+
+  for (const change of changes) {
+    const values = change.values ?? {};
+    const id = change.capability_id;
+    switch (change.operation) {
+      case 'create':
+      case 'update':
+      case 'move': {
+        if (id === null) break;
+        let node = nodes.get(id);
+        if (!node) {
+          // Updates of capabilities deleted later in the batch are skipped
+          if (change.operation !== 'create') break;
+          node = { id, name: '', description: null, parent_id: null, children: [] };
+          nodes.set(id, node);
+        }
+        Object.assign(node, values);
+        break;
+      }
+      case 'delete': {
+        if (id !== null) nodes.delete(id);
+        ((values.removed_ids as number[] | undefined) ?? []).forEach(removed => nodes.delete(removed));
+        break;
+      }
+      case 'reorder': {
+        ((values.order_positions as [number, number][] | undefined) ?? []).forEach(([childId, position]) => {
+          const node = nodes.get(childId);
+          if (node) node.order_position = position;
+        });
+        break;
+      }
+    }
+  }
+
+  // Rebuild the hierarchy; nodes whose parent is gone are dropped with it
+  const roots: Capability[] = [];
+  nodes.forEach(node => {
+    if (node.parent_id === null) {
+      roots.push(node);
+    } else {
+      nodes.get(node.parent_id)?.children!.push(node);
+    }
+  });
+  const finish = (caps: Capability[]): number => {
+    caps.sort((a, b) => (a.order_position ?? 0) - (b.order_position ?? 0) || a.id - b.id);
+    return caps.reduce((count, cap) => {
+      cap.descendant_count = finish(cap.children!);
+      return count + 1 + cap.descendant_count;
+    }, 0);
+  };
+  finish(roots);
+  return roots;
+}
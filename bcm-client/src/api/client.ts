@@ -1,13 +1,16 @@
 import axios from 'axios';
 import type {
   AuditLogEntry,
+  AuditLogPage,
   Capability,
+  CapabilityBatchCreate,
   CapabilityContextResponse,
   CapabilityCreate,
   CapabilityMove,
   CapabilityUpdate,
   ConfluencePublishRequest,
   LayoutModel,
+  ModelChangedEvent,
   PromptUpdate,
   PublishProgress,
   Settings,
@@ -31,7 +34,7 @@ const api = axios.create({
 // WebSocket connection manager
 class WebSocketManager {
   private ws: WebSocket | null = null;
-  private onModelChangeCallbacks: Set<(user: string, action: string) => void> = new Set();
+  private onModelChangeCallbacks: Set<(event: ModelChangedEvent) => void> = new Set();
   private onUserEventCallbacks: Set<(user: string, event: string) => void> = new Set();
 
   connect(sessionId?: string) {
@@ -43,7 +46,7 @@ class WebSocketManager {
     this.ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
       if (data.type === 'model_changed') {
-        this.notifyModelChange(data.user, data.action);
+        this.notifyModelChange(data);
       } else if (data.type === 'user_event') {
         this.notifyUserEvent(data.user, data.event);
       }
@@ -69,7 +72,7 @@ class WebSocketManager {
     }
   }
 
-  onModelChange(callback: (user: string, action: string) => void) {
+  onModelChange(callback: (event: ModelChangedEvent) => void) {
     this.onModelChangeCallbacks.add(callback);
     return () => this.onModelChangeCallbacks.delete(callback);
   }
@@ -79,8 +82,8 @@ class WebSocketManager {
     return () => this.onUserEventCallbacks.delete(callback);
   }
 
-  private notifyModelChange(user: string, action: string) {
-    this.onModelChangeCallbacks.forEach(callback => callback(user, action));
+  private notifyModelChange(event: ModelChangedEvent) {
+    this.onModelChangeCallbacks.forEach(callback => callback(event));
   }
 
   private notifyUserEvent(user: string, event: string) {
@@ -121,6 +124,11 @@ export const ApiClient = {
     return response.data;
   },
 
+  createCapabilities: async (batch: CapabilityBatchCreate, sessionId: string): Promise<Capability[]> => {
+    const response = await api.post<Capability[]>(`/api/capabilities/batch?session_id=${sessionId}`, batch);
+    return response.data;
+  },
+
   getCapability: async (capabilityId: number): Promise<Capability> => {
     const response = await api.get<Capability>(`/api/capabilities/${capabilityId}`);
     return response.data;
@@ -236,10 +244,15 @@ export const ApiClient = {
     await api.post(`/api/clearlocks?session_id=${sessionId}`);
   },
 
-  // Get audit logs
-  getLogs: async (): Promise<AuditLogEntry[]> => {
-    const response = await api.get<AuditLogEntry[]>('/api/logs');
-    return response.data;
+  // Get one page of audit logs, newest first
+  getLogs: async (cursor?: string | null): Promise<AuditLogPage> => {
+    const response = await api.get<AuditLogEntry[]>('/api/logs', {
+      params: { descending: true, ...(cursor ? { cursor } : {}) },
+    });
+    return {
+      logs: response.data,
+      nextCursor: response.headers['x-next-cursor'] ?? null,
+    };
   },
 
   // Reset database and clear locks
@@ -7,6 +7,8 @@ export default function AuditLogs() {
   const [logs, setLogs] = useState<AuditLogEntry[]>([]);
   const [searchTerm, setSearchTerm] = useState('');
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [error, setError] = useState<string | null>(null);
   const [sortColumn, setSortColumn] = useState<'timestamp' | 'operation' | 'capability_name'>('timestamp');
   const [sortDirection, setSortDirection] = useState<'asc' | 'desc'>('desc');
@@ -26,10 +28,10 @@ export default function AuditLogs() {
   useEffect(() => {
     const fetchLogs = async () => {
       try {
-        const data = await ApiClient.getLogs();
-        // Sort logs by timestamp (newest first)
-        data.sort((a, b) => new Date(b.timestamp).getTime() - new Date(a.timestamp).getTime());
-        setLogs(data);
+        // Pages arrive newest first
+        const page = await ApiClient.getLogs();
+        setLogs(page.logs);
+        setNextCursor(page.nextCursor);
       } catch (err) {
         setError('Failed to load audit logs');
         console.error('Error loading logs:', err);
@@ -41,6 +43,21 @@ export default function AuditLogs() {
     fetchLogs();
   }, []);
 
+  const loadMore = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const page = await ApiClient.getLogs(nextCursor);
+      setLogs(prev => [...prev, ...page.logs]);
+      setNextCursor(page.nextCursor);
+    } catch (err) {
+      setError('Failed to load audit logs');
+      console.error('Error loading logs:', err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const formatChanges = (log: AuditLogEntry): string => {
     const changes: string[] = [];
 
@@ -234,6 +251,18 @@ export default function AuditLogs() {
           </tbody>
         </table>
       </div>
+
+      {nextCursor && (
+        <div className="flex justify-center mt-4">
+          <button
+            onClick={loadMore}
+            disabled={loadingMore}
+            className="px-4 py-2 bg-blue-600 text-white rounded hover:bg-blue-700 disabled:opacity-50"
+          >
+            {loadingMore ? 'Loading...' : 'Load older entries'}
+          </button>
+        </div>
+      )}
     </div>
   );
 }
@@ -8,7 +8,7 @@ import ReactMarkdown from 'react-markdown';
 import { useNavigate } from 'react-router-dom';
 import { ApiClient } from '../api/client';
 import { useApp } from '../contexts/AppContext';
-import type { Capability } from '../types/api';
+import type { Capability, CapabilityBatchItem } from '../types/api';
 
 interface DragItem {
   id: number;
@@ -385,6 +385,11 @@ export const DraggableCapability: React.FC<Props> = ({
                 >
                   {capability.name}
                 </h3>
+                {!(globalExpanded === undefined ? isExpanded : globalExpanded) && !!capability.descendant_count && (
+                  <span className="ml-2 text-xs text-gray-400">
+                    {capability.descendant_count}
+                  </span>
+                )}
                 {directLockingUser && (
                   <span className="ml-2 px-2 py-0.5 text-xs font-medium bg-red-100 text-red-800 rounded-full">
                     {directLockingUser.nickname}
@@ -478,18 +483,14 @@ export const DraggableCapability: React.FC<Props> = ({
                       }
                       const clipboardText = await navigator.clipboard.readText();
                       console.log('Clipboard content:', clipboardText);
-                      let capabilities: Array<{
-                        name: string;
-                        description?: string;
-                        children?: RecursiveCapability[];
-                      }>;
+                      let capabilities: CapabilityBatchItem[];
                       try {
                         // First repair any malformed JSON
                         const repairedJson = jsonrepair(clipboardText);
                         capabilities = JSON.parse(repairedJson);
                         
                         // Clean up description fields
-                        const cleanupDescription = (cap: RecursiveCapability) => {
+                        const cleanupDescription = (cap: CapabilityBatchItem) => {
                           if (cap.description) {
                             // Replace sequences of newlines followed by spaces with a single newline
                             cap.description = cap.description.replace(/\n+\s*/g, '\n\n');
@@ -509,27 +510,11 @@ export const DraggableCapability: React.FC<Props> = ({
                         return;
                       }
 
-                      // Create capabilities recursively
-                      interface RecursiveCapability {
-                        name: string;
-                        description?: string;
-                        children?: RecursiveCapability[];
-                      }
-
-                      const createCapabilityTree = async (caps: RecursiveCapability[], parentId: number | null = null) => {
-                        for (const cap of caps) {
-                          const newCap = await ApiClient.createCapability({
-                            name: cap.name,
-                            description: cap.description,
-                            parent_id: parentId
-                          }, userSession?.session_id || '');
-                          if (cap.children?.length) {
-                            await createCapabilityTree(cap.children, newCap.id);
-                          }
-                        }
-                      };
-
-                      await createCapabilityTree(capabilities, capability.id);
+                      // Create the whole pasted tree in one request
+                      await ApiClient.createCapabilities({
+                        parent_id: capability.id,
+                        capabilities
+                      }, userSession?.session_id || '');
                       toast.success('Capabilities pasted successfully');
                     } catch (error) {
                       console.error('Failed to paste capabilities:', error);
@@ -1,6 +1,7 @@
-import React, { createContext, useContext, useState, useEffect } from 'react';
+import React, { createContext, useContext, useState, useEffect, useRef } from 'react';
 import { ApiClient, wsManager } from '../api/client';
-import type { UserSession, Capability } from '../types/api';
+import { applyModelChanges } from '../api/changes';
+import type { UserSession, Capability, ChangeEntry } from '../types/api';
 import toast from 'react-hot-toast';
 
 interface DropTarget {
@@ -51,6 +52,10 @@ export const AppProvider: React.FC<{ children: React.ReactNode }> = ({ children
   const [capabilities, setCapabilities] = useState<Capability[]>([]);
   const [activeUsers, setActiveUsers] = useState<UserSession[]>([]);
   const [currentDropTarget, setCurrentDropTarget] = useState<DropTarget | null>(null);
+  // Model revision the local tree is at, once known from a model_changed event
+  const revision = useRef<number | null>(null);
+  // Changes received while full reloads are in flight, reapplied on their result
+  const pendingChanges = useRef<Set<ChangeEntry[]>>(new Set());
 
   // Fetch active users periodically
   useEffect(() => {
@@ -74,11 +79,25 @@ export const AppProvider: React.FC<{ children: React.ReactNode }> = ({ children
           wsManager.connect(userSession.session_id);
           
           // Set up model change handler
-          const unsubscribeModel = wsManager.onModelChange((user, action) => {
-            refreshCapabilities();
-            // Don't show toast for own actions
-            if (user !== userSession.nickname) {
-              toast(`${user} ${action}`, {
+          const unsubscribeModel = wsManager.onModelChange(({ user, action, events, since, revision: next, resync, changes }) => {
+            if (next === undefined || resync || since !== revision.current) {
+              // Missed changes (or none sent): reload the whole model
+              revision.current = next ?? null;
+              refreshCapabilities();
+            } else {
+              revision.current = next;
+              if (changes?.length) {
+                pendingChanges.current.forEach(pending => pending.push(...changes));
+                setCapabilities(caps => applyModelChanges(caps, changes));
+              }
+            }
+            // Don't show toast for own actions; coalesced events list them all
+            const others = (events ?? [{ user, action }]).filter(e => e.user !== userSession.nickname);
+            if (others.length) {
+              const message = others.length === 1
+                ? `${others[0].user} ${others[0].action}`
+                : `${[...new Set(others.map(e => e.user))].join(', ')} made ${others.length} changes`;
+              toast(message, {
                 duration: 3000,
                 position: 'bottom-right',
                 style: {
@@ -178,10 +197,13 @@ export const AppProvider: React.FC<{ children: React.ReactNode }> = ({ children
   };
 
   const refreshCapabilities = async () => {
+    const pending: ChangeEntry[] = [];
+    pendingChanges.current.add(pending);
     try {
       const caps = await ApiClient.getCapabilities(null, true);
       if (Array.isArray(caps)) {
-        setCapabilities(caps);
+        // The response may predate changes that arrived meanwhile
+        setCapabilities(pending.length ? applyModelChanges(caps, pending) : caps);
       } else {
         console.error('Invalid capabilities response:', caps);
         setCapabilities([]);
@@ -190,6 +212,8 @@ export const AppProvider: React.FC<{ children: React.ReactNode }> = ({ children
       console.error('Failed to fetch capabilities:', error);
       setCapabilities([]);
       throw error;
+    } finally {
+      pendingChanges.current.delete(pending);
     }
   };
 
@@ -15,16 +15,48 @@ export interface Capability {
   parent_id: number | null;
   order_position?: number;
   children?: Capability[];
+  descendant_count?: number;  // Number of capabilities below this one
   locked_by?: string | null;  // Nickname of user who locked the capability
   is_locked?: boolean;        // Whether the capability is locked
 }
 
+// One node-level change from the model's change feed
+export interface ChangeEntry {
+  revision: number;
+  operation: 'create' | 'update' | 'move' | 'delete' | 'reorder' | 'reset';
+  capability_id: number | null;
+  values: Record<string, unknown> | null;
+}
+
+// WebSocket event sent after every change to the model
+export interface ModelChangedEvent {
+  type: 'model_changed';
+  user: string;       // All users of the events, comma separated
+  action: string;     // The action, or a count of the events
+  events?: { user: string; action: string }[];  // Changes coalesced into this event
+  since?: number;     // Revision of the previous event
+  revision?: number;  // Model revision after the changes
+  resync?: boolean;   // Changes unavailable: reload the model
+  changes?: ChangeEntry[];
+}
+
 export interface CapabilityCreate {
   name: string;
   description?: string | null;
   parent_id?: number | null;
 }
 
+export interface CapabilityBatchItem {
+  name: string;
+  description?: string | null;
+  children?: CapabilityBatchItem[];
+}
+
+export interface CapabilityBatchCreate {
+  parent_id?: number | null;
+  capabilities: CapabilityBatchItem[];
+}
+
 export interface CapabilityUpdate {
   name?: string;
   description?: string | null;
@@ -82,6 +114,12 @@ export interface AuditLogEntry {
   };
 }
 
+export interface AuditLogPage {
+  logs: AuditLogEntry[];
+  // Cursor for the next page, null on the last page
+  nextCursor: string | null;
+}
+
 export interface Settings {
   max_ai_capabilities: number;
   first_level_range: string;
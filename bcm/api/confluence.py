@@ -7,10 +7,18 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from bcm.api.state import app_state
 from bcm.confluence_publish import publish_capability_to_confluence
 from bcm.database import DatabaseOperations
-from bcm.models import AsyncSessionLocal, ConfluencePublishRequest, get_db
+from bcm.models import (
+    AsyncSessionLocal,
+    AuditSessionLocal,
+    ConfluencePublishRequest,
+    ReadSessionLocal,
+    get_db,
+)
 
 # Initialize database operations
-db_ops = DatabaseOperations(AsyncSessionLocal)
+db_ops = DatabaseOperations(
+    AsyncSessionLocal, AuditSessionLocal, read_session_factory=ReadSessionLocal
+)
 
 router = APIRouter(tags=["io"])
 
@@ -69,7 +77,7 @@ async def publish_to_confluence(
 
             # After successful completion, notify all clients
             await app_state.connection_manager.broadcast_model_change(
-                app_state.active_users[session_id]["nickname"],
+                app_state.active_users[session_id].nickname,
                 "published to Confluence",
             )
 
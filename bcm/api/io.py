@@ -1,4 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException
+import json
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from bcm.api.export_handler import format_capability
@@ -7,15 +11,19 @@ from bcm.database import DatabaseOperations
 from bcm.layout_manager import process_layout
 from bcm.models import (
     AsyncSessionLocal,
+    AuditSessionLocal,
     FormatRequest,
     ImportData,
     LayoutModel,
+    ReadSessionLocal,
     get_db
 )
 from bcm.settings import Settings
 
 # Initialize database operations
-db_ops = DatabaseOperations(AsyncSessionLocal)
+db_ops = DatabaseOperations(
+    AsyncSessionLocal, AuditSessionLocal, read_session_factory=ReadSessionLocal
+)
 
 router = APIRouter(tags=["io"])
 
@@ -31,7 +39,51 @@ async def import_capabilities(
         await db_ops.import_capabilities(import_data.data)
         # Notify all clients about model change
         await app_state.connection_manager.broadcast_model_change(
-            app_state.active_users[session_id]["nickname"], "imported capabilities"
+            app_state.active_users[session_id].nickname, "imported capabilities"
+        )
+        return {"message": "Capabilities imported successfully"}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def read_ndjson(request: Request) -> List[dict]:
+    """Parse a newline-delimited JSON request body as it arrives."""
+    items = []
+    buffer = b""
+
+    def parse(line: bytes):
+        line = line.strip()
+        if not line:
+            return
+        item = json.loads(line)
+        if not isinstance(item, dict):
+            raise ValueError(f"Expected a JSON object per line, got: {line[:80]!r}")
+        items.append(item)
+
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            parse(line)
+    parse(buffer)
+    return items
+
+
+@router.post("/import/ndjson")
+async def import_capabilities_ndjson(request: Request, session_id: str):
+    """Import capabilities from a streamed NDJSON body, one capability per line.
+
+    Accepts the output of GET /export?format=ndjson.
+    """
+    if session_id not in app_state.active_users:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    try:
+        data = await read_ndjson(request)
+        await db_ops.import_capabilities(data)
+        # Notify all clients about model change
+        await app_state.connection_manager.broadcast_model_change(
+            app_state.active_users[session_id].nickname, "imported capabilities"
         )
         return {"message": "Capabilities imported successfully"}
     except Exception as e:
@@ -39,11 +91,31 @@ async def import_capabilities(
 
 
 @router.get("/export")
-async def export_capabilities(session_id: str, db: AsyncSession = Depends(get_db)):
-    """Export capabilities to JSON."""
+async def export_capabilities(
+    session_id: str,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Export capabilities to JSON.
+
+    With format=ndjson the export is streamed as newline-delimited JSON, one
+    capability per line, so memory use stays flat for large models.
+    """
     if session_id not in app_state.active_users:
         raise HTTPException(status_code=404, detail="Session not found")
 
+    if format == "ndjson":
+
+        async def lines():
+            async for item in db_ops.stream_export_capabilities():
+                yield json.dumps(item) + "\n"
+
+        return StreamingResponse(
+            lines(),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": 'attachment; filename="capabilities.ndjson"'},
+        )
+
     try:
         data = await db_ops.export_capabilities()
         return data
@@ -51,18 +123,51 @@ async def export_capabilities(session_id: str, db: AsyncSession = Depends(get_db
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/export/snapshot")
+async def export_snapshot(
+    session_id: str, codec: str = Query("zlib", pattern="^(none|zlib|zstd)$")
+):
+    """Export the model as a compact binary snapshot."""
+    if session_id not in app_state.active_users:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    try:
+        data = await db_ops.export_snapshot(codec)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(
+        content=data,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="capabilities.bcms"'},
+    )
+
+
+@router.post("/import/snapshot")
+async def import_snapshot(request: Request, session_id: str):
+    """Replace the model with a binary snapshot from GET /export/snapshot."""
+    if session_id not in app_state.active_users:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    try:
+        await db_ops.import_snapshot(await request.body())
+        # Notify all clients about model change
+        await app_state.connection_manager.broadcast_model_change(
+            app_state.active_users[session_id].nickname, "imported capabilities"
+        )
+        return {"message": "Capabilities imported successfully"}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @router.get("/layout/{node_id}", response_model=LayoutModel)
 async def get_layout(node_id: int, db: AsyncSession = Depends(get_db)):
     """Get layouted model starting from the specified node ID."""
-    # Get hierarchical data starting from node
-    node_data = await db_ops.get_capability_with_children(node_id)
-    if not node_data:
-        raise HTTPException(status_code=404, detail="Node not found")
-
-    # Convert to layout format using shared method
+    # Convert to layout format, loading only the levels that are shown
     settings = Settings()
     max_level = settings.get("max_level", 6)
-    layout_model = LayoutModel.convert_to_layout_format(node_data, max_level)
+    layout_model = await db_ops.get_layout_model(node_id, max_level)
+    if layout_model is None:
+        raise HTTPException(status_code=404, detail="Node not found")
     return process_layout(layout_model, settings)
 
 
@@ -71,14 +176,11 @@ async def format_node(
     node_id: int, format_request: FormatRequest, db: AsyncSession = Depends(get_db)
 ):
     """Format a node and its children in the specified format."""
-    # Get hierarchical data starting from node
-    node_data = await db_ops.get_capability_with_children(node_id)
-    if not node_data:
-        raise HTTPException(status_code=404, detail="Node not found")
-
-    # Convert to layout format
+    # Convert to layout format, loading only the levels that are shown
     settings = Settings()
     max_level = settings.get("max_level", 6)
-    layout_model = LayoutModel.convert_to_layout_format(node_data, max_level)
+    layout_model = await db_ops.get_layout_model(node_id, max_level)
+    if layout_model is None:
+        raise HTTPException(status_code=404, detail="Node not found")
 
     return format_capability(node_id, format_request.format, layout_model, settings)
@@ -3,7 +3,14 @@ import socket
 from contextlib import asynccontextmanager
 from typing import List, Optional
 
-from fastapi import Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Query,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
@@ -17,16 +24,24 @@ from bcm.api import confluence, io
 from bcm.database import DatabaseOperations
 from bcm.models import (
     AsyncSessionLocal,
+    AuditSessionLocal,
+    CapabilityBatchCreate,
     CapabilityCreate,
     CapabilityMove,
+    CapabilityOperation,
+    CapabilityTransaction,
     CapabilityUpdate,
+    ChangeFeed,
     PromptUpdate,
+    ReadSessionLocal,
     get_db,
     init_db,
 )
 
 # Initialize database operations
-db_ops = DatabaseOperations(AsyncSessionLocal)
+db_ops = DatabaseOperations(
+    AsyncSessionLocal, AuditSessionLocal, read_session_factory=ReadSessionLocal
+)
 
 
 def get_all_ipv4_addresses():
@@ -57,6 +72,10 @@ async def lifespan(app: FastAPI):
     """Handle startup and shutdown events."""
     # Initialize database
     await init_db()
+    # model_changed events carry the changes made since the previous one
+    app_state.connection_manager.set_change_feed(
+        db_ops.get_changes, await db_ops.get_revision()
+    )
 
     # Get port from uvicorn command arguments
     import sys
@@ -86,6 +105,14 @@ async def lifespan(app: FastAPI):
 
     yield  # Server is running
 
+    await app_state.connection_manager.stop()
+    # Let background maintenance such as sibling rebalancing finish
+    await db_ops.drain_background_tasks()
+    if db_ops.writer is not None:
+        await db_ops.writer.stop()
+    # Write audit entries that are still queued
+    await db_ops.audit.stop()
+
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -128,6 +155,7 @@ api_app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
     max_age=3600,
 )
 
@@ -171,33 +199,60 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
         await websocket.close(code=4000)
         return
 
-    nickname = app_state.active_users[session_id]["nickname"]
-    await app_state.connection_manager.connect(websocket, session_id, nickname)
+    await app_state.connection_manager.connect(websocket, session_id)
 
     try:
         while True:
             await websocket.receive_text()  # Keep connection alive
     except WebSocketDisconnect:
-        nickname = app_state.connection_manager.disconnect(session_id)
+        nickname = app_state.connection_manager.disconnect(session_id, websocket)
         if nickname:
             # Broadcast user left event
             await app_state.connection_manager.broadcast_user_event(nickname, "left")
 
 
+async def check_not_locked(
+    capability_id: int, session_id: str, descendants: bool = False
+) -> None:
+    """Raise 409 if another user locks the capability or one of its ancestors,
+    or with descendants=True anything below it.
+
+    The ancestors come from the cached model, or from one primary key lookup
+    when it is stale."""
+    ancestor_ids = await db_ops.get_ancestor_ids(capability_id)
+    if app_state.lock_manager.conflict(
+        capability_id, session_id, ancestor_ids or (), descendants
+    ):
+        raise HTTPException(
+            status_code=409, detail="Capability is locked by another user"
+        )
+
+
+async def reindex_locks(capability_id: int) -> None:
+    """Re-index the locks in a subtree after it moved."""
+    if app_state.lock_manager.covers(capability_id):
+        ancestor_ids = await db_ops.get_ancestor_ids(capability_id)
+        app_state.lock_manager.moved(capability_id, ancestor_ids or ())
+
+
+def moves_subtree(operation: CapabilityOperation) -> bool:
+    """Whether a transaction operation moves a capability and its subtree.
+
+    Besides move, an update that sets a new parent does.
+    """
+    return operation.op == "move" or (
+        operation.op == "update"
+        and bool(operation.model_fields_set & {"parent_id", "parent_ref"})
+    )
+
+
 @api_app.post("/capabilities/lock/{capability_id}")
 async def lock_capability(
     capability_id: int, nickname: str, db: AsyncSession = Depends(get_db)
 ):
     """Lock a capability for editing."""
     # Find user by nickname
-    user_session = next(
-        (
-            session
-            for session in app_state.active_users.values()
-            if session["nickname"] == nickname
-        ),
-        None,
-    )
+    user_session = app_state.active_users.by_nickname(nickname)
     if not user_session:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -206,31 +261,21 @@ async def lock_capability(
     if not capability:
         raise HTTPException(status_code=404, detail="Capability not found")
 
-    # Check if any ancestor capabilities are locked
-    current_parent_id = capability.parent_id
-    while current_parent_id is not None:
-        # Check if parent is locked by any user
-        for user in app_state.active_users.values():
-            if current_parent_id in user["locked_capabilities"]:
-                # Parent is locked, silently ignore the lock request
-                return {"message": "Capability is already locked by inheritance"}
-
-        # Move up to next parent
-        parent = await db_ops.get_capability(current_parent_id, db)
-        if not parent:
-            break
-        current_parent_id = parent.parent_id
-
-    # Check if capability itself is already locked
-    for user in app_state.active_users.values():
-        if capability_id in user["locked_capabilities"]:
-            raise HTTPException(status_code=409, detail="Capability is already locked")
-
-    # No ancestor locks found, proceed with locking
-    user_session["locked_capabilities"].append(capability_id)
+    # Check if any ancestor capabilities are locked (ancestors come from the
+    # materialized path, so no further queries are needed)
+    ancestor_ids = capability.ancestor_ids
+    if app_state.lock_manager.locked_ancestor(ancestor_ids) is not None:
+        # Ancestor is locked, silently ignore the lock request
+        return {"message": "Capability is already locked by inheritance"}
+
+    # Lock unless the capability itself is already locked
+    if not app_state.lock_manager.lock(
+        capability_id, user_session.session_id, ancestor_ids
+    ):
+        raise HTTPException(status_code=409, detail="Capability is already locked")
     # Broadcast lock change
     await app_state.connection_manager.broadcast_model_change(
-        user_session["nickname"], f"locked capability '{capability.name}'"
+        user_session.nickname, f"locked capability '{capability.name}'"
     )
     return {"message": "Capability locked"}
 
@@ -241,27 +286,20 @@ async def unlock_capability(
 ):
     """Unlock a capability."""
     # Find user by nickname
-    user_session = next(
-        (
-            session
-            for session in app_state.active_users.values()
-            if session["nickname"] == nickname
-        ),
-        None,
-    )
+    user_session = app_state.active_users.by_nickname(nickname)
     if not user_session:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if capability_id in user_session["locked_capabilities"]:
+    if app_state.lock_manager.owner(capability_id) == user_session.session_id:
         # Get capability name before unlocking
         capability = await db_ops.get_capability(capability_id, db)
         if not capability:
             raise HTTPException(status_code=404, detail="Capability not found")
 
-        user_session["locked_capabilities"].remove(capability_id)
+        app_state.lock_manager.unlock(capability_id)
         # Broadcast unlock change
         await app_state.connection_manager.broadcast_model_change(
-            user_session["nickname"], f"unlocked capability '{capability.name}'"
+            user_session.nickname, f"unlocked capability '{capability.name}'"
         )
         return {"message": "Capability unlocked"}
 
@@ -276,10 +314,10 @@ async def create_capability(
     if session_id not in app_state.active_users:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    result = await db_ops.create_capability(capability, db)
+    result = await db_ops.create_capability(capability)
     # Notify all clients about model change
     await app_state.connection_manager.broadcast_model_change(
-        app_state.active_users[session_id]["nickname"],
+        app_state.active_users[session_id].nickname,
         f"created capability '{result.name}'",
     )
     return {
@@ -290,6 +328,95 @@ async def create_capability(
     }
 
 
+@api_app.post("/capabilities/batch", response_model=List[dict])
+async def create_capabilities(
+    batch: CapabilityBatchCreate, session_id: str, db: AsyncSession = Depends(get_db)
+):
+    """
+    Create several capabilities under one parent in a single transaction.
+    Items may nest children; they are appended after the parent's existing
+    children in the given order. Returns the created capabilities.
+    """
+    if session_id not in app_state.active_users:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    try:
+        created = await db_ops.create_capabilities(
+            batch.parent_id, batch.capabilities
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    # Notify all clients about model change once for the whole batch
+    await app_state.connection_manager.broadcast_model_change(
+        app_state.active_users[session_id].nickname,
+        f"created {len(created)} capabilities",
+    )
+    return created
+
+
+@api_app.post("/capabilities/transaction", response_model=List[dict])
+async def apply_capability_transaction(
+    transaction: CapabilityTransaction, session_id: str
+):
+    """
+    Apply an ordered list of create, update, move and delete operations
+    atomically. Either every operation is committed or none is. Capabilities
+    created in the transaction can be referenced by later operations through
+    the ref given when creating them. Returns one result per operation.
+    """
+    if session_id not in app_state.active_users:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    # Check every targeted capability against other users' locks
+    current_user = app_state.active_users[session_id]
+    for operation in transaction.operations:
+        if operation.capability_id is None:
+            continue
+        ancestor_ids = await db_ops.get_ancestor_ids(operation.capability_id)
+        if app_state.lock_manager.conflict(
+            operation.capability_id,
+            session_id,
+            ancestor_ids or (),
+            descendants=operation.op == "delete" or moves_subtree(operation),
+        ):
+            raise HTTPException(
+                status_code=409,
+                detail=f"Capability {operation.capability_id} is locked by another user",
+            )
+
+    try:
+        results = await db_ops.apply_operations(transaction.operations)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Keep the lock index in step with moved and deleted subtrees; capabilities
+    # created in the transaction (addressed by ref) cannot hold locks yet
+    for operation in transaction.operations:
+        if operation.capability_id is None:
+            continue
+        if operation.op == "delete":
+            app_state.lock_manager.removed(operation.capability_id)
+        elif moves_subtree(operation):
+            await reindex_locks(operation.capability_id)
+
+    # Notify all clients about model change once for the whole transaction
+    await app_state.connection_manager.broadcast_model_change(
+        current_user.nickname, f"applied {len(results)} changes"
+    )
+    return results
+
+
+@api_app.get("/capabilities/search", response_model=List[dict])
+async def search_capabilities(q: str, limit: int = Query(50, ge=1, le=500)):
+    """
+    Full-text search over capability names and descriptions.
+    Every term is prefix matched; results are ranked best first and include
+    name_snippet and description_snippet with matches wrapped in <mark> tags.
+    """
+    return await db_ops.search_capabilities(q, limit)
+
+
 @api_app.get("/capabilities/{capability_id}", response_model=dict)
 async def get_capability(capability_id: int, db: AsyncSession = Depends(get_db)):
     """Get a capability by ID."""
@@ -359,23 +486,19 @@ async def update_capability(
     if session_id not in app_state.active_users:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    # Check if capability is locked by another user
-    current_user = app_state.active_users[session_id]
-    for user in app_state.active_users.values():
-        if (
-            capability_id in user["locked_capabilities"]
-            and user["nickname"] != current_user["nickname"]
-        ):
-            raise HTTPException(
-                status_code=409, detail="Capability is locked by another user"
-            )
+    # Check if capability is locked by another user; changing the parent
+    # moves the whole subtree, so locks below it count too
+    moving = "parent_id" in capability.model_fields_set
+    await check_not_locked(capability_id, session_id, descendants=moving)
 
-    result = await db_ops.update_capability(capability_id, capability, db)
+    result = await db_ops.update_capability(capability_id, capability)
     if not result:
         raise HTTPException(status_code=404, detail="Capability not found")
+    if moving:
+        await reindex_locks(capability_id)
     # Notify all clients about model change
     await app_state.connection_manager.broadcast_model_change(
-        app_state.active_users[session_id]["nickname"],
+        app_state.active_users[session_id].nickname,
         f"updated capability '{result.name}'",
     )
     return {
@@ -394,28 +517,21 @@ async def delete_capability(
     if session_id not in app_state.active_users:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    # Check if capability is locked by another user
-    current_user = app_state.active_users[session_id]
-    for user in app_state.active_users.values():
-        if (
-            capability_id in user["locked_capabilities"]
-            and user["nickname"] != current_user["nickname"]
-        ):
-            raise HTTPException(
-                status_code=409, detail="Capability is locked by another user"
-            )
+    # Check if capability or anything below it is locked by another user
+    await check_not_locked(capability_id, session_id, descendants=True)
 
     # Get capability name before deletion
     capability = await db_ops.get_capability(capability_id, db)
     if not capability:
         raise HTTPException(status_code=404, detail="Capability not found")
 
-    result = await db_ops.delete_capability(capability_id, db)
+    result = await db_ops.delete_capability(capability_id)
     if not result:
         raise HTTPException(status_code=404, detail="Capability not found")
+    app_state.lock_manager.removed(capability_id)
     # Notify all clients about model change
     await app_state.connection_manager.broadcast_model_change(
-        app_state.active_users[session_id]["nickname"],
+        app_state.active_users[session_id].nickname,
         f"deleted capability '{capability.name}'",
     )
     return {"message": "Capability deleted"}
@@ -432,30 +548,26 @@ async def move_capability(
     if session_id not in app_state.active_users:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    # Check if capability is locked by another user
-    current_user = app_state.active_users[session_id]
-    for user in app_state.active_users.values():
-        if (
-            capability_id in user["locked_capabilities"]
-            and user["nickname"] != current_user["nickname"]
-        ):
-            raise HTTPException(
-                status_code=409, detail="Capability is locked by another user"
-            )
+    # Check if capability or anything below it is locked by another user
+    await check_not_locked(capability_id, session_id, descendants=True)
 
     # Get capability name before move
     capability = await db_ops.get_capability(capability_id, db)
     if not capability:
         raise HTTPException(status_code=404, detail="Capability not found")
 
-    result = await db_ops.update_capability_order(
-        capability_id, move.new_parent_id, move.new_order
-    )
+    try:
+        result = await db_ops.update_capability_order(
+            capability_id, move.new_parent_id, move.new_order
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not result:
         raise HTTPException(status_code=404, detail="Capability not found")
+    await reindex_locks(capability_id)
     # Notify all clients about model change
     await app_state.connection_manager.broadcast_model_change(
-        app_state.active_users[session_id]["nickname"],
+        app_state.active_users[session_id].nickname,
         f"moved capability '{capability.name}'",
     )
     return {"message": "Capability moved successfully"}
@@ -473,15 +585,7 @@ async def update_description(
         raise HTTPException(status_code=404, detail="Session not found")
 
     # Check if capability is locked by another user
-    current_user = app_state.active_users[session_id]
-    for user in app_state.active_users.values():
-        if (
-            capability_id in user["locked_capabilities"]
-            and user["nickname"] != current_user["nickname"]
-        ):
-            raise HTTPException(
-                status_code=409, detail="Capability is locked by another user"
-            )
+    await check_not_locked(capability_id, session_id)
 
     result = await db_ops.save_description(capability_id, description)
     if not result:
@@ -498,39 +602,48 @@ async def update_prompt(
         raise HTTPException(status_code=404, detail="Session not found")
 
     # Check if capability is locked by another user
-    current_user = app_state.active_users[session_id]
-    for user in app_state.active_users.values():
-        if (
-            capability_id in user["locked_capabilities"]
-            and user["nickname"] != current_user["nickname"]
-        ):
-            raise HTTPException(
-                status_code=409, detail="Capability is locked by another user"
-            )
+    await check_not_locked(capability_id, session_id)
 
     # In a real implementation, this would update the prompt in a database
     # For now, we'll just return success
     return {"message": f"{prompt_update.prompt_type} prompt updated successfully"}
 
 
+@api_app.get("/changes", response_model=ChangeFeed)
+async def get_changes(
+    since: int = Query(..., ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=10000),
+):
+    """
+    Get the node-level changes made after model revision `since`.
+    Returns the current revision to pass as `since` next time. When `resync`
+    is set the changes are no longer available and the whole model should
+    be reloaded instead.
+    """
+    return await db_ops.get_changes(since, limit)
+
+
 @api_app.get("/capabilities", response_model=List[dict])
 async def get_capabilities(
     parent_id: Optional[int] = None,
     hierarchical: bool = False,
+    max_depth: Optional[int] = Query(None, ge=0),
     db: AsyncSession = Depends(get_db),
 ):
     """
     Get capabilities, optionally filtered by parent_id.
-    If hierarchical=True, returns full tree structure under the parent_id.
+    If hierarchical=True, returns full tree structure under the parent_id,
+    limited to max_depth levels below it when given.
     If hierarchical=False, returns flat list of immediate children.
+    Every capability carries its descendant_count.
     """
     if hierarchical:
         if parent_id is None:
             # Get full hierarchy starting from root
-            return await db_ops.get_all_capabilities()
+            return await db_ops.get_all_capabilities(max_depth)
         else:
             # Get hierarchy starting from specific parent
-            result = await db_ops.get_capability_with_children(parent_id)
+            result = await db_ops.get_capability_with_children(parent_id, max_depth)
             return [result] if result else []
     else:
         # Original flat list behavior
@@ -542,6 +655,7 @@ async def get_capabilities(
                 "description": cap.description,
                 "parent_id": cap.parent_id,
                 "order_position": cap.order_position,
+                "descendant_count": cap.descendant_count,
             }
             for cap in capabilities
         ]
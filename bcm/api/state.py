@@ -1,103 +1,493 @@
+import asyncio
+import json
+import os
+import uuid
 from dataclasses import dataclass, field
-from typing import Dict
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from fastapi import WebSocket
 
 
+class Session:
+    """An active user session."""
+
+    __slots__ = ("session_id", "nickname")
+
+    def __init__(self, session_id: str, nickname: str):
+        self.session_id = session_id
+        self.nickname = nickname
+
+    def __repr__(self) -> str:
+        return f"Session(session_id={self.session_id!r}, nickname={self.nickname!r})"
+
+
+class SessionRegistry:
+    """Active user sessions, indexed by session id and by nickname.
+
+    Joining, leaving and lookups by either key are O(1). Supports
+    `session_id in registry` and `registry[session_id]` like a dict.
+    """
+
+    def __init__(self):
+        self._by_id: Dict[str, Session] = {}
+        self._by_nickname: Dict[str, Session] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[Session]:
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._by_id
+
+    def __getitem__(self, session_id: str) -> Session:
+        return self._by_id[session_id]
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """Get a session by id."""
+        return self._by_id.get(session_id)
+
+    def by_nickname(self, nickname: str) -> Optional[Session]:
+        """Get the session of a nickname."""
+        return self._by_nickname.get(nickname)
+
+    def join(self, nickname: str) -> Session:
+        """Start a session for a nickname. Raises ValueError if it is taken."""
+        if nickname in self._by_nickname:
+            raise ValueError(f"Nickname '{nickname}' is already in use")
+        session = Session(str(uuid.uuid4()), nickname)
+        self._by_id[session.session_id] = session
+        self._by_nickname[nickname] = session
+        return session
+
+    def leave(self, session_id: str) -> Optional[Session]:
+        """End a session; return it, or None if it was not active."""
+        session = self._by_id.pop(session_id, None)
+        if session is not None:
+            del self._by_nickname[session.nickname]
+        return session
+
+
 @dataclass
 class AppState:
     """Centralized state management for the application."""
-    active_users: Dict[str, dict] = field(default_factory=dict)
+    active_users: SessionRegistry = field(default_factory=SessionRegistry)
     
     def __post_init__(self):
         self.connection_manager = ConnectionManager()
+        self.lock_manager = LockManager()
+
+class LockManager:
+    """Capability locks held by user sessions.
+
+    Every lock is stored with the ancestor ids of the locked capability and
+    counted under each of those ancestors, so checking a capability against
+    locks on itself, its ancestors or its descendants takes O(depth) and
+    never needs the database. Callers pass ancestor ids nearest parent first.
+    """
 
-class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}  # session_id -> websocket
-        self.session_to_user: Dict[str, str] = {}  # session_id -> nickname
+        self._owners: Dict[int, str] = {}  # capability_id -> session_id
+        self._ancestors: Dict[int, Tuple[int, ...]] = {}  # capability_id -> ancestor ids
+        self._by_owner: Dict[str, Set[int]] = {}  # session_id -> capability ids
+        self._below: Dict[int, Dict[str, int]] = {}  # capability_id -> session_id -> locks below it
+
+    def owner(self, capability_id: int) -> Optional[str]:
+        """Session holding a direct lock on the capability, if any."""
+        return self._owners.get(capability_id)
+
+    def locked_ids(self, owner: str) -> List[int]:
+        """Capabilities directly locked by a session."""
+        return sorted(self._by_owner.get(owner, ()))
+
+    def locked_ancestor(self, ancestor_ids: Iterable[int]) -> Optional[int]:
+        """Nearest of the given ancestors that is locked, if any."""
+        for ancestor_id in ancestor_ids:
+            if ancestor_id in self._owners:
+                return ancestor_id
+        return None
+
+    def covers(self, capability_id: int) -> bool:
+        """Whether the capability or anything below it is locked."""
+        return capability_id in self._owners or capability_id in self._below
+
+    def conflict(
+        self,
+        capability_id: int,
+        owner: str,
+        ancestor_ids: Iterable[int] = (),
+        descendants: bool = False,
+    ) -> Optional[str]:
+        """Session other than owner locking the capability or one of its
+        ancestors, or with descendants=True anything below it, if any."""
+        for locked_id in (capability_id, *ancestor_ids):
+            holder = self._owners.get(locked_id)
+            if holder is not None and holder != owner:
+                return holder
+        if descendants:
+            for holder in self._below.get(capability_id, ()):
+                if holder != owner:
+                    return holder
+        return None
+
+    def lock(self, capability_id: int, owner: str, ancestor_ids: Iterable[int]) -> bool:
+        """Lock a capability for a session. False if it is already locked."""
+        if capability_id in self._owners:
+            return False
+        ancestor_ids = tuple(ancestor_ids)
+        self._owners[capability_id] = owner
+        self._ancestors[capability_id] = ancestor_ids
+        self._by_owner.setdefault(owner, set()).add(capability_id)
+        self._count(ancestor_ids, owner, 1)
+        return True
+
+    def unlock(self, capability_id: int, owner: Optional[str] = None) -> bool:
+        """Release a lock, only if owner holds it when given."""
+        holder = self._owners.get(capability_id)
+        if holder is None or (owner is not None and holder != owner):
+            return False
+        del self._owners[capability_id]
+        self._count(self._ancestors.pop(capability_id), holder, -1)
+        locked = self._by_owner[holder]
+        locked.discard(capability_id)
+        if not locked:
+            del self._by_owner[holder]
+        return True
+
+    def release(self, owner: str) -> List[int]:
+        """Release every lock a session holds; return their capability ids."""
+        released = self.locked_ids(owner)
+        for capability_id in released:
+            self.unlock(capability_id)
+        return released
+
+    def clear(self) -> None:
+        """Release all locks."""
+        self._owners.clear()
+        self._ancestors.clear()
+        self._by_owner.clear()
+        self._below.clear()
+
+    def moved(self, capability_id: int, ancestor_ids: Iterable[int]) -> None:
+        """Re-index the locks in a subtree after it moved below new ancestors."""
+        if not self.covers(capability_id):
+            return
+        ancestor_ids = tuple(ancestor_ids)
+        for locked_id in self._subtree_locks(capability_id):
+            holder = self._owners[locked_id]
+            old = self._ancestors[locked_id]
+            # Keep the chain up to the moved capability, then its new ancestors
+            new = (
+                old[: old.index(capability_id) + 1] if locked_id != capability_id else ()
+            ) + ancestor_ids
+            self._count(old, holder, -1)
+            self._count(new, holder, 1)
+            self._ancestors[locked_id] = new
+
+    def removed(self, capability_id: int) -> None:
+        """Drop the locks in a deleted subtree."""
+        for locked_id in self._subtree_locks(capability_id):
+            self.unlock(locked_id)
+
+    def _subtree_locks(self, capability_id: int) -> List[int]:
+        locked = [capability_id] if capability_id in self._owners else []
+        if capability_id in self._below:
+            # Only reached when there are locks below; a scan of all locks
+            # is cheap next to the move or delete that triggered it
+            locked.extend(
+                locked_id
+                for locked_id, ancestor_ids in self._ancestors.items()
+                if capability_id in ancestor_ids
+            )
+        return locked
+
+    def _count(self, ancestor_ids: Tuple[int, ...], owner: str, delta: int) -> None:
+        for ancestor_id in ancestor_ids:
+            holders = self._below.setdefault(ancestor_id, {})
+            count = holders.get(owner, 0) + delta
+            if count:
+                holders[owner] = count
+            else:
+                del holders[owner]
+                if not holders:
+                    del self._below[ancestor_id]
+
+def get_send_queue_size() -> int:
+    """Messages buffered per WebSocket before the client counts as too slow.
+
+    Read from THEMIS_WS_QUEUE_SIZE, 256 by default.
+    """
+    return int(os.environ.get("THEMIS_WS_QUEUE_SIZE", "256"))
+
+
+def get_send_timeout() -> float:
+    """Seconds one WebSocket send may take before the client is dropped.
+
+    Read from THEMIS_WS_SEND_TIMEOUT_MS (milliseconds), 5 s by default.
+    """
+    return float(os.environ.get("THEMIS_WS_SEND_TIMEOUT_MS", "5000")) / 1000
 
-    async def connect(self, websocket: WebSocket, session_id: str, nickname: str):
+
+def get_broadcast_window() -> float:
+    """Seconds of quiet after which coalesced model changes are broadcast.
+
+    Read from THEMIS_BROADCAST_WINDOW_MS (milliseconds), 100 ms by default;
+    0 broadcasts every change on its own right away.
+    """
+    return float(os.environ.get("THEMIS_BROADCAST_WINDOW_MS", "100")) / 1000
+
+
+def get_broadcast_max_delay() -> float:
+    """Seconds a model change may wait for a burst of changes to end.
+
+    Read from THEMIS_BROADCAST_MAX_DELAY_MS (milliseconds), 500 ms by default.
+    """
+    return float(os.environ.get("THEMIS_BROADCAST_MAX_DELAY_MS", "500")) / 1000
+
+
+class Connection:
+    """A client WebSocket with its own outbound queue and writer task."""
+
+    __slots__ = ("session_id", "websocket", "queue", "task")
+
+    def __init__(self, session_id: str, websocket: WebSocket, queue_size: int):
+        self.session_id = session_id
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.task: Optional[asyncio.Task] = None
+
+
+class ConnectionManager:
+    """Fan out events to the connected clients.
+
+    Broadcasts encode a message once and put it on every client's bounded
+    queue without waiting for the network; a writer task per client sends
+    them. A client whose queue overflows, or whose send fails or exceeds the
+    send timeout, is disconnected like one that went away, and reloads the
+    model when it reconnects.
+
+    Model changes are coalesced: they are broadcast as one event once no
+    further change arrived for the broadcast window, or at the latest after
+    the maximum delay during a longer burst.
+    """
+
+    def __init__(
+        self,
+        queue_size: Optional[int] = None,
+        send_timeout: Optional[float] = None,
+        window: Optional[float] = None,
+        max_delay: Optional[float] = None,
+    ):
+        # Nicknames come from the session registry
+        self.active_connections: Dict[str, Connection] = {}  # session_id -> connection
+        self.queue_size = get_send_queue_size() if queue_size is None else queue_size
+        self.send_timeout = get_send_timeout() if send_timeout is None else send_timeout
+        self._closing: Set[asyncio.Task] = set()
+        # Source of the changes carried by model_changed events
+        self.change_feed: Optional[Callable[[int], Awaitable[dict]]] = None
+        self.revision = 0  # Revision of the last model_changed event
+        self._feed_lock = asyncio.Lock()
+        self.window = get_broadcast_window() if window is None else window
+        self.max_delay = get_broadcast_max_delay() if max_delay is None else max_delay
+        self._pending: List[dict] = []  # Model changes waiting to be broadcast
+        self._pending_since = 0.0  # When the oldest of them arrived
+        self._last_change = 0.0
+        self._flusher: Optional[asyncio.Task] = None
+
+    def set_change_feed(
+        self, change_feed: Callable[[int], Awaitable[dict]], revision: int
+    ) -> None:
+        """Attach the model's change feed, read as change_feed(since).
+
+        model_changed events then carry the changes made since the previous
+        event, from the given revision on.
+        """
+        self.change_feed = change_feed
+        self.revision = revision
+
+    async def connect(self, websocket: WebSocket, session_id: str):
         await websocket.accept()
-        self.active_connections[session_id] = websocket
-        self.session_to_user[session_id] = nickname
+        previous = self.active_connections.get(session_id)
+        if previous is not None:
+            self._close(previous)  # Replaced by the new socket
+        connection = Connection(session_id, websocket, self.queue_size)
+        connection.task = asyncio.create_task(self._write(connection))
+        self.active_connections[session_id] = connection
 
-    def disconnect(self, session_id: str) -> str | None:
-        """Disconnect a session and return the user's nickname if found"""
-        if session_id in self.active_connections:
+    def disconnect(
+        self, session_id: str, websocket: Optional[WebSocket] = None
+    ) -> str | None:
+        """Disconnect a session and return the user's nickname if found.
+
+        With websocket given, only if that socket is still the session's
+        connection, so a replaced socket closing does not end the session.
+        """
+        connection = self.active_connections.get(session_id)
+        if websocket is not None and (
+            connection is None or connection.websocket is not websocket
+        ):
+            return None
+        if connection is not None:
             del self.active_connections[session_id]
-        
-        nickname = None
-        if session_id in self.session_to_user:
-            nickname = self.session_to_user[session_id]
-            del self.session_to_user[session_id]
-            
+            self._close(connection)
+
         # Clean up user session and locks
-        if session_id in app_state.active_users:
-            if not nickname:
-                nickname = app_state.active_users[session_id]["nickname"]
-            # Clear any locks held by the user
-            if app_state.active_users[session_id]["locked_capabilities"]:
-                app_state.active_users[session_id]["locked_capabilities"] = []
-            del app_state.active_users[session_id]
-            
-        return nickname
+        session = app_state.active_users.leave(session_id)
+        if session is None:
+            return None
+        # Clear any locks held by the user
+        app_state.lock_manager.release(session_id)
+        return session.nickname
 
-    async def broadcast_model_change(self, user_nickname: str, action: str):
-        disconnected_sessions = []
-        for session_id, connection in self.active_connections.items():
+    async def _write(self, connection: Connection) -> None:
+        """Send a client's queued messages until it fails or is disconnected."""
+        websocket = connection.websocket
+        try:
+            while True:
+                text = await connection.queue.get()
+                await asyncio.wait_for(websocket.send_text(text), self.send_timeout)
+        except Exception:  # Including WebSocketDisconnect and send timeouts
+            if self.active_connections.get(connection.session_id) is connection:
+                self._drop([connection.session_id])
+
+    def _close(self, connection: Connection) -> None:
+        """Stop a connection's writer and close its socket in the background."""
+        if connection.task is not asyncio.current_task():
+            connection.task.cancel()
+
+        async def close():
+            # Fails if the client already closed the socket
             try:
-                await connection.send_json({
-                    "type": "model_changed",
-                    "user": user_nickname,
-                    "action": action
-                })
-            except Exception:  # Including WebSocketDisconnect
-                disconnected_sessions.append(session_id)
-        
-        # Clean up any disconnected sessions
-        for session_id in disconnected_sessions:
-            nickname = self.disconnect(session_id)
-            if nickname:
-                # Recursively broadcast that user left, but skip disconnected sessions
-                active_connections = dict(self.active_connections)  # Make a copy
-                for conn in active_connections.values():
-                    try:
-                        await conn.send_json({
-                            "type": "user_event",
-                            "user": nickname,
-                            "event": "left"
-                        })
-                    except Exception:  # Including WebSocketDisconnect
-                        pass
+                await asyncio.wait_for(connection.websocket.close(), self.send_timeout)
+            except Exception:
+                pass
 
-    async def broadcast_user_event(self, user_nickname: str, event_type: str):
-        disconnected_sessions = []
+        task = asyncio.create_task(close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def _publish(self, message: dict) -> List[str]:
+        """Queue a message for every client; return the ones that overflowed."""
+        text = json.dumps(message)
+        overflowed = []
         for session_id, connection in self.active_connections.items():
             try:
-                await connection.send_json({
-                    "type": "user_event",
-                    "user": user_nickname,
-                    "event": event_type
-                })
-            except Exception:  # Including WebSocketDisconnect
-                disconnected_sessions.append(session_id)
-        
-        # Clean up any disconnected sessions
-        for session_id in disconnected_sessions:
-            nickname = self.disconnect(session_id)
-            if nickname and nickname != user_nickname:  # Avoid recursive broadcast for same user
-                # Recursively broadcast that user left, but skip disconnected sessions
-                active_connections = dict(self.active_connections)  # Make a copy
-                for conn in active_connections.values():
-                    try:
-                        await conn.send_json({
-                            "type": "user_event",
-                            "user": nickname,
-                            "event": "left"
-                        })
-                    except Exception:  # Including WebSocketDisconnect
-                        pass
+                connection.queue.put_nowait(text)
+            except asyncio.QueueFull:
+                overflowed.append(session_id)
+        return overflowed
+
+    def _drop(self, session_ids: List[str], skip_user: Optional[str] = None) -> None:
+        """Disconnect clients and tell the others that their users left."""
+        while session_ids:
+            left = [self.disconnect(session_id) for session_id in session_ids]
+            session_ids = []
+            for nickname in left:
+                if nickname and nickname != skip_user:
+                    session_ids += self._publish(
+                        {"type": "user_event", "user": nickname, "event": "left"}
+                    )
+
+    async def broadcast_model_change(self, user_nickname: str, action: str):
+        """Tell every client that the model changed, within the window.
+
+        Changes inside one window are sent as one event whose `events` list
+        every user and action; `user` and `action` summarize them. With a
+        change feed attached the event also holds the changes since the
+        previous event: `since` and `revision` chain consecutive events, and
+        `changes` lists operation, capability_id and values of each change.
+        A client whose revision is not `since`, or that receives `resync`,
+        reloads the model instead of applying them.
+        """
+        event = {"user": user_nickname, "action": action}
+        if not self.window:
+            await self._send_model_change([event])
+            return
+
+        now = asyncio.get_running_loop().time()
+        if not self._pending:
+            self._pending_since = now
+        self._pending.append(event)
+        self._last_change = now
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._coalesce())
+
+    async def _coalesce(self) -> None:
+        """Broadcast pending model changes whenever a burst goes quiet."""
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            flush_at = min(
+                self._last_change + self.window, self._pending_since + self.max_delay
+            )
+            delay = flush_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue  # More changes may have arrived meanwhile
+            events, self._pending = self._pending, []
+            await self._send_model_change(events)
+
+    async def _send_model_change(self, events: List[dict]) -> None:
+        users = list(dict.fromkeys(event["user"] for event in events))
+        if len(events) == 1:
+            action = events[0]["action"]
+        else:
+            action = f"made {len(events)} changes"
+        message = {
+            "type": "model_changed",
+            "user": ", ".join(users),
+            "action": action,
+            "events": events,
+        }
+        if self.change_feed is None:
+            self._drop(self._publish(message))
+            return
+
+        # One event at a time, so that every change is sent exactly once
+        async with self._feed_lock:
+            try:
+                feed = await self.change_feed(self.revision)
+            except Exception as e:
+                print(f"Error reading change feed: {str(e)}")
+                # Without since/revision clients reload the model
+                self._drop(self._publish(message))
+                return
+            message["since"] = self.revision
+            message.update(feed)
+            self.revision = feed["revision"]
+            self._drop(self._publish(message))
+
+    async def broadcast_user_event(self, user_nickname: str, event_type: str):
+        # Avoid a second "left" broadcast for the same user
+        self._drop(
+            self._publish(
+                {"type": "user_event", "user": user_nickname, "event": event_type}
+            ),
+            skip_user=user_nickname,
+        )
+
+    async def stop(self) -> None:
+        """Send pending model changes, then stop all writer tasks.
+
+        Called on shutdown.
+        """
+        if self._flusher is not None:
+            await self._flusher
+        tasks = [connection.task for connection in self.active_connections.values()]
+        self.active_connections.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, *self._closing, return_exceptions=True)
 
 # Create a single instance of AppState to be imported by other modules
 app_state = AppState()
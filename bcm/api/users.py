@@ -1,4 +1,3 @@
-import uuid
 from typing import List
 
 from fastapi import APIRouter, HTTPException
@@ -23,21 +22,16 @@ router = APIRouter(
 )
 async def create_user_session(user: User) -> UserSession:
     """Create a new user session."""
-    # Check if nickname is already in use
-    if any(session["nickname"] == user.nickname for session in app_state.active_users.values()):
+    # Fails if the nickname is already in use
+    try:
+        session = app_state.active_users.join(user.nickname)
+    except ValueError:
         raise HTTPException(status_code=409, detail="Nickname is already in use")
     
-    session_id = str(uuid.uuid4())
-    print("User joined:", user.nickname, session_id)
-    session = {
-        "session_id": session_id,
-        "nickname": user.nickname,
-        "locked_capabilities": []
-    }
-    app_state.active_users[session_id] = session
+    print("User joined:", user.nickname, session.session_id)
     # Broadcast user joined event
     await app_state.connection_manager.broadcast_user_event(user.nickname, "joined")
-    return UserSession(**session)
+    return UserSession(session_id=session.session_id, nickname=session.nickname)
 
 @router.get(
     "",
@@ -49,7 +43,15 @@ async def create_user_session(user: User) -> UserSession:
 )
 async def get_active_users() -> List[UserSession]:
     """Get all active users and their locked capabilities."""
-    return [UserSession(**session) for session in app_state.active_users.values()]
+    locks = app_state.lock_manager
+    return [
+        UserSession(
+            session_id=session.session_id,
+            nickname=session.nickname,
+            locked_capabilities=locks.locked_ids(session.session_id),
+        )
+        for session in app_state.active_users
+    ]
 
 @router.delete(
     "/{session_id}",
@@ -69,22 +71,17 @@ async def get_active_users() -> List[UserSession]:
 )
 async def remove_user_session(session_id: str) -> dict:
     """Remove a user session and clear any locks held by the user."""
-    if session_id not in app_state.active_users:
+    # Remove the user session
+    user = app_state.active_users.leave(session_id)
+    if user is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    
-    # Get user info before removing
-    user = app_state.active_users[session_id]
-    nickname = user["nickname"]
+    nickname = user.nickname
     
     # Clear any locks held by the user
-    if user["locked_capabilities"]:
-        user["locked_capabilities"] = []
+    if app_state.lock_manager.release(session_id):
         # Broadcast that locks were cleared
         await app_state.connection_manager.broadcast_model_change(nickname, "cleared their capability locks")
     
-    # Remove the user session
-    del app_state.active_users[session_id]
-    
     # Broadcast user left event
     await app_state.connection_manager.broadcast_user_event(nickname, "left")
     
@@ -1,7 +1,8 @@
 import zipfile
 from io import BytesIO
-from typing import List
-from fastapi import APIRouter, HTTPException
+from datetime import datetime
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import Response
 
 from bcm.api.state import app_state
@@ -10,8 +11,13 @@ from bcm.database import DatabaseOperations
 from bcm.models import AuditLogEntry, Capability
 
 # Initialize database operations
-from bcm.models import AsyncSessionLocal
-db_ops = DatabaseOperations(AsyncSessionLocal)
+from bcm.models import AsyncSessionLocal, AuditSessionLocal, ReadSessionLocal
+db_ops = DatabaseOperations(
+    AsyncSessionLocal, AuditSessionLocal, read_session_factory=ReadSessionLocal
+)
+
+# Audit log entries returned per page when no limit is given
+AUDIT_LOG_PAGE_SIZE = 100
 
 # Create router
 utilities_router = APIRouter(
@@ -108,12 +114,11 @@ async def reset_database(session_id: str):
         await db_ops.clear_all_capabilities()
         
         # Clear all locks from users while preserving sessions
-        for user in app_state.active_users.values():
-            user["locked_capabilities"] = []
+        app_state.lock_manager.clear()
             
         # Broadcast the reset action
         await app_state.connection_manager.broadcast_model_change(
-            app_state.active_users[session_id]["nickname"],
+            app_state.active_users[session_id].nickname,
             "reset database and cleared all locks"
         )
         
@@ -123,13 +128,39 @@ async def reset_database(session_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @utilities_router.get("/logs", response_model=List[AuditLogEntry])
-async def get_audit_logs():
-    """Get all audit logs."""
+async def get_audit_logs(
+    response: Response,
+    limit: int = Query(AUDIT_LOG_PAGE_SIZE, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    capability_id: Optional[int] = None,
+    operation: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    descending: bool = False,
+):
+    """Get audit logs, optionally filtered, one page at a time.
+
+    Pages hold up to limit logs, AUDIT_LOG_PAGE_SIZE by default. The
+    X-Next-Cursor response header holds the cursor for the next page and is
+    absent on the last page.
+    """
     try:
-        logs = await db_ops.export_audit_logs()
-        return logs
+        logs, next_cursor = await db_ops.get_audit_logs(
+            limit=limit,
+            cursor=cursor,
+            capability_id=capability_id,
+            operation=operation,
+            start_date=start,
+            end_date=end,
+            descending=descending,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return logs
 
 @utilities_router.post("/clearlocks")
 async def clear_all_locks(session_id: str):
@@ -141,12 +172,11 @@ async def clear_all_locks(session_id: str):
     current_user = app_state.active_users[session_id]
     
     # Clear all locks from all users
-    for user in app_state.active_users.values():
-        user["locked_capabilities"] = []
+    app_state.lock_manager.clear()
     
     # Broadcast the clear locks action
     await app_state.connection_manager.broadcast_model_change(
-        current_user["nickname"],
+        current_user.nickname,
         "cleared all capability locks"
     )
     
@@ -0,0 +1,215 @@
+import asyncio
+import functools
+import json
+import os
+import weakref
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import delete, event, insert
+from sqlalchemy.orm import Session
+
+from bcm.models import AuditLog
+from bcm.writer import AFTER_COMMIT, SingleWriter
+
+# Keys in Session.info holding entries recorded by a not yet committed transaction
+_PENDING_KEY = "audit_pending"
+_WRITER_KEY = "audit_writer"
+
+
+def audit_synchronous_default() -> bool:
+    """Whether THEMIS_AUDIT_SYNC asks for audit entries to be written inline."""
+    return os.environ.get("THEMIS_AUDIT_SYNC", "").lower() in ("1", "true", "yes")
+
+
+class AuditWriter:
+    """Queue audit entries and group-commit them from a background task.
+
+    Mutations record entries on their session; once that session commits the
+    entries are queued here and written in batches by a single background
+    task, so the audit table is no longer written inside user-facing write
+    transactions. Rolled back transactions discard their entries.
+
+    When the audit log lives in the main SQLite database, batches are
+    submitted to its SingleWriter rather than written on a connection of their
+    own, which would compete with the writer for the database lock.
+
+    In synchronous mode entries are added to the caller's session instead and
+    committed together with the mutation. Tests use this for determinism; it
+    always writes to the main database.
+    """
+
+    # Maximum number of rows per INSERT batch
+    BATCH_SIZE = 500
+    # Seconds to wait after the first queued entry so bursts share a commit
+    FLUSH_DELAY = 0.05
+
+    # Marks a request to delete all existing entries, e.g. on import
+    CLEAR = object()
+
+    _instances: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+    def __init__(
+        self,
+        session_factory,
+        synchronous: bool = False,
+        writer: Optional[SingleWriter] = None,
+    ):
+        self.session_factory = session_factory
+        self.synchronous = synchronous
+        self.writer = writer
+        self._queue: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def for_session_factory(
+        cls,
+        session_factory,
+        audit_session_factory=None,
+        synchronous: Optional[bool] = None,
+    ) -> "AuditWriter":
+        """Get the writer shared by all users of a session factory.
+
+        Entries go to audit_session_factory when given, e.g. a separate SQLite
+        file, and to the main database otherwise.
+        """
+        writer = cls._instances.get(session_factory)
+        if writer is None:
+            if synchronous is None:
+                synchronous = audit_synchronous_default()
+            if synchronous or audit_session_factory is None:
+                audit_session_factory = session_factory
+            bind = session_factory.kw["bind"]
+            single_writer = None
+            if (
+                not synchronous
+                and bind.dialect.name == "sqlite"
+                and audit_session_factory.kw["bind"].url == bind.url
+            ):
+                single_writer = SingleWriter.for_session_factory(session_factory)
+            writer = cls._instances[session_factory] = cls(
+                audit_session_factory, synchronous, single_writer
+            )
+        return writer
+
+    @staticmethod
+    def entry(
+        operation: str,
+        capability_id: Optional[int] = None,
+        capability_name: Optional[str] = None,
+        old_values: Optional[dict] = None,
+        new_values: Optional[dict] = None,
+    ) -> dict:
+        """Build an audit_log row, timestamped now rather than when written."""
+        return {
+            "operation": operation,
+            "capability_id": capability_id,
+            "capability_name": capability_name,
+            "old_values": json.dumps(old_values) if old_values else None,
+            "new_values": json.dumps(new_values) if new_values else None,
+            "timestamp": datetime.utcnow(),
+        }
+
+    async def add(self, session, entry: dict) -> None:
+        """Record an entry to be written once session commits."""
+        if self.synchronous:
+            session.add(AuditLog(**entry))
+        else:
+            self._record(session, entry)
+
+    async def clear(self, session) -> None:
+        """Delete all existing entries once session commits."""
+        if self.synchronous:
+            await session.execute(delete(AuditLog))
+        else:
+            self._record(session, self.CLEAR)
+
+    def _record(self, session, entry) -> None:
+        session.info.setdefault(_PENDING_KEY, []).append(entry)
+        session.info[_WRITER_KEY] = self
+
+    def submit(self, entries) -> None:
+        """Queue committed entries and make sure the writer task is running."""
+        self._queue.extend(entries)
+        if self._task is None or self._task.done():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # Written by the next flush()
+            self._task = loop.create_task(self._run())
+
+    @property
+    def pending(self) -> int:
+        """Number of committed entries not yet written."""
+        return len(self._queue)
+
+    async def _run(self) -> None:
+        await asyncio.sleep(self.FLUSH_DELAY)
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Error writing audit log: {str(e)}")
+
+    async def flush(self) -> None:
+        """Write every queued entry, in batches of up to BATCH_SIZE rows."""
+        async with self._lock:
+            while self._queue:
+                batch = []
+                while self._queue and len(batch) < self.BATCH_SIZE:
+                    batch.append(self._queue.popleft())
+                try:
+                    await self.write(batch)
+                except Exception:
+                    # Keep the entries so the next flush retries them
+                    self._queue.extendleft(reversed(batch))
+                    raise
+
+    async def write(self, batch: list) -> None:
+        """Write a batch of entries right away, bypassing the queue."""
+        if self.writer is not None:
+            await self.writer.submit(functools.partial(self._insert, batch=batch))
+            return
+        async with self.session_factory() as session:
+            await self._insert(session, batch)
+            await session.commit()
+
+    async def _insert(self, session, batch: list) -> None:
+        rows = []
+        for entry in batch:
+            if entry is self.CLEAR:
+                if rows:
+                    await session.execute(insert(AuditLog), rows)
+                    rows = []
+                await session.execute(delete(AuditLog))
+            else:
+                rows.append(entry)
+        if rows:
+            await session.execute(insert(AuditLog), rows)
+
+    async def stop(self) -> None:
+        """Write everything still queued. Called on shutdown."""
+        if self._task is not None and not self._task.done():
+            await self._task
+        await self.flush()
+
+
+@event.listens_for(Session, "after_commit")
+def _queue_committed_entries(session):
+    entries = session.info.pop(_PENDING_KEY, None)
+    writer = session.info.pop(_WRITER_KEY, None)
+    if not entries:
+        return
+    callbacks = session.info.get(AFTER_COMMIT)
+    if callbacks is not None:
+        # Only a SAVEPOINT was released; queue once the outer commit succeeds
+        callbacks.append(functools.partial(writer.submit, entries))
+    else:
+        writer.submit(entries)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back_entries(session):
+    session.info.pop(_PENDING_KEY, None)
+    session.info.pop(_WRITER_KEY, None)
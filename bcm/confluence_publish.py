@@ -221,7 +221,8 @@ async def publish_capability_to_confluence(
     parent_page_title: Optional[str] = None,
     confluence_url: str = "https://your-domain.atlassian.net",
     current_page: int = 1,
-    total_pages: Optional[int] = None
+    total_pages: Optional[int] = None,
+    capability_data: Optional[dict] = None
 ) -> AsyncGenerator[PublishProgress, None]:
     """
     Publish a capability and its children to Confluence, yielding progress.
@@ -235,12 +236,15 @@ async def publish_capability_to_confluence(
         confluence_url: Confluence instance URL
         current_page: Current page number being processed
         total_pages: Total number of pages to be created
+        capability_data: Already loaded subtree for capability_id, used when
+            recursing so the hierarchy is only fetched once
         
     Yields:
         PublishProgress objects indicating the progress of publishing
     """
-    # Get capability data with children
-    capability_data = await db_ops.get_capability_with_children(capability_id)
+    # Get capability data with children (loaded once for the whole subtree)
+    if capability_data is None:
+        capability_data = await db_ops.get_capability_with_children(capability_id)
     if not capability_data:
         yield PublishProgress(
             total_pages=total_pages or 0,
@@ -289,7 +293,8 @@ async def publish_capability_to_confluence(
                     parent_page_title=capability_data['name'],
                     confluence_url=confluence_url,
                     current_page=next_page,
-                    total_pages=total_pages
+                    total_pages=total_pages,
+                    capability_data=child
                 ):
                     yield progress
                     next_page = progress.current_page + 1
@@ -15,7 +15,7 @@ def _format_description(description: str) -> str:
     description = description.replace('\n', '  \n')
     return description
 
-async def _process_capability(db_ops: DatabaseOperations, capability: dict, level: int = 0) -> List[str]:
+def _process_capability(capability: dict, level: int = 0) -> List[str]:
     """Process a capability and its children recursively to generate markdown lines."""
     lines = []
     
@@ -29,17 +29,9 @@ async def _process_capability(db_ops: DatabaseOperations, capability: dict, leve
         lines.extend(f"{line}\n" for line in desc_lines)
         lines.append('\n')
     
-    # Process children if present
-    children = await db_ops.get_capabilities(capability['id'])
-    if children:
-        for child in sorted(children, key=lambda x: x.order_position):
-            child_dict = {
-                'id': child.id,
-                'name': child.name,
-                'description': child.description,
-                'parent_id': child.parent_id
-            }
-            lines.extend(await _process_capability(db_ops, child_dict, level + 1))
+    # Children are already loaded and ordered by the tree loader
+    for child in capability['children']:
+        lines.extend(_process_capability(child, level + 1))
     
     return lines
 
@@ -140,24 +132,18 @@ async def export_context(db_ops: DatabaseOperations) -> List[Tuple[str, str]]:
     Returns:
         List of tuples containing (filename, content)
     """
-    # Get root capabilities (those without parent)
-    roots = await db_ops.get_capabilities(None)
+    # Load the whole model in one query
+    roots = await db_ops.get_capability_tree()
     if not roots:
         return []
     
     # Get the first root's name for the filename
-    model_name = roots[0].name
+    model_name = roots[0]['name']
     
     # Process each root capability
     lines = []
-    for root in sorted(roots, key=lambda x: x.order_position):
-        root_dict = {
-            'id': root.id,
-            'name': root.name,
-            'description': root.description,
-            'parent_id': root.parent_id
-        }
-        lines.extend(await _process_capability(db_ops, root_dict))
+    for root in roots:
+        lines.extend(_process_capability(root))
     
     # Join all lines and split into files if needed
     content = ''.join(lines)
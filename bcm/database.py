@@ -1,20 +1,85 @@
-from typing import List, Optional
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import base64
+from contextlib import asynccontextmanager
+from functools import partial
 import json
+import re
 from datetime import datetime
-from sqlalchemy import select, func, text, or_
+from sqlalchemy import (
+    String,
+    and_,
+    delete,
+    func,
+    insert,
+    literal,
+    or_,
+    select,
+    text,
+    update,
+)
 from bcm.models import (
     Capability,
+    CapabilityBatchItem,
     CapabilityCreate,
+    CapabilityOperation,
     CapabilityUpdate,
     AuditLog,
+    ChangeLog,
+    LayoutModel,
 )  # Changed from CapabilityDB
-from uuid import uuid4
+from bcm.audit import AuditWriter
+from bcm.model_cache import ModelCache, ModelSnapshot
+from bcm.snapshot import decode_snapshot, encode_snapshot
+from bcm.tree_index import NONE, TreeIndex
+from bcm.writer import AFTER_COMMIT, SingleWriter
+from uuid import uuid4, uuid5
 
 
 class DatabaseOperations:
-    def __init__(self, session_factory):
-        """Initialize with session factory instead of session."""
+    # Number of rows per executemany batch when bulk importing
+    IMPORT_BATCH_SIZE = 1000
+    # Spacing between sibling order keys, so most moves only write one row
+    ORDER_GAP = 1024
+    # Gaps narrower than this trigger a background rebalance of the siblings
+    ORDER_MIN_GAP = 4
+    # Revisions kept in the change feed; clients further behind must resync
+    CHANGE_LOG_RETENTION = 10000
+    # Most changes returned by get_changes before asking for a resync instead
+    CHANGE_FEED_LIMIT = 1000
+    # PostgreSQL advisory lock key serializing change feed writers
+    CHANGE_LOG_LOCK = 0x5448454D
+
+    def __init__(
+        self,
+        session_factory,
+        audit_session_factory=None,
+        audit_synchronous: Optional[bool] = None,
+        read_session_factory=None,
+    ):
+        """Initialize with session factory instead of session.
+
+        Audit entries are written by a background AuditWriter, into
+        audit_session_factory's database if given. audit_synchronous writes
+        them inline with each mutation instead (THEMIS_AUDIT_SYNC by default).
+        Reads use read_session_factory when given, e.g. a read-only pool.
+        """
         self.session_factory = session_factory
+        self.read_session_factory = read_session_factory or session_factory
+        # Shared by every DatabaseOperations using the same session factory
+        self.model_cache = ModelCache.for_session_factory(session_factory)
+        self.audit = AuditWriter.for_session_factory(
+            session_factory, audit_session_factory, audit_synchronous
+        )
+        # SQLite allows one writer at a time, so mutations are queued to a
+        # single connection instead of competing for the lock
+        self.writer = (
+            SingleWriter.for_session_factory(session_factory)
+            if session_factory.kw["bind"].dialect.name == "sqlite"
+            else None
+        )
+        self._background_tasks = set()
+        self._changes_since_prune = 0
 
     async def log_audit(
         self,
@@ -25,51 +90,275 @@ class DatabaseOperations:
         old_values: Optional[dict] = None,
         new_values: Optional[dict] = None,
     ):
-        """Add an audit log entry."""
-        audit = AuditLog(
-            operation=operation,
-            capability_id=capability_id,
-            capability_name=capability_name,
-            old_values=json.dumps(old_values) if old_values else None,
-            new_values=json.dumps(new_values) if new_values else None,
+        """Add an audit log entry, written once the session commits."""
+        await self.audit.add(
+            session,
+            AuditWriter.entry(
+                operation, capability_id, capability_name, old_values, new_values
+            ),
         )
-        session.add(audit)
+
+    @staticmethod
+    def _change(
+        operation: str, capability_id: Optional[int] = None, values: Optional[dict] = None
+    ) -> dict:
+        """Build a change_log row."""
+        return {
+            "operation": operation,
+            "capability_id": capability_id,
+            "values": json.dumps(values) if values is not None else None,
+            "timestamp": datetime.utcnow(),
+        }
+
+    async def _record_changes(self, session, changes: List[dict]) -> None:
+        """Add rows to the change feed, committed together with the mutation.
+
+        Revisions older than CHANGE_LOG_RETENTION are pruned now and then.
+        """
+        if not changes:
+            return
+        await self._lock_change_log(session)
+        await session.execute(insert(ChangeLog), changes)
+        self._changes_since_prune += len(changes)
+        if self._changes_since_prune >= self.CHANGE_LOG_RETENTION // 10:
+            self._changes_since_prune = 0
+            newest = select(func.max(ChangeLog.revision)).scalar_subquery()
+            await session.execute(
+                delete(ChangeLog).where(
+                    ChangeLog.revision <= newest - self.CHANGE_LOG_RETENTION
+                )
+            )
+
+    async def _record_reset(self, session) -> None:
+        """Record that the whole model was replaced; earlier changes are moot."""
+        await self._lock_change_log(session)
+        await session.execute(delete(ChangeLog))
+        await session.execute(insert(ChangeLog), [self._change("reset")])
+
+    @classmethod
+    async def _lock_change_log(cls, session) -> None:
+        """Hold the change feed lock until the session's transaction ends.
+
+        Revisions are taken from the autoincrement key on insert. Unless
+        writers commit in that order, a reader could see revision n + 1 before
+        n and skip n for good. SQLite's single writer already guarantees it;
+        on PostgreSQL an advisory lock does.
+        """
+        if session.bind.dialect.name == "postgresql":
+            await session.execute(
+                select(func.pg_advisory_xact_lock(cls.CHANGE_LOG_LOCK))
+            )
+
+    @property
+    def _ordered_change_feed(self) -> bool:
+        """Whether change feed revisions become visible in order."""
+        dialect = self.session_factory.kw["bind"].dialect.name
+        return dialect in ("sqlite", "postgresql")
 
     async def _get_session(self):
         """Get a fresh session for operations."""
         return self.session_factory()
 
+    async def _get_read_session(self):
+        """Get a fresh session for read-only queries."""
+        return self.read_session_factory()
+
+    async def _write(self, operation: Callable[..., Awaitable]):
+        """Run operation(session) as one atomic mutation and return its result.
+
+        With SQLite it runs on the single writer, otherwise in transaction().
+        """
+        if self.writer is not None:
+            return await self.writer.submit(operation)
+        async with self.transaction() as session:
+            return await operation(session)
+
+    @staticmethod
+    def _child_path(parent_path: Optional[str], capability_id: int) -> str:
+        """Materialized path of a capability given the path of its parent."""
+        return f"{parent_path or '/'}{capability_id}/"
+
+    @staticmethod
+    def _descendant_filter(path: str):
+        """Indexed range condition matching every strict descendant of path.
+
+        Descendant paths all start with path. As '/' sorts directly before '0',
+        they are exactly the values between path and path with its trailing
+        '/' replaced by '0'.
+        """
+        return and_(Capability.path > path, Capability.path < path[:-1] + "0")
+
+    @staticmethod
+    async def _add_descendants(session, ancestor_ids: List[int], delta: int) -> None:
+        """Add delta to the descendant_count of the given ancestors."""
+        if not ancestor_ids or not delta:
+            return
+        await session.execute(
+            update(Capability)
+            .where(Capability.id.in_(ancestor_ids))
+            .values(
+                descendant_count=Capability.descendant_count + delta,
+                # A count change is not an edit of the capability
+                updated_at=Capability.updated_at,
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    async def _move_subtree(
+        self, session, capability: Capability, new_parent: Optional[Capability]
+    ) -> None:
+        """Rewrite the materialized paths and depths of a capability and its
+        subtree, and move its size from the old ancestors to the new ones."""
+        old_path = capability.path
+        new_path = self._child_path(
+            new_parent.path if new_parent is not None else None, capability.id
+        )
+        new_depth = new_parent.depth + 1 if new_parent is not None else 0
+        if old_path and old_path != new_path:
+            await session.execute(
+                update(Capability)
+                .where(self._descendant_filter(old_path))
+                .values(
+                    path=literal(new_path)
+                    + func.substr(Capability.path, len(old_path) + 1),
+                    depth=Capability.depth + (new_depth - capability.depth),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            size = capability.descendant_count + 1
+            await self._add_descendants(
+                session, Capability.ancestor_ids_from_path(old_path), -size
+            )
+            await self._add_descendants(
+                session, Capability.ancestor_ids_from_path(new_path), size
+            )
+        capability.path = new_path
+        capability.depth = new_depth
+
+    def _model_changed(self) -> None:
+        """Mark the cached model snapshot stale after a committed mutation."""
+        self.model_cache.invalidate()
+
+    async def _commit(self, session) -> None:
+        """Commit a mutation, or only flush it when the caller commits later.
+
+        Sessions from transaction() and the single writer carry a list of
+        after-commit callbacks; the model is marked changed through it.
+        """
+        callbacks = session.info.get(AFTER_COMMIT)
+        if callbacks is not None:
+            await session.flush()
+            # Bulk path updates and subtree deletes bypass the identity map, so
+            # make later operations in the transaction reload what they use
+            session.expire_all()
+            if self._model_changed not in callbacks:
+                callbacks.append(self._model_changed)
+        else:
+            await session.commit()
+            self._model_changed()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Session in which mutations are committed together, or not at all.
+
+        Methods given this session flush instead of committing. The model is
+        invalidated once, and deferred rebalancing runs, after the commit.
+        """
+        async with await self._get_session() as session:
+            callbacks = session.info[AFTER_COMMIT] = []
+            try:
+                yield session
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+            finally:
+                session.info.pop(AFTER_COMMIT, None)
+        for callback in callbacks:
+            callback()
+
+    @property
+    def model_revision(self) -> int:
+        """Monotonic revision of the model, bumped by every mutation."""
+        return self.model_cache.revision
+
+    async def get_model_snapshot(self) -> ModelSnapshot:
+        """Get the in-memory snapshot of the capability tree.
+
+        The snapshot is loaded with one query and shared until the next
+        mutation, so repeated reads are served from memory.
+        """
+
+        async def load_rows():
+            async with await self._get_read_session() as session:
+                stmt = select(*self._tree_columns()).order_by(
+                    Capability.order_position, Capability.id
+                )
+                result = await session.execute(stmt)
+                return result.all()
+
+        return await self.model_cache.get(load_rows)
+
+    async def get_tree_index(self) -> TreeIndex:
+        """Get the array-backed index of the cached model snapshot."""
+        return (await self.get_model_snapshot()).tree_index
+
     async def create_capability(
         self, capability: CapabilityCreate, session=None
     ) -> Capability:
         """Create a new capability."""
         if session is None:
-            async with await self._get_session() as session:
-                return await self._create_capability_impl(capability, session)
+            return await self._write(
+                lambda session: self._create_capability_impl(capability, session)
+            )
         else:
             return await self._create_capability_impl(capability, session)
 
     async def _create_capability_impl(
         self, capability: CapabilityCreate, session
     ) -> Capability:
-        # Get max order for the parent
-        result = await session.execute(
-            select(func.max(Capability.order_position)).where(
-                Capability.parent_id == capability.parent_id
-            )
-        )
-        max_order = result.scalar() or -1
+        # Append after the last sibling, leaving a gap for later moves
+        order_position = await self._append_order_key(session, capability.parent_id)
 
         # Create new capability with next order
         db_capability = Capability(
             name=capability.name,
             description=capability.description,
             parent_id=capability.parent_id,
-            order_position=max_order + 1,
+            order_position=order_position,
         )
         session.add(db_capability)
 
-        # Add audit log
+        # Flush to get the ID needed for the materialized path
+        await session.flush()
+        parent_path = None
+        if capability.parent_id is not None:
+            result = await session.execute(
+                select(Capability.path).where(Capability.id == capability.parent_id)
+            )
+            parent_path = result.scalar()
+        db_capability.path = self._child_path(parent_path, db_capability.id)
+        ancestor_ids = Capability.ancestor_ids_from_path(db_capability.path)
+        db_capability.depth = len(ancestor_ids)
+        await self._add_descendants(session, ancestor_ids, 1)
+        await self._record_changes(
+            session,
+            [
+                self._change(
+                    "create",
+                    db_capability.id,
+                    {
+                        "name": capability.name,
+                        "description": capability.description,
+                        "parent_id": capability.parent_id,
+                        "order_position": order_position,
+                    },
+                )
+            ],
+        )
+
+        # Add audit log; the ID is known after the flush, so both entries
+        # are committed together with the capability
         await self.log_audit(
             session,
             "CREATE",
@@ -78,14 +367,9 @@ class DatabaseOperations:
                 "name": capability.name,
                 "description": capability.description,
                 "parent_id": capability.parent_id,
-                "order_position": max_order + 1,
+                "order_position": order_position,
             },
         )
-
-        await session.commit()
-        await session.refresh(db_capability)
-
-        # Update audit log with actual ID
         await self.log_audit(
             session,
             "ID_ASSIGN",
@@ -93,16 +377,143 @@ class DatabaseOperations:
             capability_name=capability.name,
             new_values={"id": db_capability.id},
         )
-        await session.commit()
+
+        await self._commit(session)
+        await session.refresh(db_capability)
 
         return db_capability
 
+    async def create_capabilities(
+        self,
+        parent_id: Optional[int],
+        items: List[CapabilityBatchItem],
+        session=None,
+    ) -> List[dict]:
+        """Create a list of capabilities, optionally nested, under one parent.
+
+        Everything is inserted in one transaction; returns the created
+        capabilities level by level.
+        """
+        if session is None:
+            return await self._write(
+                lambda session: self._create_capabilities_impl(
+                    parent_id, items, session
+                )
+            )
+        else:
+            return await self._create_capabilities_impl(parent_id, items, session)
+
+    @classmethod
+    def _batch_size(cls, items: List[CapabilityBatchItem]) -> int:
+        """Number of capabilities in a batch, nested children included."""
+        return sum(1 + cls._batch_size(item.children) for item in items)
+
+    async def _create_capabilities_impl(
+        self, parent_id: Optional[int], items: List[CapabilityBatchItem], session
+    ) -> List[dict]:
+        parent_path = None
+        if parent_id is not None:
+            result = await session.execute(
+                select(Capability.path).where(Capability.id == parent_id)
+            )
+            row = result.first()
+            if row is None:
+                raise ValueError(f"Parent capability {parent_id} not found")
+            parent_path = row.path
+
+        # New top-level items go after the existing children, the others
+        # start from an empty sibling list
+        first_key = await self._append_order_key(session, parent_id)
+        level = [
+            (item, parent_id, parent_path, first_key + position * self.ORDER_GAP)
+            for position, item in enumerate(items)
+        ]
+
+        created = []
+        try:
+            # One INSERT per nesting level, once the parent ids are known
+            while level:
+                result = await session.execute(
+                    insert(Capability).returning(
+                        Capability.id, sort_by_parameter_order=True
+                    ),
+                    [
+                        {
+                            "name": item.name,
+                            "description": item.description,
+                            "parent_id": item_parent_id,
+                            "order_position": order_position,
+                            "depth": len(Capability.ancestor_ids_from_path(item_parent_path)) + 1
+                            if item_parent_path
+                            else 0,
+                            "descendant_count": self._batch_size(item.children),
+                        }
+                        for item, item_parent_id, item_parent_path, order_position in level
+                    ],
+                )
+                ids = result.scalars().all()
+                paths = [
+                    self._child_path(item_parent_path, cap_id)
+                    for (_, _, item_parent_path, _), cap_id in zip(level, ids)
+                ]
+                await session.execute(
+                    update(Capability),
+                    [{"id": cap_id, "path": path} for cap_id, path in zip(ids, paths)],
+                )
+
+                next_level = []
+                changes = []
+                for (item, item_parent_id, _, order_position), cap_id, path in zip(
+                    level, ids, paths
+                ):
+                    created.append(
+                        {
+                            "id": cap_id,
+                            "name": item.name,
+                            "description": item.description,
+                            "parent_id": item_parent_id,
+                        }
+                    )
+                    values = {
+                        "name": item.name,
+                        "description": item.description,
+                        "parent_id": item_parent_id,
+                        "order_position": order_position,
+                    }
+                    changes.append(self._change("create", cap_id, values))
+                    await self.log_audit(
+                        session,
+                        "CREATE",
+                        capability_id=cap_id,
+                        capability_name=item.name,
+                        new_values=values,
+                    )
+                    next_level.extend(
+                        (child, cap_id, path, position * self.ORDER_GAP)
+                        for position, child in enumerate(item.children)
+                    )
+                await self._record_changes(session, changes)
+                level = next_level
+
+            if parent_id is not None:
+                await self._add_descendants(
+                    session,
+                    Capability.ancestor_ids_from_path(parent_path) + [parent_id],
+                    len(created),
+                )
+            await self._commit(session)
+            return created
+        except Exception as e:
+            print(f"Error creating capabilities: {str(e)}")
+            await session.rollback()
+            raise
+
     async def get_capability(
         self, capability_id: int, session=None
     ) -> Optional[Capability]:
         """Get a capability by ID."""
         if session is None:
-            async with await self._get_session() as session:
+            async with await self._get_read_session() as session:
                 return await self._get_capability_impl(capability_id, session)
         else:
             return await self._get_capability_impl(capability_id, session)
@@ -116,7 +527,7 @@ class DatabaseOperations:
 
     async def get_capability_by_name(self, name: str) -> Optional[Capability]:
         """Get a capability by name (case insensitive)."""
-        async with await self._get_session() as session:
+        async with await self._get_read_session() as session:
             stmt = (
                 select(Capability)
                 .where(func.lower(Capability.name) == func.lower(name))
@@ -130,7 +541,7 @@ class DatabaseOperations:
     ) -> List[Capability]:
         """Get all capabilities, optionally filtered by parent_id."""
         if session is None:
-            async with await self._get_session() as session:
+            async with await self._get_read_session() as session:
                 return await self._get_capabilities_impl(parent_id, session)
         else:
             return await self._get_capabilities_impl(parent_id, session)
@@ -142,7 +553,7 @@ class DatabaseOperations:
             stmt = (
                 select(Capability)
                 .where(Capability.parent_id == parent_id)
-                .order_by(Capability.order_position)
+                .order_by(Capability.order_position, Capability.id)
             )
             result = await session.execute(stmt)
             capabilities = result.scalars().all()
@@ -150,103 +561,251 @@ class DatabaseOperations:
         except Exception as e:
             raise e
 
-    async def get_all_capabilities(self) -> List[dict]:
-        """Get all capabilities in a hierarchical structure."""
+    @staticmethod
+    def _build_tree(rows) -> List[dict]:
+        """Build nested capability dicts from flat rows in a single pass.
+
+        Rows must be ordered by order_position so that every children list ends
+        up in display order. Nodes whose parent is not part of the rows are
+        returned as top-level nodes.
+        """
+        nodes = {}
+        for row in rows:
+            nodes[row.id] = {
+                "id": row.id,
+                "name": row.name,
+                "description": row.description,
+                "parent_id": row.parent_id,
+                "order_position": row.order_position,
+                "descendant_count": row.descendant_count,
+                "children": [],
+            }
 
-        async def build_hierarchy(parent_id: Optional[int] = None) -> List[dict]:
-            capabilities = await self.get_capabilities(parent_id)
-            result = []
-            for cap in capabilities:
-                cap_dict = {
-                    "id": cap.id,
-                    "name": cap.name,
-                    "description": cap.description,
-                    "parent_id": cap.parent_id,
-                    "order_position": cap.order_position,
-                    "children": await build_hierarchy(cap.id),
-                }
-                result.append(cap_dict)
-            return result
+        roots = []
+        for node in nodes.values():
+            parent = nodes.get(node["parent_id"])
+            if parent is None:
+                roots.append(node)
+            else:
+                parent["children"].append(node)
+        return roots
+
+    @staticmethod
+    def _tree_columns():
+        """Columns needed to build hierarchy dicts without loading ORM objects."""
+        return (
+            Capability.id,
+            Capability.name,
+            Capability.description,
+            Capability.parent_id,
+            Capability.order_position,
+            Capability.descendant_count,
+        )
 
-        return await build_hierarchy()
+    async def get_capability_tree(
+        self,
+        capability_id: Optional[int] = None,
+        max_depth: Optional[int] = None,
+        session=None,
+    ) -> List[dict]:
+        """Load a whole subtree with one query and return it as nested dicts.
+
+        With capability_id=None the full model is returned as a list of root
+        nodes; otherwise the list holds the single requested node (or is empty
+        if it does not exist). max_depth limits the levels returned below
+        them; descendant_count still tells how many nodes each one holds.
+        Without a session the tree is built from the cached model snapshot
+        if it is current, and otherwise loaded depth-limited from the database.
+        """
+        if session is None:
+            if max_depth is None or self.model_cache.current() is not None:
+                snapshot = await self.get_model_snapshot()
+                return snapshot.tree(capability_id, max_depth)
+            async with await self._get_read_session() as session:
+                return await self._get_capability_tree_impl(
+                    capability_id, max_depth, session
+                )
+        else:
+            return await self._get_capability_tree_impl(
+                capability_id, max_depth, session
+            )
+
+    async def _get_capability_tree_impl(
+        self, capability_id: Optional[int], max_depth: Optional[int], session
+    ) -> List[dict]:
+        stmt = select(*self._tree_columns())
+        if capability_id is not None:
+            result = await session.execute(
+                select(Capability.path, Capability.depth).where(
+                    Capability.id == capability_id
+                )
+            )
+            node = result.first()
+            if node is None:
+                return []
+            # The node and its descendants, down to max_depth levels below it
+            stmt = stmt.where(
+                or_(Capability.id == capability_id, self._descendant_filter(node.path))
+            )
+            if max_depth is not None:
+                stmt = stmt.where(Capability.depth <= node.depth + max_depth)
+        elif max_depth is not None:
+            stmt = stmt.where(Capability.depth <= max_depth)
+        stmt = stmt.order_by(Capability.order_position, Capability.id)
 
-    async def get_capability_with_children(self, capability_id: int) -> Optional[dict]:
+        result = await session.execute(stmt)
+        return self._build_tree(result.all())
+
+    async def get_all_capabilities(self, max_depth: Optional[int] = None) -> List[dict]:
+        """Get all capabilities in a hierarchical structure."""
+        return await self.get_capability_tree(max_depth=max_depth)
+
+    async def get_capability_with_children(
+        self, capability_id: int, max_depth: Optional[int] = None
+    ) -> Optional[dict]:
         """Get a capability and its children in a hierarchical structure."""
+        tree = await self.get_capability_tree(capability_id, max_depth)
+        return tree[0] if tree else None
+
+    async def get_layout_model(
+        self, capability_id: int, max_level: int
+    ) -> Optional[LayoutModel]:
+        """Get the layout input for a capability, max_level levels deep.
+
+        Uses the cached tree index when it is current; otherwise only the
+        shown levels are loaded from the database.
+        """
+        snapshot = self.model_cache.current()
+        if snapshot is not None:
+            tree = snapshot.tree_index
+            position = tree.position(capability_id)
+            if position == NONE:
+                return None
+            return LayoutModel.from_tree_index(tree, position, max_level)
 
-        async def build_hierarchy(parent_id: int) -> List[dict]:
-            capabilities = await self.get_capabilities(parent_id)
-            result = []
-            for cap in capabilities:
-                cap_dict = {
-                    "id": cap.id,
-                    "name": cap.name,
-                    "description": cap.description,
-                    "parent_id": cap.parent_id,
-                    "order_position": cap.order_position,
-                    "children": await build_hierarchy(cap.id),
-                }
-                result.append(cap_dict)
-            return result
+        node_data = await self.get_capability_with_children(capability_id, max_level)
+        if node_data is None:
+            return None
+        return LayoutModel.convert_to_layout_format(node_data, max_level)
 
-        async with await self._get_session() as session:
-            stmt = select(Capability).where(Capability.id == capability_id)
-            result = await session.execute(stmt)
-            capability = result.scalar_one_or_none()
-            if not capability:
+    async def get_ancestors(self, capability_id: int, session=None) -> List[Capability]:
+        """Get the ancestors of a capability, nearest parent first."""
+        if session is None:
+            async with await self._get_read_session() as session:
+                return await self._get_ancestors_impl(capability_id, session)
+        else:
+            return await self._get_ancestors_impl(capability_id, session)
+
+    async def _get_ancestors_impl(self, capability_id: int, session) -> List[Capability]:
+        # The ancestor ids are encoded in the path, so one lookup by
+        # primary key fetches the whole chain
+        path = select(Capability.path).where(Capability.id == capability_id)
+        ancestor_ids = Capability.ancestor_ids_from_path(
+            (await session.execute(path)).scalar()
+        )
+        if not ancestor_ids:
+            return []
+        stmt = select(Capability).where(Capability.id.in_(ancestor_ids))
+        result = await session.execute(stmt)
+        by_id = {cap.id: cap for cap in result.scalars().all()}
+        return [by_id[cap_id] for cap_id in ancestor_ids if cap_id in by_id]
+
+    async def get_ancestor_ids(self, capability_id: int) -> Optional[List[int]]:
+        """Get the ancestor ids of a capability, nearest parent first.
+
+        Returns None if the capability does not exist. Answered from the
+        cached model when it is current, otherwise from the path column.
+        """
+        snapshot = self.model_cache.current()
+        if snapshot is not None:
+            if capability_id not in snapshot.nodes:
                 return None
+            return snapshot.ancestors(capability_id)
+        async with await self._get_read_session() as session:
+            stmt = select(Capability.path).where(Capability.id == capability_id)
+            path = (await session.execute(stmt)).scalar()
+        return None if path is None else Capability.ancestor_ids_from_path(path)
+
+    async def get_descendant_ids(self, capability_id: int, session=None) -> List[int]:
+        """Get the ids of all descendants of a capability."""
+        if session is None:
+            async with await self._get_read_session() as session:
+                return await self._get_descendant_ids_impl(capability_id, session)
+        else:
+            return await self._get_descendant_ids_impl(capability_id, session)
 
-            return {
-                "id": capability.id,
-                "name": capability.name,
-                "description": capability.description,
-                "parent_id": capability.parent_id,
-                "order_position": capability.order_position,
-                "children": await build_hierarchy(capability.id),
-            }
+    async def _get_descendant_ids_impl(self, capability_id: int, session) -> List[int]:
+        path = (
+            select(Capability.path).where(Capability.id == capability_id).scalar_subquery()
+        )
+        stmt = select(Capability.id).where(
+            Capability.path > path,
+            Capability.path
+            < func.substr(path, 1, func.length(path) - 1, type_=String) + "0",
+        )
+        result = await session.execute(stmt)
+        return list(result.scalars().all())
+
+    async def is_ancestor(self, ancestor_id: int, capability_id: int, session=None) -> bool:
+        """Check whether ancestor_id is a strict ancestor of capability_id."""
+        if session is None:
+            async with await self._get_read_session() as session:
+                return await self._is_ancestor_impl(ancestor_id, capability_id, session)
+        else:
+            return await self._is_ancestor_impl(ancestor_id, capability_id, session)
+
+    async def _is_ancestor_impl(self, ancestor_id: int, capability_id: int, session) -> bool:
+        stmt = select(Capability.path).where(Capability.id == capability_id)
+        path = (await session.execute(stmt)).scalar()
+        return ancestor_id != capability_id and f"/{ancestor_id}/" in (path or "")
 
     async def save_description(self, capability_id: int, description: str) -> bool:
         """Save capability description and create audit log."""
-        async with await self._get_session() as session:
-            try:
-                # Get current capability within this session
-                stmt = select(Capability).where(Capability.id == capability_id)
-                result = await session.execute(stmt)
-                capability = result.scalar_one_or_none()
 
-                if not capability:
-                    return False
+        async def operation(session) -> bool:
+            # Get current capability within this session
+            stmt = select(Capability).where(Capability.id == capability_id)
+            result = await session.execute(stmt)
+            capability = result.scalar_one_or_none()
 
-                # Store old values for audit
-                old_values = {"description": capability.description}
+            if not capability:
+                return False
 
-                # Update description
-                capability.description = description
+            # Store old values for audit
+            old_values = {"description": capability.description}
 
-                # Add audit log
-                await self.log_audit(
-                    session,
-                    "UPDATE",
-                    capability_id=capability_id,
-                    capability_name=capability.name,
-                    old_values=old_values,
-                    new_values={"description": description},
-                )
+            # Update description
+            capability.description = description
 
-                await session.commit()
-                return True
-            except Exception:
-                await session.rollback()
-                raise
+            # Add audit log
+            await self.log_audit(
+                session,
+                "UPDATE",
+                capability_id=capability_id,
+                capability_name=capability.name,
+                old_values=old_values,
+                new_values={"description": description},
+            )
+            await self._record_changes(
+                session,
+                [self._change("update", capability_id, {"description": description})],
+            )
+
+            await self._commit(session)
+            return True
+
+        return await self._write(operation)
 
     async def update_capability(
         self, capability_id: int, capability: CapabilityUpdate, session=None
     ) -> Optional[Capability]:
         """Update a capability."""
         if session is None:
-            async with await self._get_session() as session:
-                return await self._update_capability_impl(
+            return await self._write(
+                lambda session: self._update_capability_impl(
                     capability_id, capability, session
                 )
+            )
         else:
             return await self._update_capability_impl(
                 capability_id, capability, session
@@ -256,10 +815,6 @@ class DatabaseOperations:
         self, capability_id: int, capability: CapabilityUpdate, session
     ) -> Optional[Capability]:
         try:
-            # Enable foreign key constraints
-            await session.execute(text("PRAGMA foreign_keys = ON"))
-            await session.commit()
-
             # Get capability within this session
             stmt = select(Capability).where(Capability.id == capability_id)
             result = await session.execute(stmt)
@@ -294,6 +849,7 @@ class DatabaseOperations:
                 db_capability.description = update_data["description"]
 
             # If updating parent_id, validate it exists
+            parent = None
             if "parent_id" in update_data:
                 new_parent_id = update_data["parent_id"]
                 if new_parent_id is not None:
@@ -313,27 +869,24 @@ class DatabaseOperations:
                         raise ValueError("Cannot set capability as its own parent")
 
                     # Check if new parent would create a circular reference through children
-                    async def is_descendant(parent_id: int, child_id: int) -> bool:
-                        if parent_id == child_id:
-                            return True
-                        stmt = select(Capability).where(
-                            Capability.parent_id == child_id
-                        )
-                        result = await session.execute(stmt)
-                        children = result.scalars().all()
-                        for child in children:
-                            if await is_descendant(parent_id, child.id):
-                                return True
-                        return False
-
-                    if await is_descendant(capability_id, new_parent_id):
+                    if parent.path and db_capability.path and parent.path.startswith(
+                        db_capability.path
+                    ):
                         raise ValueError(
                             "Cannot create circular reference in capability hierarchy"
                         )
 
+            parent_changed = (
+                "parent_id" in update_data
+                and update_data["parent_id"] != db_capability.parent_id
+            )
             for key, value in update_data.items():
                 setattr(db_capability, key, value)
 
+            # Keep the materialized paths of the moved subtree up to date
+            if parent_changed:
+                await self._move_subtree(session, db_capability, parent)
+
             # Add audit log for the update
             await self.log_audit(
                 session,
@@ -343,8 +896,16 @@ class DatabaseOperations:
                 old_values=old_values,
                 new_values=update_data,
             )
+            changed = {
+                key: update_data[key]
+                for key in ("name", "description", "parent_id")
+                if key in update_data
+            }
+            await self._record_changes(
+                session, [self._change("update", capability_id, changed)]
+            )
 
-            await session.commit()
+            await self._commit(session)
             await session.refresh(db_capability)
             return db_capability
         except Exception:
@@ -354,17 +915,14 @@ class DatabaseOperations:
     async def delete_capability(self, capability_id: int, session=None) -> bool:
         """Delete a capability and its children."""
         if session is None:
-            async with await self._get_session() as session:
-                return await self._delete_capability_impl(capability_id, session)
+            return await self._write(
+                lambda session: self._delete_capability_impl(capability_id, session)
+            )
         else:
             return await self._delete_capability_impl(capability_id, session)
 
     async def _delete_capability_impl(self, capability_id: int, session) -> bool:
         try:
-            # Enable foreign key constraints for this session
-            await session.execute(text("PRAGMA foreign_keys = ON"))
-            await session.commit()
-
             # Get the capability within this session
             stmt = select(Capability).where(Capability.id == capability_id)
             result = await session.execute(stmt)
@@ -372,6 +930,15 @@ class DatabaseOperations:
             if not capability:
                 return False
 
+            # Collect the descendants being removed for the audit entry
+            stmt = (
+                select(Capability.id, Capability.name)
+                .where(self._descendant_filter(capability.path))
+                .order_by(Capability.path)
+            )
+            result = await session.execute(stmt)
+            removed = result.all()
+
             # Log deletion with old values
             old_values = {
                 "name": capability.name,
@@ -379,6 +946,9 @@ class DatabaseOperations:
                 "parent_id": capability.parent_id,
                 "order_position": capability.order_position,
             }
+            if removed:
+                old_values["removed_descendants"] = [row.name for row in removed]
+                old_values["removed_descendant_ids"] = [row.id for row in removed]
             await self.log_audit(
                 session,
                 "DELETE",
@@ -386,392 +956,842 @@ class DatabaseOperations:
                 capability_name=capability.name,
                 old_values=old_values,
             )
+            await self._record_changes(
+                session,
+                [
+                    self._change(
+                        "delete",
+                        capability_id,
+                        {"removed_ids": [row.id for row in removed]},
+                    )
+                ],
+            )
 
-            # Get all descendants to ensure they're properly deleted
-            async def get_descendants(cap_id: int) -> List[int]:
-                stmt = select(Capability).where(Capability.parent_id == cap_id)
-                result = await session.execute(stmt)
-                children = result.scalars().all()
-                ids = [cap.id for cap in children]
-                for (
-                    child_id
-                ) in ids.copy():  # Use copy to avoid modifying list during iteration
-                    ids.extend(await get_descendants(child_id))
-                return ids
-
-            # Get all descendant IDs
-            descendant_ids = await get_descendants(capability_id)
-
-            # Delete all descendants first (bottom-up deletion)
-            for desc_id in reversed(descendant_ids):
-                stmt = select(Capability).where(Capability.id == desc_id)
-                result = await session.execute(stmt)
-                desc = result.scalar_one_or_none()
-                if desc:
-                    await session.delete(desc)
+            await self._add_descendants(
+                session, capability.ancestor_ids, -(len(removed) + 1)
+            )
 
-            # Finally delete the capability itself
-            await session.delete(capability)
-            await session.commit()
+            # Delete the capability and its whole subtree in one statement
+            await session.execute(
+                delete(Capability)
+                .where(
+                    or_(
+                        Capability.id == capability_id,
+                        self._descendant_filter(capability.path),
+                    )
+                )
+                .execution_options(synchronize_session=False)
+            )
+            session.expunge(capability)
+            await self._commit(session)
             return True
         except Exception as e:
             print(f"Error in delete_capability: {str(e)}")
             await session.rollback()
             raise
 
+    async def _append_order_key(self, session, parent_id: Optional[int]) -> int:
+        """Order key placing a new child after the current last child."""
+        result = await session.execute(
+            select(func.max(Capability.order_position)).where(
+                Capability.parent_id == parent_id
+            )
+        )
+        max_order = result.scalar()
+        return 0 if max_order is None else max_order + self.ORDER_GAP
+
+    async def _order_key_at(
+        self, session, parent_id: Optional[int], index: int, exclude_id: int
+    ) -> Tuple[int, bool]:
+        """Order key placing a node at index among the children of parent_id.
+
+        The key is taken from the gap between the neighbouring siblings, so only
+        the moved row is written. When the neighbours are adjacent the siblings
+        are renumbered first. Returns the key and whether the gap it used is
+        now small enough that the siblings should be rebalanced.
+        """
+        siblings = (
+            select(Capability.order_position)
+            .where(Capability.parent_id == parent_id, Capability.id != exclude_id)
+            .order_by(Capability.order_position, Capability.id)
+        )
+        index = max(index, 0)
+        if index == 0:
+            result = await session.execute(siblings.limit(1))
+            after = result.scalar()
+            key = 0 if after is None else after - self.ORDER_GAP
+            return key, False
+
+        result = await session.execute(siblings.offset(index - 1).limit(2))
+        neighbours = result.scalars().all()
+        if not neighbours:
+            # Index past the end: append
+            return await self._append_order_key(session, parent_id), False
+        if len(neighbours) == 1:
+            return neighbours[0] + self.ORDER_GAP, False
+
+        before, after = neighbours
+        if after - before < 2:
+            # Gap exhausted: renumber the siblings and try again
+            await self._rebalance_siblings(session, parent_id, exclude_id)
+            return await self._order_key_at(session, parent_id, index, exclude_id)
+
+        key = (before + after) // 2
+        tight = min(key - before, after - key) < self.ORDER_MIN_GAP
+        return key, tight
+
+    async def _rebalance_siblings(
+        self, session, parent_id: Optional[int], exclude_id: Optional[int] = None
+    ) -> None:
+        """Renumber the children of parent_id with ORDER_GAP spacing."""
+        result = await session.execute(
+            select(Capability.id)
+            .where(Capability.parent_id == parent_id, Capability.id != exclude_id)
+            .order_by(Capability.order_position, Capability.id)
+        )
+        rows = [
+            {"id": cap_id, "order_position": position * self.ORDER_GAP}
+            for position, cap_id in enumerate(result.scalars().all())
+        ]
+        if rows:
+            await session.execute(update(Capability), rows)
+            await self._record_changes(
+                session,
+                [
+                    self._change(
+                        "reorder",
+                        values={
+                            "parent_id": parent_id,
+                            "order_positions": [
+                                [row["id"], row["order_position"]] for row in rows
+                            ],
+                        },
+                    )
+                ],
+            )
+
+    async def rebalance_children(self, parent_id: Optional[int]) -> None:
+        """Restore evenly spaced order keys for the children of parent_id."""
+
+        async def operation(session) -> None:
+            await self._rebalance_siblings(session, parent_id)
+            await self._commit(session)
+
+        try:
+            await self._write(operation)
+        except Exception as e:
+            print(f"Error rebalancing children of {parent_id}: {e}")
+
+    def _schedule_rebalance(self, parent_id: Optional[int], session=None) -> None:
+        """Rebalance the children of parent_id in a background task.
+
+        Inside transaction() or the writer this waits until the enclosing
+        transaction has committed.
+        """
+        callbacks = session.info.get(AFTER_COMMIT) if session is not None else None
+        if callbacks is not None:
+            callbacks.append(partial(self._schedule_rebalance, parent_id))
+            return
+        task = asyncio.create_task(self.rebalance_children(parent_id))
+        # Keep a reference so the task is not garbage collected while running
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def drain_background_tasks(self) -> None:
+        """Wait for pending background maintenance (e.g. rebalancing) to finish."""
+        while self._background_tasks:
+            await asyncio.gather(*self._background_tasks)
+
     async def update_capability_order(
-        self, capability_id: int, new_parent_id: Optional[int], new_order: int
+        self,
+        capability_id: int,
+        new_parent_id: Optional[int],
+        new_order: int,
+        session=None,
     ) -> Optional[Capability]:
         """Update a capability's parent and order."""
-        async with await self._get_session() as session:
-            try:
-                # Enable foreign key constraints
-                await session.execute(text("PRAGMA foreign_keys = ON"))
-                await session.commit()
+        if session is None:
+            return await self._write(
+                lambda session: self._update_capability_order_impl(
+                    capability_id, new_parent_id, new_order, session
+                )
+            )
+        else:
+            return await self._update_capability_order_impl(
+                capability_id, new_parent_id, new_order, session
+            )
 
-                # Get capability
-                stmt = select(Capability).where(Capability.id == capability_id)
-                result = await session.execute(stmt)
-                db_capability = result.scalar_one_or_none()
-                if not db_capability:
-                    return None
-
-                # Store old values for audit
-                old_values = {
-                    "parent_id": db_capability.parent_id,
-                    "order_position": db_capability.order_position,
-                }
+    async def _update_capability_order_impl(
+        self,
+        capability_id: int,
+        new_parent_id: Optional[int],
+        new_order: int,
+        session,
+    ) -> Optional[Capability]:
+        try:
+            # Get capability
+            stmt = select(Capability).where(Capability.id == capability_id)
+            result = await session.execute(stmt)
+            db_capability = result.scalar_one_or_none()
+            if not db_capability:
+                return None
 
-                # Add old parent name if it exists
-                if db_capability.parent_id:
-                    parent_stmt = select(Capability).where(
-                        Capability.id == db_capability.parent_id
-                    )
-                    parent_result = await session.execute(parent_stmt)
-                    old_parent = parent_result.scalar_one_or_none()
-                    if old_parent:
-                        old_values["parent_name"] = old_parent.name
-
-                # Get new parent name if applicable
-                new_values = {"parent_id": new_parent_id, "order_position": new_order}
-                if new_parent_id:
-                    parent_stmt = select(Capability).where(
-                        Capability.id == new_parent_id
-                    )
-                    parent_result = await session.execute(parent_stmt)
-                    new_parent = parent_result.scalar_one_or_none()
-                    if new_parent:
-                        new_values["parent_name"] = new_parent.name
-
-                # Update order of other capabilities
-                if db_capability.parent_id == new_parent_id:
-                    # Moving within same parent
-                    if new_order > db_capability.order_position:
-                        stmt = select(Capability).where(
-                            Capability.parent_id == new_parent_id,
-                            Capability.order_position <= new_order,
-                            Capability.order_position > db_capability.order_position,
-                            Capability.id != capability_id,
-                        )
-                        result = await session.execute(stmt)
-                        capabilities = result.scalars().all()
-                        for cap in capabilities:
-                            cap.order_position -= 1
-                    else:
-                        stmt = select(Capability).where(
-                            Capability.parent_id == new_parent_id,
-                            Capability.order_position >= new_order,
-                            Capability.order_position < db_capability.order_position,
-                            Capability.id != capability_id,
+            # Store old values for audit
+            old_values = {
+                "parent_id": db_capability.parent_id,
+                "order_position": db_capability.order_position,
+            }
+
+            # Add old parent name if it exists
+            if db_capability.parent_id:
+                parent_stmt = select(Capability).where(
+                    Capability.id == db_capability.parent_id
+                )
+                parent_result = await session.execute(parent_stmt)
+                old_parent = parent_result.scalar_one_or_none()
+                if old_parent:
+                    old_values["parent_name"] = old_parent.name
+
+            # Get new parent name if applicable
+            new_values = {"parent_id": new_parent_id, "order_position": new_order}
+            new_parent = None
+            if new_parent_id:
+                parent_stmt = select(Capability).where(
+                    Capability.id == new_parent_id
+                )
+                parent_result = await session.execute(parent_stmt)
+                new_parent = parent_result.scalar_one_or_none()
+                if new_parent:
+                    new_values["parent_name"] = new_parent.name
+
+                    # Moving below its own subtree would create a cycle
+                    if new_parent.path and db_capability.path and new_parent.path.startswith(
+                        db_capability.path
+                    ):
+                        raise ValueError(
+                            "Cannot create circular reference in capability hierarchy"
                         )
-                        result = await session.execute(stmt)
-                        capabilities = result.scalars().all()
-                        for cap in capabilities:
-                            cap.order_position += 1
-                else:
-                    # Moving to new parent
-                    # Decrease order of capabilities in old parent
-                    stmt = select(Capability).where(
-                        Capability.parent_id == db_capability.parent_id,
-                        Capability.order_position > db_capability.order_position,
-                    )
-                    result = await session.execute(stmt)
-                    capabilities = result.scalars().all()
-                    for cap in capabilities:
-                        cap.order_position -= 1
-
-                    # Increase order of capabilities in new parent
-                    stmt = select(Capability).where(
-                        Capability.parent_id == new_parent_id,
-                        Capability.order_position >= new_order,
+
+            # Pick a key in the gap at the target index; siblings are not touched
+            order_position, tight = await self._order_key_at(
+                session, new_parent_id, new_order, capability_id
+            )
+
+            # Update the capability's parent and position
+            if db_capability.parent_id != new_parent_id:
+                await self._move_subtree(session, db_capability, new_parent)
+            db_capability.parent_id = new_parent_id
+            db_capability.order_position = order_position
+
+            # Add audit log for the move operation
+            await self.log_audit(
+                session,
+                "MOVE",
+                capability_id=capability_id,
+                capability_name=db_capability.name,
+                old_values=old_values,
+                new_values=new_values,
+            )
+            await self._record_changes(
+                session,
+                [
+                    self._change(
+                        "move",
+                        capability_id,
+                        {"parent_id": new_parent_id, "order_position": order_position},
                     )
-                    result = await session.execute(stmt)
-                    capabilities = result.scalars().all()
-                    for cap in capabilities:
-                        cap.order_position += 1
+                ],
+            )
+
+            await self._commit(session)
+            if tight:
+                self._schedule_rebalance(new_parent_id, session)
+            await session.refresh(db_capability)
+            return db_capability
 
-                # Update the capability's parent and position
-                db_capability.parent_id = new_parent_id
-                db_capability.order_position = new_order
+        except Exception as e:
+            await session.rollback()
+            raise e
 
-                # Add audit log for the move operation
-                await self.log_audit(
+    async def apply_operations(
+        self, operations: List[CapabilityOperation]
+    ) -> List[dict]:
+        """Apply create, update, move and delete operations in one transaction.
+
+        Operations run in order through the regular methods; if any of them
+        fails nothing is committed. Returns the id and name each operation
+        applied to.
+        """
+        return await self._write(
+            lambda session: self._apply_operations_impl(operations, session)
+        )
+
+    async def _apply_operations_impl(
+        self, operations: List[CapabilityOperation], session
+    ) -> List[dict]:
+        refs = {}
+
+        def resolve(capability_id: Optional[int], ref: Optional[str]) -> Optional[int]:
+            if ref is None:
+                return capability_id
+            if ref not in refs:
+                raise ValueError(f"Unknown capability reference '{ref}'")
+            return refs[ref]
+
+        results = []
+        for index, operation in enumerate(operations):
+            fields = operation.model_fields_set
+            parent_id = resolve(operation.parent_id, operation.parent_ref)
+
+            if operation.op == "create":
+                if not operation.name:
+                    raise ValueError(f"Operation {index}: create needs a name")
+                capability = await self.create_capability(
+                    CapabilityCreate(
+                        name=operation.name,
+                        description=operation.description,
+                        parent_id=parent_id,
+                    ),
                     session,
-                    "MOVE",
-                    capability_id=capability_id,
-                    capability_name=db_capability.name,
-                    old_values=old_values,
-                    new_values=new_values,
                 )
+                if operation.ref is not None:
+                    refs[operation.ref] = capability.id
+                results.append(
+                    {"op": "create", "id": capability.id, "name": capability.name}
+                )
+                continue
 
-                await session.commit()
-                await session.refresh(db_capability)
-                return db_capability
+            capability_id = resolve(operation.capability_id, operation.ref)
+            if capability_id is None:
+                raise ValueError(
+                    f"Operation {index}: {operation.op} needs a capability_id or ref"
+                )
 
-            except Exception as e:
-                await session.rollback()
-                raise e
+            if operation.op == "update":
+                values = {
+                    key: getattr(operation, key)
+                    for key in ("name", "description")
+                    if key in fields
+                }
+                if fields & {"parent_id", "parent_ref"}:
+                    values["parent_id"] = parent_id
+                capability = await self.update_capability(
+                    capability_id, CapabilityUpdate(**values), session
+                )
+            elif operation.op == "move":
+                capability = await self.update_capability_order(
+                    capability_id, parent_id, operation.new_order, session
+                )
+            else:
+                capability = await self.get_capability(capability_id, session)
+                if capability is not None:
+                    await self.delete_capability(capability_id, session)
+
+            if capability is None:
+                raise ValueError(
+                    f"Operation {index}: capability {capability_id} not found"
+                )
+            results.append(
+                {"op": operation.op, "id": capability_id, "name": capability.name}
+            )
+        return results
 
     async def export_capabilities(self) -> List[dict]:
         """Export all capabilities in the external format."""
-        async with await self._get_session() as session:
-            # Enable foreign key constraints
-            await session.execute(text("PRAGMA foreign_keys = ON"))
-            await session.commit()
-
-            # Get all capabilities
-            stmt = select(Capability).order_by(Capability.order_position)
-            result = await session.execute(stmt)
-            capabilities = result.scalars().all()
-
-            # Create a mapping of capabilities by ID for easy lookup
-            cap_by_id = {cap.id: cap for cap in capabilities}
-            
-            # Create mapping of DB IDs to new UUIDs
-            id_mapping = {}
-
-            # Helper function to validate ancestor chain
-            def has_valid_ancestors(cap_id: int, visited: set) -> bool:
-                if cap_id in visited:
-                    return False  # Circular reference
-                
-                cap = cap_by_id.get(cap_id)
-                if not cap:
-                    return False
-                
-                if cap.parent_id is None:
-                    return True  # Root capability
-                
-                visited.add(cap_id)
-                return has_valid_ancestors(cap.parent_id, visited)
-
-            # First pass: Map IDs for all capabilities with valid ancestor chains
-            for cap in capabilities:
-                if has_valid_ancestors(cap.id, set()):
-                    id_mapping[cap.id] = str(uuid4())
-
-            # Second pass: Create export data maintaining parent relationships
-            export_data = []
-            for cap in capabilities:
-                if cap.id in id_mapping:
-                    export_data.append(
-                        {
-                            "id": id_mapping[cap.id],
-                            "name": cap.name,
-                            "capability": 0,
-                            "description": cap.description or "",
-                            "parent": id_mapping[cap.parent_id] if cap.parent_id in id_mapping else None,
-                        }
-                    )
-
-            return export_data
-
-    async def search_capabilities(self, query: str) -> List[Capability]:
-        """Search capabilities by name or description."""
-        async with await self._get_session() as session:
-            search_term = f"%{query}%"
-            stmt = select(Capability).where(
+        # Walks the cached tree index in pre-order, so parents precede their
+        # children. Capabilities not reachable from a root (broken or circular
+        # parent chains) are not part of the index and are left out.
+        index = await self.get_tree_index()
+        external_ids = [str(uuid4()) for _ in range(len(index))]
+        return [
+            {
+                "id": external_ids[pos],
+                "name": index.names[pos],
+                "capability": 0,
+                "description": index.descriptions[pos] or "",
+                "parent": external_ids[index.parent[pos]]
+                if index.parent[pos] != NONE
+                else None,
+            }
+            for pos in range(len(index))
+        ]
+
+    async def stream_export_capabilities(self) -> AsyncIterator[dict]:
+        """Yield all capabilities in the external format, one at a time.
+
+        Capabilities come in pre-order, like the JSON export, so every parent
+        is yielded before its children and siblings keep their order. Only the
+        ids of the tree are held in memory; full rows are read in batches, and
+        external ids are derived from database ids with a per-export UUID
+        namespace.
+        """
+        namespace = uuid4()
+
+        def external_id(cap_id: int) -> str:
+            return str(uuid5(namespace, str(cap_id)))
+
+        async with await self._get_read_session() as session:
+            result = await session.execute(
+                select(Capability.id, Capability.parent_id).order_by(
+                    Capability.order_position, Capability.id
+                )
+            )
+            children: Dict[Optional[int], List[int]] = {}
+            for cap_id, parent_id in result:
+                children.setdefault(parent_id, []).append(cap_id)
+
+            order = []
+            stack = list(reversed(children.get(None, [])))
+            while stack:
+                cap_id = stack.pop()
+                order.append(cap_id)
+                stack.extend(reversed(children.get(cap_id, [])))
+
+            for start in range(0, len(order), self.IMPORT_BATCH_SIZE):
+                batch = order[start : start + self.IMPORT_BATCH_SIZE]
+                result = await session.execute(
+                    select(
+                        Capability.id,
+                        Capability.name,
+                        Capability.description,
+                        Capability.parent_id,
+                    ).where(Capability.id.in_(batch))
+                )
+                rows = {row.id: row for row in result}
+                for cap_id in batch:
+                    row = rows.get(cap_id)
+                    if row is None:
+                        continue  # Deleted meanwhile
+                    yield {
+                        "id": external_id(row.id),
+                        "name": row.name,
+                        "capability": 0,
+                        "description": row.description or "",
+                        "parent": external_id(row.parent_id)
+                        if row.parent_id is not None
+                        else None,
+                    }
+
+    @staticmethod
+    def _fts_query(query: str) -> str:
+        """Build an FTS5 MATCH expression with prefix matching on every term.
+
+        Terms are quoted so that FTS5 operators in user input are taken literally.
+        """
+        return " ".join(f'"{term}"*' for term in re.findall(r"\w+", query))
+
+    async def search_capabilities(self, query: str, limit: int = 50) -> List[dict]:
+        """Search capabilities by name or description.
+
+        Results are ranked best first and carry highlighted snippets of the
+        matching name and description. Every search term is prefix matched.
+        """
+        match = self._fts_query(query)
+        if not match:
+            return []
+
+        async with await self._get_read_session() as session:
+            if session.bind.dialect.name != "sqlite":
+                return await self._search_capabilities_like(session, query, limit)
+
+            # bm25 weights name matches ten times higher than description matches
+            stmt = text(
+                """
+                SELECT c.id, c.name, c.description, c.parent_id,
+                       snippet(capabilities_fts, 0, '<mark>', '</mark>', '…', 10)
+                           AS name_snippet,
+                       snippet(capabilities_fts, 1, '<mark>', '</mark>', '…', 16)
+                           AS description_snippet,
+                       bm25(capabilities_fts, 10.0, 1.0) AS rank
+                FROM capabilities_fts
+                JOIN capabilities AS c ON c.id = capabilities_fts.rowid
+                WHERE capabilities_fts MATCH :match
+                ORDER BY rank
+                LIMIT :limit
+                """
+            )
+            result = await session.execute(stmt, {"match": match, "limit": limit})
+            return [dict(row._mapping) for row in result.all()]
+
+    async def _search_capabilities_like(self, session, query: str, limit: int) -> List[dict]:
+        """Unranked substring search for databases without FTS5."""
+        search_term = f"%{query}%"
+        stmt = (
+            select(*self._tree_columns())
+            .where(
                 or_(
                     Capability.name.ilike(search_term),
                     Capability.description.ilike(search_term),
                 )
             )
-            result = await session.execute(stmt)
-            return result.scalars().all()
+            .limit(limit)
+        )
+        result = await session.execute(stmt)
+        return [
+            {
+                "id": row.id,
+                "name": row.name,
+                "description": row.description,
+                "parent_id": row.parent_id,
+                "name_snippet": row.name,
+                "description_snippet": row.description,
+                "rank": 0.0,
+            }
+            for row in result.all()
+        ]
 
     async def clear_all_capabilities(self) -> None:
         """Clear all capabilities from the database."""
-        async with await self._get_session() as session:
-            try:
-                # Enable foreign key constraints
-                await session.execute(text("PRAGMA foreign_keys = ON"))
-                await session.commit()
 
-                # Get all root capabilities
-                stmt = select(Capability).where(Capability.parent_id.is_(None))
-                result = await session.execute(stmt)
-                root_capabilities = result.scalars().all()
+        async def operation(session) -> None:
+            # Delete every capability in one statement
+            await session.execute(delete(Capability))
+            await self._record_reset(session)
+            await self._commit(session)
 
-                # Delete each root capability (which will cascade to children)
-                for root in root_capabilities:
-                    await session.delete(root)
+        try:
+            await self._write(operation)
+        except Exception as e:
+            print(f"Error clearing capabilities: {e}")
+            raise
 
-                await session.commit()
-            except Exception as e:
-                print(f"Error clearing capabilities: {e}")
-                await session.rollback()
-                raise
+    def _plan_import(self, data: List[dict], first_id: int = 1) -> List[dict]:
+        """Turn external items into capability rows ready for a bulk insert.
+
+        Database ids are assigned up front in topological (pre-order) order so
+        every parent precedes its children, which lets parent_id and path be
+        filled in directly. Siblings keep their order from the input.
+        """
+        children = {}
+        for item in data:
+            name = item.get("name")
+            if not isinstance(name, str) or not 1 <= len(name) <= 255:
+                raise ValueError(f"Invalid name for capability {item.get('id')}")
+            children.setdefault(item.get("parent") or None, []).append(item)
+
+        known_ids = {item["id"] for item in data}
+        for parent_ext_id, items in children.items():
+            if parent_ext_id is not None and parent_ext_id not in known_ids:
+                raise ValueError(
+                    f"Invalid parent reference for capability {items[0]['name']}"
+                )
+
+        rows = []
+        next_id = first_id
+        # Stack of (item, parent db id, parent path, position among siblings, depth)
+        stack = [
+            (item, None, None, position, 0)
+            for position, item in reversed(list(enumerate(children.get(None, []))))
+        ]
+        while stack:
+            item, parent_id, parent_path, position, depth = stack.pop()
+            cap_id = next_id
+            next_id += 1
+            path = self._child_path(parent_path, cap_id)
+            rows.append(
+                {
+                    "id": cap_id,
+                    "name": item["name"],
+                    "description": item.get("description", ""),
+                    "parent_id": parent_id,
+                    "order_position": position * self.ORDER_GAP,
+                    "path": path,
+                    "depth": depth,
+                    "descendant_count": 0,
+                }
+            )
+            stack.extend(
+                (child, cap_id, path, child_position, depth + 1)
+                for child_position, child in reversed(
+                    list(enumerate(children.get(item["id"], [])))
+                )
+            )
+
+        if len(rows) != len(data):
+            # Items that are never reached from a root form a parent cycle
+            raise ValueError("Circular parent references in imported capabilities")
+
+        # Rows are in pre-order with consecutive ids, so walking them backwards
+        # sees every subtree complete before its parent
+        for row in reversed(rows):
+            if row["parent_id"] is not None:
+                parent = rows[row["parent_id"] - first_id]
+                parent["descendant_count"] += row["descendant_count"] + 1
+        return rows
 
     async def import_capabilities(self, data: List[dict]) -> None:
-        """Import capabilities from external format."""
+        """Import capabilities from external format.
+
+        Replaces the whole model in one transaction using batched bulk inserts.
+        """
         if not data:
             print("No data received for import")
             return
 
-        async with await self._get_session() as session:
-            try:
-                # Enable foreign key constraints
-                await session.execute(text("PRAGMA foreign_keys = ON"))
+        rows = self._plan_import(data)
 
-                # Clear existing audit logs
-                await session.execute(text("DELETE FROM audit_log"))
+        async def operation(session) -> None:
+            # Clear existing audit logs
+            await self.audit.clear(session)
 
-                # Clear existing capabilities within the same transaction
-                stmt = select(Capability).where(Capability.parent_id.is_(None))
-                result = await session.execute(stmt)
-                root_capabilities = result.scalars().all()
-                for root in root_capabilities:
-                    await session.delete(root)
-                await session.flush()
-
-                # Create mapping of external IDs to new database IDs
-                id_mapping = {}
-                parent_updates = []
-
-                # First pass: Create all capabilities and store parent updates
-                for item in data:
-                    try:
-                        cap = CapabilityCreate(
-                            name=item["name"],
-                            description=item.get("description", ""),
-                            parent_id=None,  # Initially create without parent
-                        )
-                        db_capability = Capability(
-                            name=cap.name,
-                            description=cap.description,
-                            parent_id=None,
-                            order_position=0,  # Reset order position
-                        )
-                        session.add(db_capability)
-                        await session.flush()  # Flush to get the ID
-
-                        # Store in mapping
-                        id_mapping[item["id"]] = db_capability.id
-
-                        # Store parent update if needed
-                        if item.get("parent"):
-                            parent_updates.append((db_capability, item["parent"]))
-
-                    except Exception as e:
-                        print(f"Error creating capability {item.get('name')}: {e}")
-                        await session.rollback()
-                        raise
-
-                # Second pass: Update parent relationships
-                for capability, parent_ext_id in parent_updates:
-                    parent_id = id_mapping.get(parent_ext_id)
-                    if parent_id is None:
-                        await session.rollback()
-                        raise ValueError(
-                            f"Invalid parent reference for capability {capability.name}"
-                        )
-                    capability.parent_id = parent_id
+            # Clear existing capabilities within the same transaction
+            await session.execute(delete(Capability))
 
-                # Add a single audit log entry for the import
-                await self.log_audit(
-                    session,
-                    "IMPORT",
-                    capability_name="SYSTEM",
-                    new_values={"message": f"Imported {len(data)} capabilities"},
+            # Insert in large executemany batches
+            for start in range(0, len(rows), self.IMPORT_BATCH_SIZE):
+                await session.execute(
+                    insert(Capability), rows[start : start + self.IMPORT_BATCH_SIZE]
                 )
 
-                # Commit all changes in one transaction
-                await session.commit()
+            # Explicit ids bypass the PostgreSQL id sequence; move it past them
+            if session.bind.dialect.name == "postgresql":
+                await session.execute(
+                    text(
+                        "SELECT setval(pg_get_serial_sequence('capabilities', 'id'), "
+                        "(SELECT MAX(id) FROM capabilities))"
+                    )
+                )
 
-            except Exception as e:
-                print(f"Error during import: {str(e)}")
-                await session.rollback()
-                raise
+            # Add a single audit log entry for the import
+            await self.log_audit(
+                session,
+                "IMPORT",
+                capability_name="SYSTEM",
+                new_values={"message": f"Imported {len(data)} capabilities"},
+            )
+            await self._record_reset(session)
+
+            # Commit all changes in one transaction
+            await self._commit(session)
+
+        try:
+            await self._write(operation)
+        except Exception as e:
+            print(f"Error during import: {str(e)}")
+            raise
+
+    async def export_snapshot(self, codec: str = "zlib") -> bytes:
+        """Export the model as a compact binary snapshot (see bcm.snapshot)."""
+        snapshot = await self.get_model_snapshot()
+        return encode_snapshot(snapshot.nodes.values(), codec)
+
+    async def import_snapshot(self, data: bytes) -> None:
+        """Replace the model with the contents of a binary snapshot.
+
+        Goes through import_capabilities, so ids are reassigned the same way.
+        """
+        await self.import_capabilities(
+            [
+                {
+                    "id": row.id,
+                    "name": row.name,
+                    "description": row.description,
+                    "parent": row.parent_id,
+                }
+                for row in decode_snapshot(data)
+            ]
+        )
 
     async def get_markdown_hierarchy(self) -> str:
         """Generate a markdown representation of the capability hierarchy."""
+        index = await self.get_tree_index()
+        return "\n".join(
+            f"{'  ' * index.depth[pos]}- {index.names[pos]}" for pos in range(len(index))
+        )
 
-        async def build_hierarchy(
-            parent_id: Optional[int] = None, level: int = 0
-        ) -> str:
-            capabilities = await self.get_capabilities(parent_id)
-            result = []
-            for cap in capabilities:
-                indent = "  " * level
-                result.append(f"{indent}- {cap.name}")
-                child_hierarchy = await build_hierarchy(cap.id, level + 1)
-                if child_hierarchy:
-                    result.append(child_hierarchy)
-            return "\n".join(result)
-
-        return await build_hierarchy()
+    @staticmethod
+    def _audit_entry(row) -> dict:
+        """Turn an audit_log row into its readable form, decoding the JSON."""
+        old_values = json.loads(row.old_values) if row.old_values else None
+        new_values = json.loads(row.new_values) if row.new_values else None
+
+        # Remove order_position from values if present
+        if old_values and "order_position" in old_values:
+            del old_values["order_position"]
+        if new_values and "order_position" in new_values:
+            del new_values["order_position"]
+
+        return {
+            "timestamp": row.timestamp.isoformat(),
+            "operation": row.operation,
+            "capability_id": row.capability_id,
+            "capability_name": row.capability_name,
+            "old_values": old_values,
+            "new_values": new_values,
+        }
+
+    @staticmethod
+    def _encode_audit_cursor(row) -> str:
+        """Opaque cursor for the position right after row."""
+        position = json.dumps([row.timestamp.isoformat(), row.id])
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    @staticmethod
+    def _decode_audit_cursor(cursor: str) -> Tuple[datetime, int]:
+        try:
+            timestamp, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.fromisoformat(timestamp), int(log_id)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid audit log cursor: {cursor}") from e
+
+    async def get_revision(self) -> int:
+        """Get the current model revision of the change feed."""
+        async with await self._get_read_session() as session:
+            result = await session.execute(select(func.max(ChangeLog.revision)))
+            return result.scalar() or 0
+
+    async def get_changes(self, since: int, limit: Optional[int] = None) -> dict:
+        """Get the node-level changes made after revision since.
+
+        Returns the current revision and the changes in order. resync is set
+        instead when the feed cannot bring the caller up to date: the changes
+        were pruned, the model was replaced, there are more than limit of
+        them, or since is ahead of the database. Applying a change twice has
+        no further effect, so a model loaded after reading the revision can
+        be brought up to date from it. On databases other than SQLite and
+        PostgreSQL revisions may commit out of order, so resync is always set.
+        """
+        limit = limit or self.CHANGE_FEED_LIMIT
+        if not self._ordered_change_feed:
+            revision = await self.get_revision()
+            return {"revision": revision, "resync": True, "changes": []}
+        async with await self._get_read_session() as session:
+            result = await session.execute(
+                select(func.min(ChangeLog.revision), func.max(ChangeLog.revision))
+            )
+            oldest, newest = result.one()
+            feed = {"revision": newest or 0, "resync": False, "changes": []}
+            if since == feed["revision"]:
+                return feed
+            if since > feed["revision"] or since < oldest - 1:
+                feed["resync"] = True
+                return feed
+
+            result = await session.execute(
+                select(ChangeLog)
+                .where(ChangeLog.revision > since)
+                .order_by(ChangeLog.revision)
+                .limit(limit + 1)
+            )
+            rows = result.scalars().all()
+
+        if len(rows) > limit or any(row.operation == "reset" for row in rows):
+            feed["resync"] = True
+            return feed
+        feed["revision"] = rows[-1].revision
+        feed["changes"] = [
+            {
+                "revision": row.revision,
+                "operation": row.operation,
+                "capability_id": row.capability_id,
+                "values": json.loads(row.values) if row.values else None,
+            }
+            for row in rows
+        ]
+        return feed
+
+    async def get_audit_logs(
+        self,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        capability_id: Optional[int] = None,
+        operation: Optional[str] = None,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        descending: bool = False,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """Get one page of audit logs and the cursor of the next page.
+
+        Pages are ordered by (timestamp, id) and continue after the cursor
+        (keyset pagination), so every page costs the same however deep it is.
+        The next cursor is None on the last page or when limit is None.
+        """
+        # Include entries still queued in the audit writer
+        await self.audit.flush()
+
+        conditions = []
+        if capability_id is not None:
+            conditions.append(AuditLog.capability_id == capability_id)
+        if operation:
+            conditions.append(AuditLog.operation == operation)
+        if start_date:
+            conditions.append(AuditLog.timestamp >= start_date)
+        if end_date:
+            conditions.append(AuditLog.timestamp < end_date)
+        if cursor:
+            timestamp, log_id = self._decode_audit_cursor(cursor)
+            if descending:
+                conditions.append(
+                    or_(
+                        AuditLog.timestamp < timestamp,
+                        and_(AuditLog.timestamp == timestamp, AuditLog.id < log_id),
+                    )
+                )
+            else:
+                conditions.append(
+                    or_(
+                        AuditLog.timestamp > timestamp,
+                        and_(AuditLog.timestamp == timestamp, AuditLog.id > log_id),
+                    )
+                )
+
+        order = (
+            (AuditLog.timestamp.desc(), AuditLog.id.desc())
+            if descending
+            else (AuditLog.timestamp, AuditLog.id)
+        )
+        query = (
+            select(
+                AuditLog.id,
+                AuditLog.timestamp,
+                AuditLog.operation,
+                AuditLog.capability_id,
+                AuditLog.capability_name,
+                AuditLog.old_values,
+                AuditLog.new_values,
+            )
+            .where(*conditions)
+            .order_by(*order)
+        )
+        if limit is not None:
+            # One extra row tells whether another page follows
+            query = query.limit(limit + 1)
+
+        async with self.audit.session_factory() as session:
+            rows = (await session.execute(query)).all()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self._encode_audit_cursor(rows[-1])
+
+        # JSON is only decoded for the rows actually returned
+        return [self._audit_entry(row) for row in rows], next_cursor
 
     async def export_audit_logs(
         self, start_date: Optional[datetime] = None
     ) -> List[dict]:
         """Export audit logs in a readable format."""
-        async with await self._get_session() as session:
-            query = select(AuditLog).order_by(AuditLog.timestamp)
-            if start_date:
-                query = query.where(AuditLog.timestamp >= start_date)
-
-            result = await session.execute(query)
-            logs = result.scalars().all()
-
-            export_data = []
-            for log in logs:
-                # Parse JSON values once
-                old_values = json.loads(log.old_values) if log.old_values else None
-                new_values = json.loads(log.new_values) if log.new_values else None
-
-                # Remove order_position from values if present
-                if old_values and "order_position" in old_values:
-                    del old_values["order_position"]
-                if new_values and "order_position" in new_values:
-                    del new_values["order_position"]
-
-                entry = {
-                    "timestamp": log.timestamp.isoformat(),
-                    "operation": log.operation,
-                    "capability_id": log.capability_id,
-                    "capability_name": log.capability_name,
-                    "old_values": old_values,
-                    "new_values": new_values,
-                }
-                export_data.append(entry)
-
-            return export_data
+        logs, _ = await self.get_audit_logs(start_date=start_date)
+        return logs
 
     async def import_audit_logs(self, logs: List[dict]) -> None:
         """Import audit logs from exported format."""
-        async with await self._get_session() as session:
-            for log_entry in logs:
-                audit = AuditLog(
-                    operation=log_entry["operation"],
-                    capability_id=log_entry["capability_id"],
-                    capability_name=log_entry["capability_name"],
-                    old_values=json.dumps(log_entry["old_values"])
+        await self.audit.flush()
+        await self.audit.write(
+            [
+                {
+                    "operation": log_entry["operation"],
+                    "capability_id": log_entry["capability_id"],
+                    "capability_name": log_entry["capability_name"],
+                    "old_values": json.dumps(log_entry["old_values"])
                     if log_entry["old_values"]
                     else None,
-                    new_values=json.dumps(log_entry["new_values"])
+                    "new_values": json.dumps(log_entry["new_values"])
                     if log_entry["new_values"]
                     else None,
-                    timestamp=datetime.fromisoformat(log_entry["timestamp"]),
-                )
-                session.add(audit)
-            await session.commit()
+                    "timestamp": datetime.fromisoformat(log_entry["timestamp"]),
+                }
+                for log_entry in logs
+            ]
+        )
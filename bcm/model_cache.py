@@ -0,0 +1,152 @@
+import asyncio
+import weakref
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from bcm.tree_index import NONE, TreeIndex
+
+
+class ModelSnapshot:
+    """Read-only, in-memory copy of the capability tree at a given revision.
+
+    Holds an id -> node map, ordered children lists per parent (None for the
+    roots) and parent pointers. Nodes are plain dicts with the same keys the
+    hierarchy endpoints return, minus "children".
+    """
+
+    __slots__ = ("revision", "nodes", "children", "parents", "_tree_index")
+
+    def __init__(self, revision: int, rows: Iterable):
+        self.revision = revision
+        self.nodes: Dict[int, dict] = {}
+        self.children: Dict[Optional[int], List[int]] = {None: []}
+        self.parents: Dict[int, Optional[int]] = {}
+        self._tree_index: Optional[TreeIndex] = None
+
+        # Rows arrive ordered by order_position, so appending keeps every
+        # children list in display order
+        for row in rows:
+            self.nodes[row.id] = {
+                "id": row.id,
+                "name": row.name,
+                "description": row.description,
+                "parent_id": row.parent_id,
+                "order_position": row.order_position,
+            }
+            self.parents[row.id] = row.parent_id
+            self.children.setdefault(row.id, [])
+            self.children.setdefault(row.parent_id, []).append(row.id)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def tree_index(self) -> TreeIndex:
+        """Array-backed pre-order index of the tree, built on first use."""
+        if self._tree_index is None:
+            self._tree_index = TreeIndex(self)
+        return self._tree_index
+
+    def get(self, capability_id: int) -> Optional[dict]:
+        """Get a single node by ID."""
+        return self.nodes.get(capability_id)
+
+    def get_children(self, parent_id: Optional[int] = None) -> List[dict]:
+        """Get the ordered direct children of a node (roots for None)."""
+        return [self.nodes[child_id] for child_id in self.children.get(parent_id, [])]
+
+    def ancestors(self, capability_id: int) -> List[int]:
+        """Get the ancestor ids of a node, nearest parent first."""
+        result = []
+        parent_id = self.parents.get(capability_id)
+        while parent_id is not None and parent_id in self.nodes:
+            if parent_id in result or parent_id == capability_id:
+                break  # Guard against corrupt cyclic data
+            result.append(parent_id)
+            parent_id = self.parents.get(parent_id)
+        return result
+
+    def tree(
+        self, capability_id: Optional[int] = None, max_depth: Optional[int] = None
+    ) -> List[dict]:
+        """Build nested dicts for a subtree, or for the whole model with None.
+
+        max_depth limits the levels built below the start; every node carries
+        its descendant_count either way. Fresh dicts are returned on every
+        call so callers may modify them without affecting the shared snapshot.
+        """
+        index = self.tree_index
+
+        def build(pos: int, levels: Optional[int]) -> dict:
+            node = dict(self.nodes[index.ids[pos]])
+            node["descendant_count"] = index.end[pos] - pos - 1
+            node["children"] = (
+                []
+                if levels == 0
+                else [
+                    build(child, None if levels is None else levels - 1)
+                    for child in index.children(pos)
+                ]
+            )
+            return node
+
+        if capability_id is None:
+            return [build(pos, max_depth) for pos in index.roots()]
+        pos = index.position(capability_id)
+        if pos == NONE:
+            return []
+        return [build(pos, max_depth)]
+
+
+class ModelCache:
+    """Process-wide snapshot of the capability tree with a revision counter.
+
+    Every mutation bumps the revision, which drops the current snapshot. The
+    next reader reloads it once; concurrent readers wait for that load instead
+    of each hitting the database.
+    """
+
+    _instances: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+    def __init__(self):
+        self.revision = 0
+        self._snapshot: Optional[ModelSnapshot] = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def for_session_factory(cls, session_factory) -> "ModelCache":
+        """Get the cache shared by all users of a session factory."""
+        cache = cls._instances.get(session_factory)
+        if cache is None:
+            cache = cls._instances[session_factory] = cls()
+        return cache
+
+    def current(self) -> Optional[ModelSnapshot]:
+        """The snapshot if it is up to date, without loading it otherwise."""
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.revision == self.revision:
+            return snapshot
+        return None
+
+    def invalidate(self) -> int:
+        """Bump the revision and drop the snapshot. Returns the new revision."""
+        self.revision += 1
+        self._snapshot = None
+        return self.revision
+
+    async def get(self, loader: Callable[[], Awaitable[Iterable]]) -> ModelSnapshot:
+        """Get the current snapshot, loading rows with loader if it is stale."""
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.revision == self.revision:
+            return snapshot
+
+        async with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.revision == self.revision:
+                return snapshot
+
+            revision = self.revision
+            snapshot = ModelSnapshot(revision, await loader())
+            # Only keep the snapshot if no mutation happened while loading
+            if revision == self.revision:
+                self._snapshot = snapshot
+            return snapshot
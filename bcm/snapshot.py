@@ -0,0 +1,203 @@
+"""Compact binary snapshot of the capability model.
+
+Layout, all integers little endian:
+
+    magic         4 bytes   b"BCMS"
+    version       u8
+    codec         u8        0 = none, 1 = zlib, 2 = zstd
+    payload       the rest, compressed with codec:
+        count         u32           number of capabilities
+        strings       u32           number of entries in the string table
+        ids           i32[count]
+        parents       i32[count]    NO_PARENT for top-level capabilities
+        orders        i64[count]
+        names         u32[count]    index into the string table
+        descriptions  u32[count]    index into the string table, or NO_STRING
+        lengths       u32[strings]  length of each string in characters
+        text          every string concatenated, UTF-8 encoded
+
+Names and descriptions are deduplicated through the string table. Rows keep
+the order of the model snapshot, so children lists rebuild in display order.
+"""
+
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+from typing import Iterable, List, Union
+
+from bcm.model_cache import ModelSnapshot
+
+try:
+    import zstandard
+except ImportError:  # Optional dependency: pip install -e .[zstd]
+    zstandard = None
+
+MAGIC = b"BCMS"
+VERSION = 1
+CODECS = {"none": 0, "zlib": 1, "zstd": 2}
+NO_PARENT = -1
+NO_STRING = 0xFFFFFFFF
+# Favour speed: the default level 6 is several times slower for ~30% less
+ZLIB_LEVEL = 1
+
+_DECODE_ERRORS = (struct.error, zlib.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+_HEADER = struct.Struct("<4sBB")
+_COUNTS = struct.Struct("<II")
+
+# Same attributes as the database rows ModelSnapshot is built from
+SnapshotRow = namedtuple(
+    "SnapshotRow", ["id", "name", "description", "parent_id", "order_position"]
+)
+
+
+def _to_bytes(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode: str, data, offset: int, count: int):
+    values = array(typecode)
+    end = offset + count * values.itemsize
+    values.frombytes(data[offset:end])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, end
+
+
+def encode_snapshot(nodes: Iterable[dict], codec: str = "zlib") -> bytes:
+    """Encode capability nodes (dicts as held by ModelSnapshot) as a snapshot."""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown snapshot codec '{codec}'")
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("zstd snapshots need the zstandard package")
+
+    ids, parents = array("i"), array("i")
+    orders = array("q")
+    names, descriptions = array("I"), array("I")
+    table = {}
+
+    def intern(value: str) -> int:
+        index = table.get(value)
+        if index is None:
+            index = table[value] = len(table)
+        return index
+
+    for node in nodes:
+        ids.append(node["id"])
+        parents.append(NO_PARENT if node["parent_id"] is None else node["parent_id"])
+        orders.append(node["order_position"])
+        names.append(intern(node["name"]))
+        description = node["description"]
+        descriptions.append(NO_STRING if description is None else intern(description))
+
+    payload = b"".join(
+        [
+            _COUNTS.pack(len(ids), len(table)),
+            _to_bytes(ids),
+            _to_bytes(parents),
+            _to_bytes(orders),
+            _to_bytes(names),
+            _to_bytes(descriptions),
+            _to_bytes(array("I", [len(value) for value in table])),
+            "".join(table).encode("utf-8"),
+        ]
+    )
+    if codec == "zlib":
+        payload = zlib.compress(payload, ZLIB_LEVEL)
+    elif codec == "zstd":
+        payload = zstandard.ZstdCompressor().compress(payload)
+    return _HEADER.pack(MAGIC, VERSION, CODECS[codec]) + payload
+
+
+def decode_snapshot(data: Union[bytes, memoryview, mmap.mmap]) -> List[SnapshotRow]:
+    """Decode a snapshot into rows, ordered as they were encoded.
+
+    Uncompressed snapshots are read in place, so data may be a memory map.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("Not a capability snapshot")
+    magic, version, codec = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a capability snapshot")
+    if version != VERSION:
+        raise ValueError(f"Unsupported snapshot version {version}")
+
+    view = memoryview(data)
+    payload = view[_HEADER.size :]
+    try:
+        if codec == CODECS["zlib"]:
+            payload = memoryview(zlib.decompress(payload))
+        elif codec == CODECS["zstd"]:
+            if zstandard is None:
+                raise ValueError("zstd snapshots need the zstandard package")
+            payload = memoryview(zstandard.ZstdDecompressor().decompress(payload))
+        elif codec != CODECS["none"]:
+            raise ValueError(f"Unknown snapshot codec {codec}")
+
+        count, string_count = _COUNTS.unpack_from(payload)
+        offset = _COUNTS.size
+        ids, offset = _from_bytes("i", payload, offset, count)
+        parents, offset = _from_bytes("i", payload, offset, count)
+        orders, offset = _from_bytes("q", payload, offset, count)
+        names, offset = _from_bytes("I", payload, offset, count)
+        descriptions, offset = _from_bytes("I", payload, offset, count)
+        lengths, offset = _from_bytes("I", payload, offset, string_count)
+        text = bytes(payload[offset:])
+    except _DECODE_ERRORS as e:
+        raise ValueError(f"Corrupt capability snapshot: {e}")
+    finally:
+        # Release the buffer so a memory map can be closed
+        payload.release()
+        view.release()
+
+    # One decode for the whole table, then slice it up
+    try:
+        text = text.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise ValueError(f"Corrupt capability snapshot: {e}")
+    strings = []
+    start = 0
+    for length in lengths:
+        strings.append(text[start : start + length])
+        start += length
+    if (
+        start != len(text)
+        or len(descriptions) != count
+        or len(lengths) != string_count
+        or any(name >= string_count for name in names)
+        or any(d >= string_count and d != NO_STRING for d in descriptions)
+    ):
+        raise ValueError("Corrupt capability snapshot: inconsistent tables")
+
+    # Build whole columns first, then zip them into rows
+    strings.append(None)  # What NO_STRING resolves to below
+    descriptions = [
+        strings[-1 if index == NO_STRING else index] for index in descriptions
+    ]
+    parents = [None if parent_id == NO_PARENT else parent_id for parent_id in parents]
+    return list(
+        map(
+            SnapshotRow._make,
+            zip(ids, map(strings.__getitem__, names), descriptions, parents, orders),
+        )
+    )
+
+
+def read_snapshot_file(path: str) -> List[SnapshotRow]:
+    """Decode a snapshot file through a single memory-mapped read."""
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return decode_snapshot(data)
+
+
+def load_model_snapshot(data, revision: int = 0) -> ModelSnapshot:
+    """Build the in-memory model tree straight from snapshot bytes."""
+    return ModelSnapshot(revision, decode_snapshot(data))
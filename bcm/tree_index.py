@@ -0,0 +1,198 @@
+from array import array
+from typing import Iterator, List, Optional
+
+# Marks a missing parent, child or sibling in the index arrays
+NONE = -1
+
+
+class TreeIndex:
+    """Compact, array-backed index of the capability tree.
+
+    Nodes are stored in pre-order, so every node is addressed by its position
+    and the subtree of the node at position p is exactly the positions
+    range(p, end[p]). Per position the index holds the capability id, name
+    and description, and the parent, first child, next sibling and depth as
+    int32 arrays: a few dozen bytes per node instead of a dict per node.
+    Nodes that cannot be reached from a root (parent cycles) are left out.
+    """
+
+    __slots__ = (
+        "ids",
+        "names",
+        "descriptions",
+        "parent",
+        "first_child",
+        "next_sibling",
+        "depth",
+        "end",
+        "_positions",
+    )
+
+    def __init__(self, snapshot):
+        """Build the index from a ModelSnapshot's ordered children lists."""
+        nodes = snapshot.nodes
+        children = snapshot.children
+
+        ids, parent, depth = array("i"), array("i"), array("i")
+        names, descriptions = [], []
+        # Capability id -> position; ids are dense autoincrement keys
+        positions = array("i", [NONE]) * (max(nodes, default=0) + 1)
+
+        # Depth-first walk; children are pushed in reverse to pop in order
+        stack = [(root_id, NONE, 0) for root_id in reversed(children.get(None, []))]
+        pop, push = stack.pop, stack.extend
+        while stack:
+            cap_id, parent_pos, level = pop()
+            if positions[cap_id] != NONE:
+                continue  # Already placed: corrupt data with a shared child
+            pos = positions[cap_id] = len(ids)
+            node = nodes[cap_id]
+            ids.append(cap_id)
+            names.append(node["name"])
+            descriptions.append(node["description"])
+            parent.append(parent_pos)
+            depth.append(level)
+            child_ids = children[cap_id]
+            if child_ids:
+                push((child_id, pos, level + 1) for child_id in reversed(child_ids))
+
+        # A subtree ends where the last subtree below it ends. Nodes that
+        # could not be reached from a root were skipped above.
+        count = len(ids)
+        end = array("i", range(1, count + 1))
+        for pos in range(count - 1, 0, -1):
+            parent_pos = parent[pos]
+            if parent_pos != NONE and end[pos] > end[parent_pos]:
+                end[parent_pos] = end[pos]
+
+        # In pre-order a first child directly follows its parent, and the next
+        # sibling directly follows the previous sibling's subtree
+        first_child = array("i", [NONE]) * count
+        next_sibling = array("i", [NONE]) * count
+        for pos in range(count):
+            if end[pos] > pos + 1:
+                first_child[pos] = pos + 1
+            parent_pos = parent[pos]
+            if end[pos] < (end[parent_pos] if parent_pos != NONE else count):
+                next_sibling[pos] = end[pos]
+
+        self.ids, self.names, self.descriptions = ids, names, descriptions
+        self.parent, self.depth, self.end = parent, depth, end
+        self.first_child, self.next_sibling = first_child, next_sibling
+        self._positions = positions
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def position(self, capability_id: int) -> int:
+        """Position of a capability, or NONE if it is not in the tree."""
+        if 0 <= capability_id < len(self._positions):
+            return self._positions[capability_id]
+        return NONE
+
+    def node(self, capability_id: int) -> Optional["TreeNode"]:
+        """View of a capability by id, or None if it is not in the tree."""
+        pos = self.position(capability_id)
+        return TreeNode(self, pos) if pos != NONE else None
+
+    def roots(self) -> Iterator[int]:
+        """Positions of the top-level capabilities, in order."""
+        pos = 0 if self.ids else NONE
+        while pos != NONE:
+            yield pos
+            pos = self.next_sibling[pos]
+
+    def children(self, pos: int) -> Iterator[int]:
+        """Positions of the direct children of pos, in order."""
+        child = self.first_child[pos]
+        while child != NONE:
+            yield child
+            child = self.next_sibling[child]
+
+    def ancestors(self, pos: int) -> Iterator[int]:
+        """Positions of the ancestors of pos, nearest parent first."""
+        pos = self.parent[pos]
+        while pos != NONE:
+            yield pos
+            pos = self.parent[pos]
+
+    def subtree(self, pos: int) -> range:
+        """Positions of pos and all its descendants, in pre-order."""
+        return range(pos, self.end[pos])
+
+    def preorder(
+        self, pos: Optional[int] = None, max_depth: Optional[int] = None
+    ) -> Iterator[int]:
+        """Walk a subtree (the whole tree for None) in pre-order.
+
+        max_depth limits how many levels below the start are visited; deeper
+        subtrees are skipped without being looked at.
+        """
+        if pos is None:
+            current, stop, limit = 0, len(self.ids), max_depth
+        else:
+            current, stop = pos, self.end[pos]
+            limit = None if max_depth is None else self.depth[pos] + max_depth
+        if limit is None:
+            yield from range(current, stop)
+            return
+        while current < stop:
+            yield current
+            current = self.end[current] if self.depth[current] >= limit else current + 1
+
+
+class TreeNode:
+    """Lightweight view of one node of a TreeIndex."""
+
+    __slots__ = ("tree", "position")
+
+    def __init__(self, tree: TreeIndex, position: int):
+        self.tree = tree
+        self.position = position
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, TreeNode)
+            and other.tree is self.tree
+            and other.position == self.position
+        )
+
+    def __hash__(self) -> int:
+        return hash((id(self.tree), self.position))
+
+    def __repr__(self) -> str:
+        return f"TreeNode(id={self.id}, name={self.name!r})"
+
+    @property
+    def id(self) -> int:
+        return self.tree.ids[self.position]
+
+    @property
+    def name(self) -> str:
+        return self.tree.names[self.position]
+
+    @property
+    def description(self) -> Optional[str]:
+        return self.tree.descriptions[self.position]
+
+    @property
+    def depth(self) -> int:
+        return self.tree.depth[self.position]
+
+    @property
+    def parent(self) -> Optional["TreeNode"]:
+        pos = self.tree.parent[self.position]
+        return TreeNode(self.tree, pos) if pos != NONE else None
+
+    @property
+    def children(self) -> List["TreeNode"]:
+        return [TreeNode(self.tree, pos) for pos in self.tree.children(self.position)]
+
+    @property
+    def descendant_count(self) -> int:
+        return self.tree.end[self.position] - self.position - 1
+
+    def walk(self, max_depth: Optional[int] = None) -> Iterator["TreeNode"]:
+        """This node and its descendants in pre-order."""
+        for pos in self.tree.preorder(self.position, max_depth):
+            yield TreeNode(self.tree, pos)
@@ -1,9 +1,10 @@
-from typing import List, Dict
+from typing import Dict
 # from pydantic_ai import Agent
 from jinja2 import Environment, FileSystemLoader
 import os
 from bcm.settings import Settings
 from bcm.models import CapabilityExpansion, FirstLevelCapabilities
+from bcm.tree_index import NONE
 
 def init_user_templates():
     """Initialize user template directory and copy application templates if needed."""
@@ -89,7 +90,9 @@ jinja_env = get_jinja_env()
 
 async def get_capability_context(db_ops, capability_id: int) -> str:
     """Get context information for AI expansion, including full parent hierarchy."""
-    capability = await db_ops.get_capability(capability_id)
+    # All sections are built from the cached in-memory model snapshot
+    snapshot = await db_ops.get_model_snapshot()
+    capability = snapshot.get(capability_id)
     if not capability:
         return ""
 
@@ -99,12 +102,10 @@ async def get_capability_context(db_ops, capability_id: int) -> str:
     # Section 1: First-level capabilities
     context_parts.append("<first_level_capabilities>")
     if settings.get("context_first_level", True):
-        first_level_caps = await db_ops.get_capabilities(parent_id=None)
-        if first_level_caps:
-            for cap in first_level_caps:
-                context_parts.append(f"- {cap.name}")
-                if cap.description:
-                    context_parts.append(f"  Description: {cap.description}")
+        for cap in snapshot.get_children(None):
+            context_parts.append(f"- {cap['name']}")
+            if cap["description"]:
+                context_parts.append(f"  Description: {cap['description']}")
     else:
         context_parts.append("Content intentionally left blank")
     context_parts.append("</first_level_capabilities>")
@@ -112,32 +113,17 @@ async def get_capability_context(db_ops, capability_id: int) -> str:
     # Section 2: Capability Tree
     context_parts.append("<capability_tree>")
     if settings.get("context_tree", True):
-        async def build_capability_tree(
-            root_caps, current_cap_id: int, level: int = 0, prefix: str = ""
-        ) -> List[str]:
-            tree_lines = []
-            last_index = len(root_caps) - 1
-
-            for i, cap in enumerate(root_caps):
-                is_last = i == last_index
-                branch = "└── " if is_last else "├── "
-                marker = " *" if cap.id == current_cap_id else ""
-                tree_lines.append(f"{prefix}{branch}{cap.name}{marker}")
-
-                # Get children
-                children = await db_ops.get_capabilities(cap.id)
-                if children:
-                    child_prefix = prefix + ("    " if is_last else "│   ")
-                    child_lines = await build_capability_tree(
-                        children, current_cap_id, level + 1, child_prefix
-                    )
-                    tree_lines.extend(child_lines)
-
-            return tree_lines
-
-        first_level_caps = await db_ops.get_capabilities(parent_id=None)
-        tree_lines = await build_capability_tree(first_level_caps, capability_id)
-        context_parts.extend(tree_lines)
+        # Walk the array-backed index in pre-order. The guide columns of a
+        # line depend on whether each ancestor is the last of its siblings.
+        index = snapshot.tree_index
+        guides = []
+        for pos in range(len(index)):
+            del guides[index.depth[pos] :]
+            is_last = index.next_sibling[pos] == NONE
+            branch = "└── " if is_last else "├── "
+            marker = " *" if index.ids[pos] == capability_id else ""
+            context_parts.append(f"{''.join(guides)}{branch}{index.names[pos]}{marker}")
+            guides.append("    " if is_last else "│   ")
     else:
         context_parts.append("Content intentionally left blank")
     context_parts.append("</capability_tree>")
@@ -145,18 +131,14 @@ async def get_capability_context(db_ops, capability_id: int) -> str:
     # Section 3: Parent Hierarchy
     context_parts.append("<parent_hierarchy>")
     if settings.get("context_include_parents", True):
-        async def add_parent_hierarchy(cap_id: int, level: int = 0) -> None:
-            parent = await db_ops.get_capability(cap_id)
-            if parent:
-                if parent.parent_id:
-                    await add_parent_hierarchy(parent.parent_id, level + 1)
-                context_parts.append(f"Level {level+1}: {parent.name}")
-                if parent.description:
-                    # truncate long descriptions
-                    context_parts.append(f"Description: {parent.description[:200]}")
-
-        if capability.parent_id:
-            await add_parent_hierarchy(capability.parent_id)
+        # Ancestors come nearest first; list them from the root down
+        ancestors = snapshot.ancestors(capability_id)
+        for level in range(len(ancestors) - 1, -1, -1):
+            parent = snapshot.get(ancestors[level])
+            context_parts.append(f"Level {level+1}: {parent['name']}")
+            if parent["description"]:
+                # truncate long descriptions
+                context_parts.append(f"Description: {parent['description'][:200]}")
     else:
         context_parts.append("Content intentionally left blank")
     context_parts.append("</parent_hierarchy>")
@@ -164,32 +146,28 @@ async def get_capability_context(db_ops, capability_id: int) -> str:
     # Section 4: Sibling Context
     context_parts.append("<sibling_context>")
     if settings.get("context_include_siblings", True):
-        siblings = await db_ops.get_capabilities(capability.parent_id)
-        if siblings:
-            for sibling in siblings:
-                if sibling.id != capability_id:
-                    context_parts.append(f"- {sibling.name}")
-                    if sibling.description:
-                        context_parts.append(f"  Description: {sibling.description}")
+        for sibling in snapshot.get_children(capability["parent_id"]):
+            if sibling["id"] != capability_id:
+                context_parts.append(f"- {sibling['name']}")
+                if sibling["description"]:
+                    context_parts.append(f"  Description: {sibling['description']}")
     else:
         context_parts.append("Content intentionally left blank")
     context_parts.append("</sibling_context>")
 
     # Section 5: Current Capability
     context_parts.append("<current_capability>")
-    context_parts.append(f"Name: {capability.name}")
-    if capability.description:
-        context_parts.append(f"Description: {capability.description[:200]}")
+    context_parts.append(f"Name: {capability['name']}")
+    if capability["description"]:
+        context_parts.append(f"Description: {capability['description'][:200]}")
     context_parts.append("</current_capability>")
 
     # Section 6: Sub-Capabilities
     context_parts.append("<sub_capabilities>")
-    sub_capabilities = await db_ops.get_capabilities(capability_id)
-    if sub_capabilities:
-        for sub_cap in sub_capabilities:
-            context_parts.append(f"- {sub_cap.name}")
-            if sub_cap.description:
-                context_parts.append(f"  Description: {sub_cap.description}")
+    for sub_cap in snapshot.get_children(capability_id):
+        context_parts.append(f"- {sub_cap['name']}")
+        if sub_cap["description"]:
+            context_parts.append(f"  Description: {sub_cap['description']}")
     context_parts.append("</sub_capabilities>")
 
     return "\n".join(context_parts)
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import weakref
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Session.info key holding callbacks to run once the enclosing transaction is
+# durably committed. Sessions carrying it must flush instead of committing.
+AFTER_COMMIT = "after_commit_callbacks"
+
+
+def get_write_window() -> float:
+    """Seconds the writer waits for more requests to share a commit.
+
+    Read from THEMIS_WRITE_WINDOW_MS (milliseconds), 2 ms by default.
+    """
+    return float(os.environ.get("THEMIS_WRITE_WINDOW_MS", "2")) / 1000
+
+
+class SingleWriter:
+    """Serialize mutations through one connection and group-commit them.
+
+    Every submitted operation runs in its own session and SAVEPOINT on the
+    writer's connection, so a failing request only rolls back itself.
+    Operations that are queued together, or arrive within the write window,
+    are committed as one transaction. Callers get their result only after
+    that commit.
+    """
+
+    # Upper bound on the number of requests sharing one commit
+    MAX_GROUP = 64
+
+    _instances: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+    def __init__(self, engine, window: Optional[float] = None):
+        self.engine = engine
+        self.window = get_write_window() if window is None else window
+        self._queue: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        # Futures of the group currently running, not yet resolved
+        self._group: list = []
+
+    @classmethod
+    def for_session_factory(cls, session_factory) -> "SingleWriter":
+        """Get the writer shared by all users of a session factory."""
+        writer = cls._instances.get(session_factory)
+        if writer is None:
+            writer = cls._instances[session_factory] = cls(
+                session_factory.kw["bind"]
+            )
+        return writer
+
+    async def submit(self, operation: Callable[[AsyncSession], Awaitable]):
+        """Run operation(session) on the writer and return its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((operation, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self) -> None:
+        while self._queue:
+            finished = []
+            try:
+                async with self.engine.connect() as connection:
+                    await connection.execution_options(sqlite_begin="IMMEDIATE")
+                    while self._queue:
+                        self._resolve(finished)
+                        finished = await self._run_group(connection)
+            except Exception as e:
+                # Could not connect, or the group broke off: fail the group
+                # and everything that is waiting
+                for future in self._group:
+                    if not future.done():
+                        future.set_exception(e)
+                self._group = []
+                while self._queue:
+                    _, future = self._queue.popleft()
+                    if not future.done():
+                        future.set_exception(e)
+            # The last group is resolved once the connection is released, so
+            # callers that finish right away (e.g. on shutdown) cannot cut
+            # its cleanup short
+            self._resolve(finished)
+
+    @staticmethod
+    def _resolve(finished: list) -> None:
+        for future, result in finished:
+            if not future.done():
+                future.set_result(result)
+
+    async def _run_group(self, connection) -> list:
+        """Run and commit one group; return the (future, result) pairs."""
+        await connection.begin()
+        self._group = []
+        completed = []
+        callbacks = []
+        waited = False
+        while len(completed) < self.MAX_GROUP:
+            if not self._queue:
+                if waited or not self.window:
+                    break
+                # Give requests arriving right behind this one a chance to
+                # share the commit
+                waited = True
+                await asyncio.sleep(self.window)
+                continue
+            operation, future = self._queue.popleft()
+            if future.done():
+                continue  # Caller went away
+            self._group.append(future)
+            async with AsyncSession(
+                bind=connection,
+                join_transaction_mode="create_savepoint",
+                expire_on_commit=False,
+            ) as session:
+                session.info[AFTER_COMMIT] = request_callbacks = []
+                try:
+                    result = await operation(session)
+                    # Releases this request's SAVEPOINT
+                    await session.commit()
+                except Exception as e:
+                    await session.rollback()
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+            completed.append((future, result))
+            callbacks.extend(request_callbacks)
+
+        try:
+            await connection.commit()
+        except Exception as e:
+            await connection.rollback()
+            for future, _ in completed:
+                if not future.done():
+                    future.set_exception(e)
+            self._group = []
+            return []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in after-commit callback: {str(e)}")
+        self._group = []
+        return completed
+
+    async def stop(self) -> None:
+        """Wait for queued operations to finish. Called on shutdown."""
+        if self._task is not None and not self._task.done():
+            await self._task
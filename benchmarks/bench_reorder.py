@@ -0,0 +1,60 @@
+"""Benchmark drag-and-drop moves among the children of a wide parent.
+
+Usage: python benchmarks/bench_reorder.py [children] [moves]
+"""
+
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from bcm.database import DatabaseOperations
+from bcm.models import Base, create_engine_instance
+
+
+async def main(children: int, moves: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine_instance(f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        db_ops = DatabaseOperations(
+            async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        )
+
+        data = [{"id": "root", "name": "Root"}, {"id": "other", "name": "Other"}]
+        data += [
+            {"id": f"c{i}", "name": f"Child {i}", "parent": "root"}
+            for i in range(children)
+        ]
+        await db_ops.import_capabilities(data)
+        root, other = [cap.id for cap in await db_ops.get_capabilities(None)]
+        child_ids = [cap.id for cap in await db_ops.get_capabilities(root)]
+
+        rng = random.Random(42)
+        start = time.perf_counter()
+        for _ in range(moves):
+            await db_ops.update_capability_order(
+                rng.choice(child_ids), root, rng.randrange(children)
+            )
+        within = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for cap_id in child_ids[:moves]:
+            await db_ops.update_capability_order(cap_id, other, 0)
+        across = time.perf_counter() - start
+
+        print(f"{children} children, {moves} moves")
+        print(f"  within parent: {within / moves * 1000:.2f} ms/move")
+        print(f"  across parents: {across / moves * 1000:.2f} ms/move")
+        await db_ops.drain_background_tasks()
+        await db_ops.audit.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*(args + [500, 200][len(args):])))
@@ -0,0 +1,75 @@
+"""Benchmark session joins, lookups and leaves with many concurrent users.
+
+Compares the indexed session registry with scanning a dict of session dicts
+for a nickname, as the API did before.
+
+Usage: python benchmarks/bench_sessions.py [sessions] [lookups]
+"""
+
+import sys
+import time
+import uuid
+
+from bcm.api.state import SessionRegistry
+
+
+def scan_join(users: dict, nickname: str) -> str:
+    if any(session["nickname"] == nickname for session in users.values()):
+        raise ValueError(nickname)
+    session_id = str(uuid.uuid4())
+    users[session_id] = {"session_id": session_id, "nickname": nickname}
+    return session_id
+
+
+def scan_lookup(users: dict, nickname: str):
+    return next(
+        (session for session in users.values() if session["nickname"] == nickname),
+        None,
+    )
+
+
+def main(sessions: int, lookups: int) -> None:
+    nicknames = [f"user{i}" for i in range(sessions)]
+    probes = [nicknames[(i * 7919) % sessions] for i in range(lookups)]
+
+    users = {}
+    start = time.perf_counter()
+    ids = [scan_join(users, nickname) for nickname in nicknames]
+    scan_joined = time.perf_counter() - start
+    start = time.perf_counter()
+    for nickname in probes:
+        scan_lookup(users, nickname)
+    scan_found = time.perf_counter() - start
+    start = time.perf_counter()
+    for session_id in ids:
+        del users[session_id]
+    scan_left = time.perf_counter() - start
+
+    registry = SessionRegistry()
+    start = time.perf_counter()
+    ids = [registry.join(nickname).session_id for nickname in nicknames]
+    joined = time.perf_counter() - start
+    start = time.perf_counter()
+    for nickname in probes:
+        registry.by_nickname(nickname)
+    found = time.perf_counter() - start
+    start = time.perf_counter()
+    for session_id in ids:
+        registry.leave(session_id)
+    left = time.perf_counter() - start
+
+    print(f"{sessions} sessions, {lookups} nickname lookups")
+    print(f"  {'':<10}{'join ms':>10}{'lookup ms':>11}{'leave ms':>10}")
+    for label, times in (
+        ("scan", (scan_joined, scan_found, scan_left)),
+        ("registry", (joined, found, left)),
+    ):
+        row = "".join(f"{t * 1000:>{w}.2f}" for t, w in zip(times, (10, 11, 10)))
+        print(f"  {label:<10}{row}")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 100000,
+    )
@@ -0,0 +1,93 @@
+"""Compare the binary snapshot format with the JSON export in size and speed.
+
+Usage: python benchmarks/bench_snapshot.py [capabilities]
+"""
+
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from bcm.database import DatabaseOperations
+from bcm.models import Base, create_engine_instance
+from bcm.snapshot import decode_snapshot, load_model_snapshot, zstandard
+
+WORDS = (
+    "customer order payment invoice product supply chain risk compliance "
+    "data analytics service delivery partner channel marketing sales"
+).split()
+
+
+def timed(function, repeat: int = 5):
+    """Best wall-clock time of repeat calls, and the last result."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+async def main(count: int) -> None:
+    rng = random.Random(42)
+    data = []
+    for i in range(count):
+        parent = data[rng.randrange(len(data))]["id"] if data and i > 10 else None
+        data.append(
+            {
+                "id": f"c{i}",
+                "name": " ".join(rng.sample(WORDS, 2)).title() + f" {i}",
+                "description": " ".join(rng.choices(WORDS, k=rng.randrange(0, 40))),
+                "parent": parent,
+            }
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine_instance(f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        db_ops = DatabaseOperations(
+            async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        )
+        await db_ops.import_capabilities(data)
+        # Load the cached model once so only serialisation is measured
+        await db_ops.get_model_snapshot()
+
+        start = time.perf_counter()
+        exported = await db_ops.export_capabilities()
+        text = json.dumps(exported).encode("utf-8")
+        json_save = time.perf_counter() - start
+        json_load, _ = timed(lambda: json.loads(text))
+
+        # JSON load only parses; snapshots are decoded, then built into the
+        # in-memory model tree
+        print(f"{count} capabilities")
+        print(f"  {'format':<10}{'bytes':>12}{'save ms':>10}{'decode ms':>11}{'tree ms':>9}")
+        print(
+            f"  {'json':<10}{len(text):>12}{json_save * 1000:>10.1f}"
+            f"{json_load * 1000:>11.1f}{'-':>9}"
+        )
+
+        codecs = ["none", "zlib"] + (["zstd"] if zstandard is not None else [])
+        for codec in codecs:
+            start = time.perf_counter()
+            snapshot = await db_ops.export_snapshot(codec)
+            save = time.perf_counter() - start
+            decode, _ = timed(lambda: decode_snapshot(snapshot))
+            load, _ = timed(lambda: load_model_snapshot(snapshot))
+            print(
+                f"  {codec:<10}{len(snapshot):>12}{save * 1000:>10.1f}"
+                f"{decode * 1000:>11.1f}{load * 1000:>9.1f}"
+            )
+
+        await db_ops.audit.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.pool import NullPool
+
+from bcm.api import server, utilities
+from bcm.api.state import app_state
+from bcm.database import DatabaseOperations
+from bcm.models import Base, create_engine_instance, get_db
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """API client whose endpoints use a fresh SQLite file per test."""
+    engine = create_engine_instance(
+        f"sqlite+aiosqlite:///{tmp_path / 'test.db'}", poolclass=NullPool
+    )
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    session_factory = async_sessionmaker(
+        engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def get_test_db():
+        async with session_factory() as session:
+            yield session
+
+    db_ops = DatabaseOperations(session_factory)
+    monkeypatch.setattr(server, "db_ops", db_ops)
+    monkeypatch.setattr(utilities, "db_ops", db_ops)
+    server.api_app.dependency_overrides[get_db] = get_test_db
+    with TestClient(server.api_app) as client:
+        yield client
+    server.api_app.dependency_overrides.clear()
+    app_state.lock_manager.clear()
+    for session in app_state.active_users:
+        app_state.active_users.leave(session.session_id)
+    asyncio.run(engine.dispose())
+
+
+def test_transaction_updates_that_move_respect_and_reindex_locks(client):
+    def join(nickname):
+        return client.post("/users", json={"nickname": nickname}).json()["session_id"]
+
+    amy, bob = join("amy"), join("bob")
+
+    def create(name, parent_id=None):
+        response = client.post(
+            f"/capabilities?session_id={amy}",
+            json={"name": name, "parent_id": parent_id},
+        )
+        return response.json()["id"]
+
+    def reparent(session_id, capability_id, parent_id):
+        operation = {
+            "op": "update", "capability_id": capability_id, "parent_id": parent_id,
+        }
+        return client.post(
+            f"/capabilities/transaction?session_id={session_id}",
+            json={"operations": [operation]},
+        ).status_code
+
+    root = create("Root")
+    a, b = create("A", root), create("B", root)
+    x = create("X", a)
+    y = create("Y", x)
+    assert client.post(f"/capabilities/lock/{y}?nickname=bob").status_code == 200
+
+    # Re-parenting X moves bob's lock along, like the PUT endpoint does
+    assert reparent(amy, x, b) == 409
+    response = client.put(f"/capabilities/{x}?session_id={amy}", json={"parent_id": b})
+    assert response.status_code == 409
+
+    # Bob may move his own lock; the lock index follows it below B
+    assert reparent(bob, x, b) == 200
+    assert client.delete(f"/capabilities/{b}?session_id={amy}").status_code == 409
+    assert client.delete(f"/capabilities/{a}?session_id={amy}").status_code == 200
+
+
+def test_audit_logs_are_served_in_pages_by_default(client):
+    session_id = client.post("/users", json={"nickname": "amy"}).json()["session_id"]
+    count = utilities.AUDIT_LOG_PAGE_SIZE + 5
+    response = client.post(
+        f"/capabilities/batch?session_id={session_id}",
+        json={"capabilities": [{"name": f"C{i}"} for i in range(count)]},
+    )
+    assert response.status_code == 200
+
+    response = client.get("/logs")
+    assert len(response.json()) == utilities.AUDIT_LOG_PAGE_SIZE
+    logs = response.json()
+    while "X-Next-Cursor" in response.headers:
+        cursor = response.headers["X-Next-Cursor"]
+        response = client.get("/logs", params={"cursor": cursor})
+        logs += response.json()
+    assert sorted(log["capability_name"] for log in logs) == sorted(
+        f"C{i}" for i in range(count)
+    )
+
+
+def test_moving_a_capability_below_itself_is_rejected(client):
+    session_id = client.post("/users", json={"nickname": "amy"}).json()["session_id"]
+
+    def create(name, parent_id=None):
+        response = client.post(
+            f"/capabilities?session_id={session_id}",
+            json={"name": name, "parent_id": parent_id},
+        )
+        return response.json()["id"]
+
+    root = create("Root")
+    child = create("Child", root)
+    response = client.post(
+        f"/capabilities/{root}/move?session_id={session_id}",
+        json={"new_parent_id": child, "new_order": 0},
+    )
+    assert response.status_code == 400
+    assert "circular" in response.json()["detail"]
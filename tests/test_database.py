@@ -0,0 +1,1017 @@
+import asyncio
+import sqlite3
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+from bcm.database import DatabaseOperations
+from bcm.models import (
+    Base,
+    Capability,
+    CapabilityBatchItem,
+    CapabilityCreate,
+    CapabilityOperation,
+    CapabilityUpdate,
+    LayoutModel,
+    create_engine_instance,
+    create_read_engine_instance,
+    get_engine_options,
+    _upgrade_schema,
+    get_sqlite_pragmas,
+)
+from bcm.snapshot import (
+    decode_snapshot,
+    encode_snapshot,
+    load_model_snapshot,
+    read_snapshot_file,
+)
+
+
+@pytest.fixture
+def db_ops(tmp_path):
+    """DatabaseOperations bound to a fresh SQLite file per test."""
+    engine = create_engine_instance(
+        f"sqlite+aiosqlite:///{tmp_path / 'test.db'}", poolclass=NullPool
+    )
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    yield DatabaseOperations(
+        async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    )
+    asyncio.run(engine.dispose())
+
+
+async def create(db_ops, name, parent_id=None):
+    cap = await db_ops.create_capability(
+        CapabilityCreate(name=name, description=f"{name} description", parent_id=parent_id)
+    )
+    return cap.id
+
+
+def names(nodes):
+    return [node["name"] for node in nodes]
+
+
+def test_capability_tree_is_nested_and_ordered(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        a = await create(db_ops, "A", root)
+        b = await create(db_ops, "B", root)
+        a1 = await create(db_ops, "A1", a)
+        await create(db_ops, "Other")
+
+        tree = await db_ops.get_all_capabilities()
+        assert names(tree) == ["Root", "Other"]
+        assert names(tree[0]["children"]) == ["A", "B"]
+        assert tree[0]["children"][0]["children"][0]["id"] == a1
+
+        subtree = await db_ops.get_capability_with_children(a)
+        assert subtree["name"] == "A"
+        assert subtree["parent_id"] == root
+        assert names(subtree["children"]) == ["A1"]
+
+        assert await db_ops.get_capability_with_children(b) is not None
+        assert await db_ops.get_capability_with_children(9999) is None
+
+        assert await db_ops.get_markdown_hierarchy() == (
+            "- Root\n  - A\n    - A1\n  - B\n- Other"
+        )
+
+    asyncio.run(scenario())
+
+
+def test_model_snapshot_is_cached_until_mutation(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        child = await create(db_ops, "Child", root)
+
+        snapshot = await db_ops.get_model_snapshot()
+        assert await db_ops.get_model_snapshot() is snapshot
+        assert snapshot.ancestors(child) == [root]
+        assert [node["id"] for node in snapshot.get_children(root)] == [child]
+
+        revision = db_ops.model_revision
+        await db_ops.save_description(child, "Changed")
+        assert db_ops.model_revision == revision + 1
+
+        fresh = await db_ops.get_model_snapshot()
+        assert fresh is not snapshot
+        assert fresh.get(child)["description"] == "Changed"
+
+        # Other instances on the same session factory share the cache
+        other = DatabaseOperations(db_ops.session_factory)
+        assert await other.get_model_snapshot() is fresh
+
+        await db_ops.delete_capability(child)
+        tree = await other.get_all_capabilities()
+        assert tree[0]["children"] == []
+
+    asyncio.run(scenario())
+
+
+def test_paths_follow_create_move_import_and_delete(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        a = await create(db_ops, "A", root)
+        b = await create(db_ops, "B", root)
+        a1 = await create(db_ops, "A1", a)
+        a11 = await create(db_ops, "A11", a1)
+
+        assert (await db_ops.get_capability(a11)).path == f"/{root}/{a}/{a1}/{a11}/"
+        assert sorted(await db_ops.get_descendant_ids(a)) == [a1, a11]
+        assert [cap.id for cap in await db_ops.get_ancestors(a11)] == [a1, a, root]
+        assert await db_ops.is_ancestor(a, a11)
+        assert not await db_ops.is_ancestor(b, a11)
+
+        # Moving a subtree rewrites the paths below it
+        await db_ops.update_capability_order(a1, b, 0)
+        assert (await db_ops.get_capability(a11)).path == f"/{root}/{b}/{a1}/{a11}/"
+        assert await db_ops.get_descendant_ids(a) == []
+
+        # Moving a node below its own descendant is rejected
+        with pytest.raises(ValueError):
+            await db_ops.update_capability_order(b, a11, 0)
+        with pytest.raises(ValueError):
+            await db_ops.update_capability(b, CapabilityUpdate(parent_id=a1))
+
+        await db_ops.update_capability(a1, CapabilityUpdate(parent_id=None))
+        assert (await db_ops.get_capability(a11)).path == f"/{a1}/{a11}/"
+
+        await db_ops.delete_capability(a1)
+        assert await db_ops.get_capability(a11) is None
+
+        await db_ops.import_capabilities(
+            [
+                {"id": "c", "name": "Child", "parent": "p"},
+                {"id": "p", "name": "Parent"},
+            ]
+        )
+        [parent] = await db_ops.get_capabilities(None)
+        [child] = await db_ops.get_capabilities(parent.id)
+        assert child.path == f"/{parent.id}/{child.id}/"
+
+    asyncio.run(scenario())
+
+
+def test_bulk_import_orders_and_validates(db_ops):
+    async def scenario():
+        await create(db_ops, "Existing")
+        await db_ops.import_capabilities(
+            [
+                {"id": "b1", "name": "B1", "parent": "b"},
+                {"id": "a", "name": "A"},
+                {"id": "b", "name": "B"},
+                {"id": "b2", "name": "B2", "parent": "b", "description": "Second"},
+            ]
+        )
+        tree = await db_ops.get_all_capabilities()
+        assert names(tree) == ["A", "B"]
+        assert names(tree[1]["children"]) == ["B1", "B2"]
+        assert tree[1]["children"][1]["description"] == "Second"
+
+        logs = await db_ops.export_audit_logs()
+        assert [log["operation"] for log in logs] == ["IMPORT"]
+
+        with pytest.raises(ValueError):
+            await db_ops.import_capabilities([{"id": "x", "name": "X", "parent": "y"}])
+        with pytest.raises(ValueError):
+            await db_ops.import_capabilities(
+                [
+                    {"id": "x", "name": "X", "parent": "y"},
+                    {"id": "y", "name": "Y", "parent": "x"},
+                ]
+            )
+        # Failed imports leave the model untouched
+        assert names(await db_ops.get_all_capabilities()) == ["A", "B"]
+
+    asyncio.run(scenario())
+
+
+def test_subtree_delete_is_audited(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        keep = await create(db_ops, "Keep", root)
+        gone = await create(db_ops, "Gone", root)
+        child = await create(db_ops, "Child", gone)
+        grandchild = await create(db_ops, "Grandchild", child)
+
+        assert await db_ops.delete_capability(gone)
+        assert not await db_ops.delete_capability(gone)
+        for cap_id in (gone, child, grandchild):
+            assert await db_ops.get_capability(cap_id) is None
+        assert await db_ops.get_capability(keep) is not None
+
+        delete_log = (await db_ops.export_audit_logs())[-1]
+        assert delete_log["operation"] == "DELETE"
+        assert delete_log["capability_id"] == gone
+        assert delete_log["old_values"]["removed_descendants"] == ["Child", "Grandchild"]
+        assert delete_log["old_values"]["removed_descendant_ids"] == [child, grandchild]
+
+        await db_ops.clear_all_capabilities()
+        assert await db_ops.get_all_capabilities() == []
+
+    asyncio.run(scenario())
+
+
+def test_move_reorders_siblings(db_ops):
+    async def scenario():
+        await db_ops.import_capabilities(
+            [{"id": "r", "name": "R"}, {"id": "s", "name": "S"}]
+            + [{"id": n, "name": n, "parent": "r"} for n in ["A", "B", "C", "D"]]
+        )
+        r, s = [cap.id for cap in await db_ops.get_capabilities(None)]
+
+        async def children(parent_id):
+            return [cap.name for cap in await db_ops.get_capabilities(parent_id)]
+
+        a, b, c, d = [cap.id for cap in await db_ops.get_capabilities(r)]
+        await db_ops.update_capability_order(d, r, 0)
+        assert await children(r) == ["D", "A", "B", "C"]
+        await db_ops.update_capability_order(d, r, 2)
+        assert await children(r) == ["A", "B", "D", "C"]
+        await db_ops.update_capability_order(b, s, 0)
+        await db_ops.update_capability_order(c, s, 0)
+        assert await children(r) == ["A", "D"]
+        assert await children(s) == ["C", "B"]
+
+    asyncio.run(scenario())
+
+
+def test_gap_ordering_survives_many_moves(db_ops):
+    async def scenario():
+        parent = await create(db_ops, "Parent")
+        other = await create(db_ops, "Other")
+        expected = [await create(db_ops, f"C{i}", parent) for i in range(4)]
+
+        positions = [cap.order_position for cap in await db_ops.get_capabilities(parent)]
+        assert positions == [0, 1024, 2048, 3072]
+
+        # A move between two siblings writes only the moved row
+        moved = expected.pop(3)
+        await db_ops.update_capability_order(moved, parent, 1)
+        expected.insert(1, moved)
+        siblings = await db_ops.get_capabilities(parent)
+        assert [cap.id for cap in siblings] == expected
+        assert [cap.order_position for cap in siblings] == [0, 512, 1024, 2048]
+
+        # Repeatedly inserting at the same spot exhausts the gap
+        for i in range(30):
+            cap_id = await create(db_ops, f"N{i}", other)
+            await db_ops.update_capability_order(cap_id, parent, 1)
+            expected.insert(1, cap_id)
+            assert [cap.id for cap in await db_ops.get_capabilities(parent)] == expected
+        await db_ops.drain_background_tasks()
+
+        siblings = await db_ops.get_capabilities(parent)
+        assert [cap.id for cap in siblings] == expected
+        assert len({cap.order_position for cap in siblings}) == len(siblings)
+
+        # Moving to the front and the end
+        await db_ops.update_capability_order(expected[-1], parent, 0)
+        expected.insert(0, expected.pop())
+        await db_ops.update_capability_order(expected[0], parent, 999)
+        expected.append(expected.pop(0))
+        assert [cap.id for cap in await db_ops.get_capabilities(parent)] == expected
+
+    asyncio.run(scenario())
+
+
+def test_full_text_search_is_ranked_and_kept_in_sync(db_ops):
+    async def scenario():
+        customer = await create(db_ops, "Customer Management")
+        await create(db_ops, "Billing", customer)
+        await db_ops.save_description(customer, "Handles customers and accounts")
+
+        results = await db_ops.search_capabilities("cust")
+        assert [r["id"] for r in results] == [customer]
+        assert results[0]["name_snippet"] == "<mark>Customer</mark> Management"
+        assert "<mark>customers</mark>" in results[0]["description_snippet"]
+
+        # Name matches outrank description-only matches
+        invoicing = await create(db_ops, "Invoicing", customer)
+        await db_ops.save_description(invoicing, "Billing of customers")
+        assert [r["name"] for r in await db_ops.search_capabilities("bill")] == [
+            "Billing",
+            "Invoicing",
+        ]
+
+        await db_ops.update_capability(invoicing, CapabilityUpdate(name="Payments"))
+        assert [r["name"] for r in await db_ops.search_capabilities("pay")] == ["Payments"]
+        assert await db_ops.search_capabilities("invoic") == []
+
+        await db_ops.delete_capability(customer)
+        assert await db_ops.search_capabilities("bill") == []
+        assert await db_ops.search_capabilities('" OR *') == []
+
+    asyncio.run(scenario())
+
+
+def test_connections_use_sqlite_pragma_profile(db_ops, monkeypatch):
+    async def scenario():
+        async with db_ops.session_factory() as session:
+            pragma = lambda name: session.execute(text(f"PRAGMA {name}"))
+            assert (await pragma("journal_mode")).scalar() == "wal"
+            assert (await pragma("foreign_keys")).scalar() == 1
+            assert (await pragma("synchronous")).scalar() == 1  # NORMAL
+            assert (await pragma("temp_store")).scalar() == 2  # MEMORY
+
+    asyncio.run(scenario())
+
+    monkeypatch.setenv("THEMIS_SQLITE_PRAGMAS", "synchronous=FULL; mmap_size=")
+    pragmas = get_sqlite_pragmas()
+    assert pragmas["synchronous"] == "FULL"
+    assert "mmap_size" not in pragmas
+    monkeypatch.setenv("THEMIS_SQLITE_PRAGMAS", "x; drop table=1")
+    with pytest.raises(ValueError):
+        get_sqlite_pragmas()
+
+
+def test_path_backfill_handles_deep_trees_and_parent_cycles(tmp_path, capsys):
+    database = tmp_path / "old.db"
+    depth = 3000  # Deeper than the recursion limit
+    with sqlite3.connect(database) as db:
+        db.execute(
+            "CREATE TABLE capabilities (id INTEGER PRIMARY KEY, "
+            "name VARCHAR(255) NOT NULL, description TEXT, parent_id INTEGER, "
+            "order_position INTEGER, created_at DATETIME, updated_at DATETIME)"
+        )
+        db.executemany(
+            "INSERT INTO capabilities (id, name, parent_id) VALUES (?, ?, ?)",
+            [(i, f"C{i}", i - 1 if i > 1 else None) for i in range(1, depth + 1)]
+            # Two rows pointing at each other, reachable from no root
+            + [(depth + 1, "Loop A", depth + 2), (depth + 2, "Loop B", depth + 1)],
+        )
+
+    engine = create_engine(f"sqlite:///{database}")
+    with engine.begin() as connection:
+        _upgrade_schema(connection)
+        rows = dict(
+            connection.execute(text("SELECT id, path FROM capabilities")).all()
+        )
+        deepest = connection.execute(
+            text("SELECT depth FROM capabilities WHERE id = :id"), {"id": depth}
+        ).scalar()
+    engine.dispose()
+
+    assert rows[2] == "/1/2/"
+    assert rows[depth].count("/") == depth + 1
+    assert deepest == depth - 1
+    assert rows[depth + 1] is None and rows[depth + 2] is None
+    assert f"[{depth + 1}, {depth + 2}]" in capsys.readouterr().out
+
+
+def test_audit_entries_are_queued_until_commit_and_batched(db_ops):
+    async def scenario():
+        audit = db_ops.audit
+        assert not audit.synchronous
+
+        root = await create(db_ops, "Root")
+        # Both create entries are queued by the single commit, not yet written
+        assert audit.pending == 2
+        async with db_ops.session_factory() as session:
+            count = await session.execute(text("SELECT COUNT(*) FROM audit_log"))
+            assert count.scalar() == 0
+
+        # Entries of a rolled back transaction are discarded
+        async with db_ops.session_factory() as session:
+            await db_ops.log_audit(session, "UPDATE", capability_id=root)
+            await session.rollback()
+        assert audit.pending == 2
+
+        await audit.flush()
+        assert audit.pending == 0
+        logs = await db_ops.export_audit_logs()
+        assert [log["operation"] for log in logs] == ["CREATE", "ID_ASSIGN"]
+        assert logs[1]["capability_id"] == root
+
+        # The background task writes queued entries on its own
+        await db_ops.save_description(root, "Changed")
+        await asyncio.sleep(audit.FLUSH_DELAY * 4)
+        assert audit.pending == 0
+        await audit.stop()
+
+    asyncio.run(scenario())
+
+
+def test_audit_batches_share_the_single_writer_under_load(
+    tmp_path, monkeypatch, capsys
+):
+    # Without waiting on a busy database, a second writer fails right away
+    monkeypatch.setenv("THEMIS_SQLITE_PRAGMAS", "busy_timeout=0")
+    engine = create_engine_instance(
+        f"sqlite+aiosqlite:///{tmp_path / 'load.db'}", poolclass=NullPool
+    )
+    db_ops = DatabaseOperations(
+        async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    )
+
+    async def scenario():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        audit = db_ops.audit
+        assert audit.writer is db_ops.writer
+
+        root = await create(db_ops, "Root")
+        targets = await asyncio.gather(
+            *(create(db_ops, f"Target {i}", root) for i in range(5))
+        )
+
+        async def editor(i):
+            for j in range(10):
+                child = await create(db_ops, f"Child {i}.{j}", root)
+                await db_ops.update_capability_order(child, targets[j % 5], 0)
+                # Give the audit task room to run between mutations
+                await asyncio.sleep(0)
+
+        await asyncio.gather(*(editor(i) for i in range(20)))
+        await audit.stop()
+        assert audit.pending == 0
+
+        async with db_ops.session_factory() as session:
+            result = await session.execute(
+                text("SELECT operation, COUNT(*) FROM audit_log GROUP BY operation")
+            )
+            counts = dict(result.all())
+        assert counts["CREATE"] == 1 + 5 + 200
+        assert counts["MOVE"] == 200
+
+        await db_ops.import_audit_logs(
+            [
+                {
+                    "operation": "IMPORT",
+                    "capability_id": None,
+                    "capability_name": None,
+                    "old_values": None,
+                    "new_values": {"count": 1},
+                    "timestamp": datetime(2024, 1, 1).isoformat(),
+                }
+            ]
+        )
+        imported, _ = await db_ops.get_audit_logs(operation="IMPORT")
+        assert [log["new_values"] for log in imported] == [{"count": 1}]
+        await engine.dispose()
+
+    asyncio.run(scenario())
+    assert "Error writing audit log" not in capsys.readouterr().out
+
+
+def test_audit_can_be_synchronous_or_in_a_separate_database(db_ops, tmp_path):
+    async def scenario():
+        inline = DatabaseOperations(db_ops.session_factory, audit_synchronous=True)
+        # The writer is shared per session factory; the first instance decides
+        assert inline.audit is db_ops.audit
+
+        engine = create_engine_instance(
+            f"sqlite+aiosqlite:///{tmp_path / 'inline.db'}", poolclass=NullPool
+        )
+        audit_engine = create_engine_instance(
+            f"sqlite+aiosqlite:///{tmp_path / 'audit.db'}", poolclass=NullPool
+        )
+        for target in (engine, audit_engine):
+            async with target.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+        factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        audit_factory = async_sessionmaker(
+            audit_engine, class_=AsyncSession, expire_on_commit=False
+        )
+
+        inline = DatabaseOperations(factory, audit_synchronous=True)
+        await create(inline, "Inline")
+        assert inline.audit.pending == 0
+        assert len(await inline.export_audit_logs()) == 2
+
+        separate_factory = async_sessionmaker(
+            engine, class_=AsyncSession, expire_on_commit=False
+        )
+        separate = DatabaseOperations(separate_factory, audit_factory)
+        await separate.import_capabilities([{"id": "a", "name": "A"}])
+        await separate.audit.stop()
+        async with audit_factory() as session:
+            result = await session.execute(text("SELECT operation FROM audit_log"))
+            assert result.scalars().all() == ["IMPORT"]
+        # The main database keeps the inline entries untouched
+        async with factory() as session:
+            count = await session.execute(text("SELECT COUNT(*) FROM audit_log"))
+            assert count.scalar() == 2
+
+        await engine.dispose()
+        await audit_engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_audit_logs_are_paginated_and_filtered(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        for i in range(4):
+            await db_ops.save_description(root, f"Version {i}")
+        other = await create(db_ops, "Other")
+
+        everything = await db_ops.export_audit_logs()
+        assert len(everything) == 8
+
+        pages, cursor = [], None
+        while True:
+            page, cursor = await db_ops.get_audit_logs(limit=3, cursor=cursor)
+            pages.append(page)
+            if cursor is None:
+                break
+        assert [len(page) for page in pages] == [3, 3, 2]
+        assert [log for page in pages for log in page] == everything
+
+        updates, cursor = await db_ops.get_audit_logs(
+            limit=10, capability_id=root, operation="UPDATE", descending=True
+        )
+        assert cursor is None
+        assert [log["new_values"]["description"] for log in updates] == [
+            f"Version {i}" for i in (3, 2, 1, 0)
+        ]
+
+        newest, cursor = await db_ops.get_audit_logs(limit=1, descending=True)
+        assert newest[0]["capability_id"] == other
+        older, _ = await db_ops.get_audit_logs(limit=1, cursor=cursor, descending=True)
+        assert older[0]["operation"] == "CREATE"
+
+        later, _ = await db_ops.get_audit_logs(
+            start_date=datetime.fromisoformat(everything[-2]["timestamp"])
+        )
+        assert later == everything[-2:]
+
+        with pytest.raises(ValueError):
+            await db_ops.get_audit_logs(limit=1, cursor="not a cursor")
+
+    asyncio.run(scenario())
+
+
+def test_streamed_export_round_trips_through_import(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        for name in ["B", "A", "C"]:
+            await create(db_ops, name, root)
+        first = (await db_ops.get_capabilities(root))[0].id
+        await create(db_ops, "B1", first)
+        await create(db_ops, "Other")
+        # Sibling order must survive, not just creation order
+        await db_ops.update_capability_order(first, root, 2)
+        before = await db_ops.get_all_capabilities()
+
+        items = [item async for item in db_ops.stream_export_capabilities()]
+        assert len(items) == 6
+        assert len({item["id"] for item in items}) == 6
+        assert all(item["parent"] in {i["id"] for i in items} for item in items if item["parent"])
+
+        await db_ops.import_capabilities(items)
+
+        def strip(nodes):
+            return [(node["name"], node["description"], strip(node["children"])) for node in nodes]
+
+        assert strip(await db_ops.get_all_capabilities()) == strip(before)
+
+    asyncio.run(scenario())
+
+
+def test_streamed_export_yields_parents_before_children(db_ops):
+    async def scenario():
+        root = await create(db_ops, "R")
+        p = await create(db_ops, "P")
+        q = await create(db_ops, "Q", root)
+        await create(db_ops, "C", p)
+        # P now hangs below a capability with a higher id than its child's parent
+        await db_ops.update_capability_order(p, q, 0)
+
+        items = [item async for item in db_ops.stream_export_capabilities()]
+        seen = set()
+        for item in items:
+            assert item["parent"] is None or item["parent"] in seen
+            seen.add(item["id"])
+
+        def preorder(nodes):
+            return [n for node in nodes for n in [node["name"], *preorder(node["children"])]]
+
+        assert [item["name"] for item in items] == preorder(
+            await db_ops.get_all_capabilities()
+        )
+
+    asyncio.run(scenario())
+
+
+def test_batch_create_inserts_nested_items_in_one_transaction(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        await create(db_ops, "Existing", root)
+        revision = db_ops.model_revision
+
+        created = await db_ops.create_capabilities(
+            root,
+            [
+                CapabilityBatchItem(
+                    name="A",
+                    description="First",
+                    children=[CapabilityBatchItem(name="A1"), CapabilityBatchItem(name="A2")],
+                ),
+                CapabilityBatchItem(name="B"),
+            ],
+        )
+        assert [cap["name"] for cap in created] == ["A", "B", "A1", "A2"]
+        assert db_ops.model_revision == revision + 1
+
+        tree = await db_ops.get_capability_with_children(root)
+        assert names(tree["children"]) == ["Existing", "A", "B"]
+        assert names(tree["children"][1]["children"]) == ["A1", "A2"]
+        a1 = await db_ops.get_capability(created[2]["id"])
+        assert a1.path == f"/{root}/{created[0]['id']}/{a1.id}/"
+
+        logs = await db_ops.get_audit_logs(capability_id=a1.id)
+        assert [log["operation"] for log in logs[0]] == ["CREATE"]
+
+        with pytest.raises(ValueError):
+            await db_ops.create_capabilities(9999, [CapabilityBatchItem(name="X")])
+
+    asyncio.run(scenario())
+
+
+def test_operations_apply_atomically_in_one_transaction(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        a = await create(db_ops, "A", root)
+        b = await create(db_ops, "B", root)
+        a1 = await create(db_ops, "A1", a)
+        revision = db_ops.model_revision
+
+        results = await db_ops.apply_operations(
+            [
+                CapabilityOperation(op="create", ref="new", name="New", parent_id=root),
+                CapabilityOperation(op="create", name="Leaf", parent_ref="new"),
+                CapabilityOperation(op="move", capability_id=a, parent_ref="new"),
+                CapabilityOperation(op="update", capability_id=a1, name="Renamed"),
+                CapabilityOperation(op="move", capability_id=a1, parent_id=b),
+                CapabilityOperation(op="delete", capability_id=a),
+            ]
+        )
+        assert [r["op"] for r in results] == ["create", "create", "move", "update", "move", "delete"]
+        assert db_ops.model_revision == revision + 1
+
+        tree = await db_ops.get_capability_with_children(root)
+        assert names(tree["children"]) == ["B", "New"]
+        assert names(tree["children"][0]["children"]) == ["Renamed"]
+        assert names(tree["children"][1]["children"]) == ["Leaf"]
+        new = results[0]["id"]
+        assert (await db_ops.get_capability(a1)).path == f"/{root}/{b}/{a1}/"
+        assert await db_ops.get_capability(a) is None
+
+        # A failing operation rolls back everything before it
+        revision = db_ops.model_revision
+        await db_ops.audit.flush()
+        log_count = len(await db_ops.export_audit_logs())
+        with pytest.raises(ValueError):
+            await db_ops.apply_operations(
+                [
+                    CapabilityOperation(op="update", capability_id=b, name="Changed"),
+                    CapabilityOperation(op="delete", capability_id=new),
+                    CapabilityOperation(op="move", capability_id=9999, parent_id=root),
+                ]
+            )
+        assert db_ops.model_revision == revision
+        assert (await db_ops.get_capability(b)).name == "B"
+        assert await db_ops.get_capability(new) is not None
+        assert len(await db_ops.export_audit_logs()) == log_count
+
+        with pytest.raises(ValueError):
+            await db_ops.apply_operations(
+                [CapabilityOperation(op="delete", ref="missing")]
+            )
+
+    asyncio.run(scenario())
+
+
+def test_engine_options_come_from_the_environment(monkeypatch, tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'options.db'}"
+    assert get_engine_options(url) == {}
+
+    monkeypatch.setenv("THEMIS_DB_POOL_SIZE", "3")
+    monkeypatch.setenv("THEMIS_DB_MAX_OVERFLOW", "7")
+    monkeypatch.setenv("THEMIS_DB_POOL_PRE_PING", "true")
+    monkeypatch.setenv("THEMIS_DB_STATEMENT_CACHE_SIZE", "50")
+    assert get_engine_options(url) == {
+        "pool_size": 3,
+        "max_overflow": 7,
+        "pool_pre_ping": True,
+        "connect_args": {"cached_statements": 50},
+    }
+    assert get_engine_options("postgresql+asyncpg://u:p@host/db")["connect_args"] == {
+        "statement_cache_size": 50,
+        "prepared_statement_cache_size": 50,
+    }
+
+    engine = create_engine_instance(url)
+    assert engine.pool.size() == 3
+    # An explicit pool class replaces the pool sizing
+    engine = create_engine_instance(url, poolclass=NullPool)
+    assert isinstance(engine.pool, NullPool)
+
+
+def test_concurrent_writes_share_the_single_writer(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        ids = await asyncio.gather(
+            *(create(db_ops, f"Child {i}", root) for i in range(50))
+        )
+        assert len(set(ids)) == 50
+
+        # A failing request only rolls back itself, not its group
+        results = await asyncio.gather(
+            create(db_ops, "Before", root),
+            db_ops.create_capabilities(9999, [CapabilityBatchItem(name="Orphan")]),
+            create(db_ops, "After", root),
+            return_exceptions=True,
+        )
+        assert isinstance(results[1], ValueError)
+        tree = await db_ops.get_capability_with_children(root)
+        assert len(tree["children"]) == 52
+        assert names(tree["children"])[-2:] == ["Before", "After"]
+        orders = [
+            (await db_ops.get_capability(child["id"])).order_position
+            for child in tree["children"]
+        ]
+        assert orders == sorted(set(orders))
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_break_its_group(db_ops):
+    async def scenario():
+        writer = db_ops.writer
+        started = asyncio.Event()
+
+        async def succeeding(session):
+            await session.execute(
+                text(
+                    "INSERT INTO audit_log (operation, timestamp) "
+                    "VALUES ('KEPT', CURRENT_TIMESTAMP)"
+                )
+            )
+            return "kept"
+
+        async def failing(session):
+            started.set()
+            await asyncio.sleep(0.05)
+            raise ValueError("Failed after its caller left")
+
+        first = asyncio.create_task(writer.submit(succeeding))
+        second = asyncio.create_task(writer.submit(failing))
+        await started.wait()
+        second.cancel()
+
+        assert await asyncio.wait_for(first, 5) == "kept"
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        async with db_ops.session_factory() as session:
+            result = await session.execute(
+                text("SELECT COUNT(*) FROM audit_log WHERE operation = 'KEPT'")
+            )
+            assert result.scalar() == 1
+
+    asyncio.run(scenario())
+
+
+def test_read_engine_refuses_writes(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'read.db'}"
+
+    async def scenario():
+        engine = create_engine_instance(url, poolclass=NullPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await engine.dispose()
+
+        read_engine = create_read_engine_instance(url, poolclass=NullPool)
+        async with read_engine.connect() as conn:
+            assert (await conn.execute(text("SELECT COUNT(*) FROM capabilities"))).scalar() == 0
+            with pytest.raises(OperationalError):
+                await conn.execute(text("DELETE FROM capabilities"))
+        await read_engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_change_feed_replays_mutations_since_a_revision(db_ops):
+    async def scenario():
+        feed = await db_ops.get_changes(0)
+        assert feed == {"revision": 0, "resync": False, "changes": []}
+
+        root = await create(db_ops, "Root")
+        a = await create(db_ops, "A", root)
+        start = (await db_ops.get_changes(0))["revision"]
+
+        b = await create(db_ops, "B", root)
+        await db_ops.update_capability(a, CapabilityUpdate(name="A2"))
+        await db_ops.update_capability_order(b, root, 0)
+        await db_ops.save_description(a, "New description")
+        await db_ops.delete_capability(a)
+
+        feed = await db_ops.get_changes(start)
+        assert not feed["resync"]
+        changes = feed["changes"]
+        assert [(c["operation"], c["capability_id"]) for c in changes] == [
+            ("create", b),
+            ("update", a),
+            ("move", b),
+            ("update", a),
+            ("delete", a),
+        ]
+        assert changes[0]["values"]["parent_id"] == root
+        assert changes[1]["values"] == {"name": "A2"}
+        assert changes[2]["values"]["parent_id"] == root
+        assert [c["revision"] for c in changes] == sorted({c["revision"] for c in changes})
+        assert feed["revision"] == changes[-1]["revision"]
+
+        # Up to date, paged past the limit, or from the future
+        assert (await db_ops.get_changes(feed["revision"]))["changes"] == []
+        assert (await db_ops.get_changes(start, limit=2))["resync"]
+        assert (await db_ops.get_changes(feed["revision"] + 1))["resync"]
+
+        # Replacing the model makes every older revision resync
+        await db_ops.import_capabilities([{"id": "x", "name": "X"}])
+        assert (await db_ops.get_changes(feed["revision"]))["resync"]
+        latest = (await db_ops.get_changes(0))["revision"]
+        assert latest > feed["revision"]
+        assert (await db_ops.get_changes(latest)) == {
+            "revision": latest,
+            "resync": False,
+            "changes": [],
+        }
+
+    asyncio.run(scenario())
+
+
+def test_binary_snapshot_round_trip(db_ops, tmp_path):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        a = await create(db_ops, "A", root)
+        await create(db_ops, "Ünïcode", a)
+        await create(db_ops, "B", root)
+        await db_ops.update_capability(a, CapabilityUpdate(description=None))
+        await create(db_ops, "Other")
+        expected = await db_ops.get_all_capabilities()
+
+        for codec in ("none", "zlib"):
+            data = await db_ops.export_snapshot(codec)
+            assert load_model_snapshot(data).tree() == expected
+        (tmp_path / "model.bcms").write_bytes(await db_ops.export_snapshot("none"))
+        rows = read_snapshot_file(str(tmp_path / "model.bcms"))
+        assert sorted(row.name for row in rows) == ["A", "B", "Other", "Root", "Ünïcode"]
+        assert next(row for row in rows if row.id == a).description is None
+
+        # Shared strings are stored once
+        data = encode_snapshot(
+            [
+                {"id": i, "name": "Same", "description": "Text", "parent_id": None, "order_position": i}
+                for i in range(1, 101)
+            ],
+            "none",
+        )
+        assert len(data) < 100 * 30
+
+        with pytest.raises(ValueError):
+            await db_ops.export_snapshot("lz4")
+        with pytest.raises(ValueError):
+            decode_snapshot(b"not a snapshot")
+        with pytest.raises(ValueError):
+            decode_snapshot((await db_ops.export_snapshot("none"))[:-3])
+
+        await db_ops.import_snapshot(await db_ops.export_snapshot())
+        assert names(await db_ops.get_all_capabilities()) == ["Root", "Other"]
+        tree = await db_ops.get_all_capabilities()
+        assert names(tree[0]["children"]) == ["A", "B"]
+        assert names(tree[0]["children"][0]["children"]) == ["Ünïcode"]
+
+    asyncio.run(scenario())
+
+
+def test_tree_index_navigation_and_layout(db_ops):
+    async def scenario():
+        root = await create(db_ops, "Root")
+        a = await create(db_ops, "A", root)
+        a1 = await create(db_ops, "A1", a)
+        a1x = await create(db_ops, "A1x", a1)
+        b = await create(db_ops, "B", root)
+        other = await create(db_ops, "Other")
+        await db_ops.update_capability_order(b, root, 0)
+
+        tree = await db_ops.get_tree_index()
+        assert tree is await db_ops.get_tree_index()  # Cached with the snapshot
+        assert len(tree) == 6
+        assert [tree.ids[pos] for pos in tree.preorder()] == [root, b, a, a1, a1x, other]
+        assert [tree.ids[pos] for pos in tree.roots()] == [root, other]
+        assert list(tree.depth) == [0, 1, 1, 2, 3, 0]
+
+        node = tree.node(a)
+        assert node.name == "A" and node.depth == 1
+        assert node.parent.id == root
+        assert [child.id for child in node.children] == [a1]
+        assert node.descendant_count == 2
+        assert [n.id for n in node.walk()] == [a, a1, a1x]
+        assert [n.id for n in node.walk(max_depth=1)] == [a, a1]
+        assert [tree.ids[pos] for pos in tree.subtree(tree.position(root))] == [
+            root, b, a, a1, a1x,
+        ]
+        assert [tree.ids[pos] for pos in tree.ancestors(tree.position(a1x))] == [a1, a, root]
+        assert [tree.ids[pos] for pos in tree.preorder(max_depth=0)] == [root, other]
+        assert tree.node(9999) is None
+
+        # Layout input matches the dict-based conversion, levels included
+        for max_level in (0, 1, 2, 6):
+            expected = LayoutModel.convert_to_layout_format(
+                await db_ops.get_capability_with_children(root), max_level
+            )
+            assert LayoutModel.from_tree_index(
+                tree, tree.position(root), max_level
+            ) == expected
+
+        assert await db_ops.get_markdown_hierarchy() == (
+            "- Root\n  - B\n  - A\n    - A1\n      - A1x\n- Other"
+        )
+        exported = await db_ops.export_capabilities()
+        assert [item["name"] for item in exported] == ["Root", "B", "A", "A1", "A1x", "Other"]
+        by_id = {item["id"]: item for item in exported}
+        assert by_id[exported[4]["parent"]]["name"] == "A1"
+
+    asyncio.run(scenario())
+
+
+def test_depth_and_descendant_counts_are_maintained(db_ops):
+    async def counts():
+        async with db_ops.session_factory() as session:
+            rows = await session.execute(
+                select(Capability.name, Capability.depth, Capability.descendant_count)
+            )
+            return {name: (depth, count) for name, depth, count in rows}
+
+    async def scenario():
+        root = await create(db_ops, "Root")
+        a = await create(db_ops, "A", root)
+        b = await create(db_ops, "B", root)
+        await db_ops.create_capabilities(
+            a,
+            [
+                CapabilityBatchItem(
+                    name="A1",
+                    children=[CapabilityBatchItem(name="A1x"), CapabilityBatchItem(name="A1y")],
+                )
+            ],
+        )
+        [a1] = [cap.id for cap in await db_ops.get_capabilities(a)]
+        assert await counts() == {
+            "Root": (0, 5), "A": (1, 3), "B": (1, 0),
+            "A1": (2, 2), "A1x": (3, 0), "A1y": (3, 0),
+        }
+
+        # Moving a subtree shifts its size between ancestors and its depths
+        await db_ops.update_capability_order(a1, b, 0)
+        await db_ops.update_capability(b, CapabilityUpdate(parent_id=None))
+        assert await counts() == {
+            "Root": (0, 1), "A": (1, 0), "B": (0, 3),
+            "A1": (1, 2), "A1x": (2, 0), "A1y": (2, 0),
+        }
+
+        [a1x, _] = await db_ops.get_capabilities(a1)
+        await db_ops.delete_capability(a1x.id)
+        assert (await counts())["B"] == (0, 2)
+
+        # Depth limits are applied in SQL when the cache is not current
+        db_ops.model_cache.invalidate()
+        [tree] = await db_ops.get_capability_tree(b, max_depth=0)
+        assert tree["children"] == [] and tree["descendant_count"] == 2
+        assert [node["name"] for node in await db_ops.get_all_capabilities(0)] == [
+            "Root", "B",
+        ]
+        # ...and give the same tree as the cached snapshot
+        for max_depth in (0, 1, None):
+            db_ops.model_cache.invalidate()
+            loaded = await db_ops.get_capability_tree(max_depth=max_depth)
+            await db_ops.get_model_snapshot()
+            assert await db_ops.get_capability_tree(max_depth=max_depth) == loaded
+        db_ops.model_cache.invalidate()
+        assert await db_ops.get_layout_model(b, 1) == LayoutModel.from_tree_index(
+            await db_ops.get_tree_index(), (await db_ops.get_tree_index()).position(b), 1
+        )
+
+        await db_ops.import_capabilities(
+            [
+                {"id": "c", "name": "Child", "parent": "p"},
+                {"id": "p", "name": "Parent"},
+                {"id": "g", "name": "Grand", "parent": "c"},
+            ]
+        )
+        assert await counts() == {
+            "Parent": (0, 2), "Child": (1, 1), "Grand": (2, 0),
+        }
+
+    asyncio.run(scenario())
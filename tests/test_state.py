@@ -0,0 +1,187 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from bcm.api.state import ConnectionManager, LockManager, SessionRegistry, app_state
+
+
+def test_lock_manager_checks_ancestors_and_descendants():
+    locks = LockManager()
+    # Tree: 1 -> 2 -> 3, 1 -> 4
+    assert locks.lock(3, "amy", [2, 1])
+    assert not locks.lock(3, "bob", [2, 1])
+    assert locks.owner(3) == "amy"
+    assert locks.locked_ids("amy") == [3]
+
+    assert locks.locked_ancestor([2, 1]) is None
+    assert locks.locked_ancestor([3, 2, 1]) == 3
+    # Locks on the node or its ancestors always conflict, locks below it
+    # only when asked for
+    assert locks.conflict(3, "bob", [2, 1]) == "amy"
+    assert locks.conflict(1, "bob") is None
+    assert locks.conflict(1, "bob", descendants=True) == "amy"
+    assert locks.conflict(4, "bob", [1], descendants=True) is None
+    assert locks.conflict(1, "amy", descendants=True) is None
+
+    # Moving 2 below 4 re-indexes the lock below it
+    locks.moved(2, [4, 1])
+    assert locks.conflict(4, "bob", [1], descendants=True) == "amy"
+    assert locks.covers(2) and locks.covers(4) and not locks.covers(13)
+
+    assert not locks.unlock(3, "bob")
+    assert locks.unlock(3, "amy")
+    assert not locks.covers(1)
+    assert locks.conflict(1, "bob", descendants=True) is None
+
+    locks.lock(2, "amy", [4, 1])
+    locks.lock(5, "bob", [])
+    locks.removed(4)
+    assert locks.owner(2) is None and locks.owner(5) == "bob"
+    assert locks.release("bob") == [5]
+    assert not locks.covers(5)
+
+
+def test_session_registry_indexes_ids_and_nicknames():
+    sessions = SessionRegistry()
+    amy = sessions.join("amy")
+    bob = sessions.join("bob")
+    with pytest.raises(ValueError):
+        sessions.join("amy")
+
+    assert len(sessions) == 2
+    assert amy.session_id in sessions and sessions[amy.session_id] is amy
+    assert sessions.by_nickname("bob") is bob
+    assert [session.nickname for session in sessions] == ["amy", "bob"]
+
+    assert sessions.leave(amy.session_id) is amy
+    assert sessions.leave(amy.session_id) is None
+    assert sessions.by_nickname("amy") is None and sessions.get(amy.session_id) is None
+    # The nickname is free again
+    assert sessions.join("amy").session_id != amy.session_id
+
+
+class FakeWebSocket:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.delay)
+        self.sent.append(json.loads(text))
+
+    async def close(self):
+        self.closed = True
+
+
+def test_broadcasts_queue_per_client_and_drop_slow_ones():
+    async def scenario():
+        manager = ConnectionManager(queue_size=2, send_timeout=0.05, window=0)
+        fast, slow, stuck = FakeWebSocket(), FakeWebSocket(delay=1), FakeWebSocket()
+        sessions = {}
+        for name, websocket in (("fast", fast), ("slow", slow), ("stuck", stuck)):
+            sessions[name] = app_state.active_users.join(name).session_id
+            await manager.connect(websocket, sessions[name])
+        # The stuck client's writer never runs, so its queue fills up
+        manager.active_connections[sessions["stuck"]].task.cancel()
+        await asyncio.sleep(0.01)
+
+        # Broadcasting never waits for a client
+        start = time.perf_counter()
+        await manager.broadcast_model_change("fast", "one")
+        assert time.perf_counter() - start < 0.5
+
+        # The slow client times out on its first send and is dropped
+        await asyncio.sleep(0.1)
+        assert sessions["slow"] not in manager.active_connections
+        assert sessions["slow"] not in app_state.active_users
+        assert slow.closed and not slow.sent
+
+        # The stuck client overflows and is dropped right away
+        await manager.broadcast_model_change("fast", "two")
+        assert sessions["stuck"] not in manager.active_connections
+        await asyncio.sleep(0.01)
+        assert stuck.closed and not stuck.sent
+        assert [m.get("action") or m["user"] for m in fast.sent] == [
+            "one", "slow", "two", "stuck",
+        ]
+
+        # A replaced socket closing does not end the session
+        newer = FakeWebSocket()
+        await manager.connect(newer, sessions["fast"])
+        assert manager.disconnect(sessions["fast"], fast) is None
+        assert manager.disconnect(sessions["fast"], newer) == "fast"
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_model_changed_events_chain_the_change_feed():
+    async def scenario():
+        log = [{"revision": 1, "operation": "create", "capability_id": 7, "values": {}}]
+
+        async def change_feed(since):
+            changes = [change for change in log if change["revision"] > since]
+            return {"revision": len(log), "resync": False, "changes": changes}
+
+        manager = ConnectionManager(window=0)
+        client = FakeWebSocket()
+        session_id = app_state.active_users.join("viewer").session_id
+        await manager.connect(client, session_id)
+        manager.set_change_feed(change_feed, 0)
+
+        await manager.broadcast_model_change("amy", "created capability 'A'")
+        await manager.broadcast_model_change("amy", "locked capability 'A'")
+        log.append({"revision": 2, "operation": "delete", "capability_id": 7, "values": {}})
+        await manager.broadcast_model_change("amy", "deleted capability 'A'")
+        await asyncio.sleep(0.01)
+
+        assert [(m["since"], m["revision"]) for m in client.sent] == [(0, 1), (1, 1), (1, 2)]
+        assert [[c["operation"] for c in m["changes"]] for m in client.sent] == [
+            ["create"], [], ["delete"],
+        ]
+        assert client.sent[0]["user"] == "amy" and not client.sent[0]["resync"]
+        manager.disconnect(session_id)
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_model_changes_are_coalesced_within_the_window():
+    async def scenario():
+        manager = ConnectionManager(window=0.05, max_delay=0.2)
+        client = FakeWebSocket()
+        session_id = app_state.active_users.join("watcher").session_id
+        await manager.connect(client, session_id)
+
+        # A burst inside the window goes out as one event once it is quiet
+        await manager.broadcast_model_change("amy", "created capability 'A'")
+        await manager.broadcast_model_change("bob", "moved capability 'A'")
+        await asyncio.sleep(0.02)
+        assert client.sent == []
+        await asyncio.sleep(0.1)
+        [event] = client.sent
+        assert event["user"] == "amy, bob" and event["action"] == "made 2 changes"
+        assert [e["user"] for e in event["events"]] == ["amy", "bob"]
+
+        # A single change keeps its own user and action
+        await manager.broadcast_model_change("amy", "deleted capability 'A'")
+        await asyncio.sleep(0.1)
+        assert client.sent[-1]["action"] == "deleted capability 'A'"
+
+        # A continuous burst is still sent after the maximum delay
+        client.sent.clear()
+        for _ in range(12):
+            await manager.broadcast_model_change("amy", "moved capability 'A'")
+            await asyncio.sleep(0.03)
+        assert len(client.sent) >= 1 and client.sent[0]["action"].startswith("made")
+
+        manager.disconnect(session_id)
+        await manager.stop()
+
+    asyncio.run(scenario())